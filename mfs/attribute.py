@@ -7,7 +7,6 @@
 
 from mfs.objects import MFSObjectHeader, MFSObject
 from mfs.types import MFSTypes
-from mfs.string_buffer import StringBuffer
 
 class AttributeHeader(MFSObjectHeader):
     '''
@@ -35,6 +34,7 @@ class AttributeHeader(MFSObjectHeader):
     total_size = None
 
     attr = None
+    payload = None # Raw body when the attribute itself isn't decoded
 
     def __init__(self, name_size, datatype_size, dataspace_size, total_size):
         self.name_size = name_size
@@ -42,30 +42,29 @@ class AttributeHeader(MFSObjectHeader):
         self.dataspace_size = dataspace_size
         self.total_size = total_size
 
-    def serialize(self):
-        sb = StringBuffer(16 + self.total_size)
+    def serialize_into(self, string_buffer):
+        sb = string_buffer
         sb.pack('<BBHHHQ', self.mfs_type, self.ver, self.name_size, self.datatype_size, self.dataspace_size, self.total_size)
         if self.attr is not None:
-            sb.write(self.attr.serialize())
-        sb.seek(0)
-        return sb
+            self.attr.serialize_into(sb)
+        elif self.payload is not None:
+            sb.write(self.payload)
+        else:
+            sb.write('\0' * self.total_size)
 
 
     @classmethod
     def deserialize(cls, string_buffer):
-        sb = string_buffer
-        mfs_type = sb.read_uint(1)
+        mfs_type, ver, name_size, datatype_size, dataspace_size, total_size = string_buffer.unpack_header('<BBHHHQ')
         if not mfs_type == cls.mfs_type:
             raise TypeError('not an attribute header')
-        ver = sb.read_uint(1)
         if ver != cls.ver:
             raise TypeError('attribute header version mismatch')
-        name_size = sb.read_uint(2)
-        datatype_size = sb.read_uint(2)
-        dataspace_size = sb.read_uint(2)
-        total_size = sb.read_uint(8)
         return cls(name_size, datatype_size, dataspace_size, total_size)
 
+    def deserialize_body(self, string_buffer):
+        self.payload = string_buffer.raw_read(self.total_size)
+
 
     def __len__(self):
         return 16 + self.total_size
@@ -0,0 +1,168 @@
+from libc.stdint cimport uint8_t, uint64_t
+from libc.math cimport exp, log, ceil
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_C_CONTIGUOUS, PyBUF_WRITABLE
+from mfs.string_buffer import StringBuffer
+
+cdef extern from *:
+    # GCC atomics, several processes can share one mapped filter
+    uint8_t __sync_fetch_and_or(uint8_t *ptr, uint8_t value) nogil
+    uint64_t __sync_fetch_and_add(uint64_t *ptr, uint64_t value) nogil
+
+SIGNATURE = 'MBLM'
+cdef enum:
+    VERSION = 0
+    HEADER_SIZE = 24
+    RETIRED = 0x01 # flags, the filter was replaced by a new file
+
+cdef inline uint64_t load_u64(const unsigned char *p) nogil:
+    cdef uint64_t value = 0
+    cdef int i
+    for i in range(8):
+        value |= (<uint64_t> p[i]) << (8 * i)
+    return value
+
+def filter_size(capacity, fp_rate):
+    '''
+    Returns the number of bits and hashes that keep the false positive rate of
+    a filter holding capacity digests at fp_rate
+    '''
+    bits = int(ceil(-capacity * log(fp_rate) / (log(2) ** 2)))
+    bits = max(64, (bits + 63) // 64 * 64)
+    hashes = max(1, int(round(float(bits) / capacity * log(2))))
+    return bits, hashes
+
+def buffer_size(bits):
+    '''
+    Returns the size in bytes of a serialized filter of bits bits
+    '''
+    return HEADER_SIZE + bits // 8
+
+cdef class BloomFilter:
+    '''
+    Bloom filter over object digests, kept in a buffer so that it can live in
+    a shared memory mapped file and be updated in place.
+
+    +-----------------------------------------------------------------------------------+
+    |                               signature ('MBLM')                                  |
+    +-----------------------------------------------------------------------------------+
+    |     version        |    hashes          |       flags        |       res          |
+    +-----------------------------------------------------------------------------------+
+    |                               bits                                                |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+    |                               count                                               |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+    |                               bit array (bits / 8 bytes)                          |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+
+    Digests are already uniformly distributed so no hashing is done, the bit
+    positions are h1 + i * h2 (mod bits) where h1 and h2 are the first two
+    64-bit words of the digest. A miss means the digest was never added, a hit
+    has to be confirmed against the store.
+
+    flags is RETIRED once a rebuilt filter replaced this one, processes that
+    still map it see the flag and have to open the new filter.
+    '''
+    cdef Py_buffer view
+    cdef bint has_view
+    cdef unsigned char *bitmap
+    cdef uint8_t *flags_ptr
+    cdef uint64_t *count_ptr
+    cdef readonly uint64_t bits
+    cdef readonly int hashes
+    cdef readonly object buffer
+
+    def __cinit__(self, buffer):
+        PyObject_GetBuffer(buffer, &self.view, PyBUF_C_CONTIGUOUS | PyBUF_WRITABLE)
+        self.has_view = True
+        self.buffer = buffer
+        cdef unsigned char *p = <unsigned char *> self.view.buf
+        if self.view.len < HEADER_SIZE or p[0:4] != SIGNATURE or p[4] != VERSION:
+            raise TypeError('not a bloom filter')
+        self.hashes = p[5]
+        self.bits = load_u64(p + 8)
+        if self.bits == 0 or self.bits % 64 != 0 or self.view.len < buffer_size(self.bits):
+            raise TypeError('bloom filter size mismatch')
+        self.flags_ptr = <uint8_t *> (p + 6)
+        self.count_ptr = <uint64_t *> (p + 16)
+        self.bitmap = p + HEADER_SIZE
+
+    def __dealloc__(self):
+        if self.has_view:
+            PyBuffer_Release(&self.view)
+
+    @classmethod
+    def create(cls, buffer, bits, hashes):
+        '''
+        Writes an empty filter header to buffer, which has to be zeroed and at
+        least buffer_size(bits) bytes long, and returns the filter
+        '''
+        sb = StringBuffer.wrap(buffer)
+        sb.pack('<4sBBxxQQ', SIGNATURE, VERSION, hashes, bits, 0)
+        return cls(buffer)
+
+    cdef bint check(self, const unsigned char *sha, bint insert) nogil:
+        cdef uint64_t h1 = load_u64(sha)
+        cdef uint64_t h2 = load_u64(sha + 8) | 1
+        cdef uint64_t position
+        cdef uint8_t mask
+        cdef bint present = True
+        cdef int i
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % self.bits
+            mask = 1 << (position & 7)
+            if insert:
+                if not __sync_fetch_and_or(self.bitmap + (position >> 3), mask) & mask:
+                    present = False
+            elif not self.bitmap[position >> 3] & mask:
+                return False
+        if insert and not present:
+            __sync_fetch_and_add(self.count_ptr, 1)
+        return present
+
+    def add(self, sha):
+        '''
+        Adds the digest to the filter, returns True if it may have been present already
+        '''
+        if len(sha) < 16:
+            raise ValueError('digest too short')
+        return self.check(<const unsigned char *> (<char *> sha), True)
+
+    def __contains__(self, sha):
+        if len(sha) < 16:
+            raise ValueError('digest too short')
+        return self.check(<const unsigned char *> (<char *> sha), False)
+
+    def retire(self):
+        '''
+        Flags the filter as replaced, see retired
+        '''
+        __sync_fetch_and_or(self.flags_ptr, RETIRED)
+
+    property retired:
+        '''
+        True once the filter's file was replaced, digests added since may be missing
+        '''
+        def __get__(self):
+            return bool(self.flags_ptr[0] & RETIRED)
+
+    property count:
+        '''
+        Number of digests added (approximate, digests that collided on every bit aren't counted)
+        '''
+        def __get__(self):
+            return self.count_ptr[0]
+
+    def false_positive_rate(self):
+        '''
+        Estimated probability that a digest that was never added is reported present
+        '''
+        return (1.0 - exp(-float(self.hashes) * self.count_ptr[0] / self.bits)) ** self.hashes
+
+    def memory_usage(self):
+        '''
+        Size of the filter in bytes
+        '''
+        return buffer_size(self.bits)
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file mfs/datablock.py
+@description Data block, one chunk of a dataset
+'''
+
+from mfs.objects import MFSObjectHeader
+from mfs.types import MFSTypes
+
+class DataBlockHeader(MFSObjectHeader):
+    '''
+    +-----------------------------------------------------------------------------------+
+    |     mfs_type       |    ver             |              flags                      |
+    +-----------------------------------------------------------------------------------+
+    |                                  res                                              |
+    +-----------------------------------------------------------------------------------+
+    |                               total_size                                          |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+    |                               data*                                               |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+      * - total_size bytes, the elements of the chunk in row-major order
+
+    mfs_type   - MFSObject Type
+    ver        - data block version (currently 0)
+    flags      - data block flags, FILTERED if the data was encoded by the
+                 dataset's filter pipeline
+    res        - reserved
+    total_size - size in bytes of the data
+
+    The block doesn't know its shape, element type or filters, those are kept
+    by the dataset it belongs to. Blocks are content addressed like every other
+    object so equal chunks, within a dataset or across datasets and versions,
+    are stored once.
+    '''
+
+    FILTERED   = 0x01
+
+    mfs_type   = MFSTypes.DataBlock
+    ver        = 0
+    flags      = 0
+    total_size = 0
+    data       = None
+
+    def __init__(self, data='', flags=0):
+        self.flags = flags
+        self.data = data
+        self.total_size = len(data)
+
+    def serialize_into(self, string_buffer):
+        string_buffer.pack('<BBHIQ', self.mfs_type, self.ver, self.flags, 0, self.total_size)
+        string_buffer.write(self.data)
+
+    @classmethod
+    def deserialize(cls, string_buffer):
+        mfs_type, ver, flags, total_size = string_buffer.unpack_header('<BBHxxxxQ')
+        if mfs_type != cls.mfs_type:
+            raise TypeError('object is not a data block')
+        if ver != cls.ver:
+            raise TypeError('unsupported data block version')
+        inst = cls(flags=flags)
+        inst.total_size = total_size
+        return inst
+
+    def deserialize_body(self, string_buffer):
+        # A view, the data isn't copied out of the buffer
+        self.data = string_buffer.view(self.total_size)
+
+    def __len__(self):
+        return 16 + self.total_size
+
@@ -8,7 +8,6 @@
 
 from mfs.objects import MFSObject, MFSObjectHeader
 from mfs.types import MFSTypes
-from mfs.string_buffer import StringBuffer
 
 class DataspaceHeader(MFSObjectHeader):
     '''
@@ -54,27 +53,19 @@ class DataspaceHeader(MFSObjectHeader):
             raise ValueError('invalid shape')
 
 
-    def serialize(self):
-        sb = StringBuffer(16 + self.total_size)
+    def serialize_into(self, string_buffer):
+        sb = string_buffer
         sb.pack('<BBBBIQ', self.mfs_type, self.ver, self.dims, self.flags, 0, self.total_size)
         for ds in self.dataspaces:
-            sb.write(ds.serialize())
-        sb.seek(0)
-        return sb
+            ds.serialize_into(sb)
 
     @classmethod
     def deserialize(cls, string_buffer):
-        sb = string_buffer
-        mfs_type = sb.read_uint(1)
+        mfs_type, ver, dims, flags, total_size = string_buffer.unpack_header('<BBBBxxxxQ')
         if mfs_type != MFSTypes.Dataspace:
             raise TypeError('object is not a dataspace')
-        ver = sb.read_uint(1)
         if ver != 0:
             raise TypeError('unsupported dataspace version')
-        dims = sb.read_uint(1)
-        flags = sb.read_uint(1)
-        sb.read_uint(4)
-        total_size = sb.read_uint(8)
 
         return cls(dims, flags)
 
@@ -83,6 +74,9 @@ class DataspaceHeader(MFSObjectHeader):
         for i in xrange(self.dims):
             self.dataspaces[i] = Dataspace.deserialize(sb)
 
+    def deserialize_body(self, string_buffer):
+        self.deserialize_dataspaces(string_buffer)
+
     def __len__(self):
         return self.total_size + 16
 
@@ -102,16 +96,15 @@ class Dataspace(MFSObject):
     def __init__(self, dim_size):
         self.dim_size = dim_size
 
-    def serialize(self):
-        sb = StringBuffer(8)
-        sb.pack('<Q', self.dim_size)
-        sb.seek(0)
-        return sb
+    def serialized_size(self):
+        return 8
+
+    def serialize_into(self, string_buffer):
+        string_buffer.pack('<Q', self.dim_size)
 
     @classmethod
     def deserialize(cls, string_buffer):
-        sb = string_buffer
-        dim_size = sb.read_uint(8)
+        dim_size = string_buffer.read_u64()
         return cls(dim_size)
 
 
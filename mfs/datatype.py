@@ -7,7 +7,11 @@
 
 from mfs.objects import MFSObject, MFSObjectHeader
 from mfs.types import MFSTypes
-from mfs.string_buffer import StringBuffer
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 class DatatypeHeader(MFSObjectHeader):
     '''
@@ -37,6 +41,9 @@ class DatatypeHeader(MFSObjectHeader):
       0x08 float32
       0x09 double
       0x10 fixed-length string
+
+    numpy_dtype() and from_numpy() map datatypes to numpy dtypes and back,
+    numeric elements are always stored little-endian.
     '''
 
     mfs_type   = None
@@ -52,23 +59,57 @@ class DatatypeHeader(MFSObjectHeader):
         self.size = size
         self.total_size = total_size
 
-    def serialize(self):
-        sb = StringBuffer(16)
-        sb.pack('<BBHIQ', self.mfs_type, self.datatype, self.flags, self.size, self.total_size)
-        sb.seek(0)
-        return sb
+    def serialized_size(self):
+        return 16
+
+    def serialize_into(self, string_buffer):
+        string_buffer.pack('<BBHIQ', self.mfs_type, self.datatype, self.flags, self.size, self.total_size)
 
     @classmethod
     def deserialize(cls, string_buffer):
-        mfs_type = string_buffer.read_uint(1)
+        mfs_type, datatype, flags, size, total_size = string_buffer.unpack_header('<BBHIQ')
         if mfs_type != MFSTypes.Datatype:
             raise TypeError('object is not a datatype')
-        datatype = string_buffer.read_uint(1)
-        flags = string_buffer.read_uint(2)
-        size = string_buffer.read_uint(4)
-        total_size = string_buffer.read_uint(8)
         return cls(datatype, flags, size, total_size)
 
+    def numpy_dtype(self):
+        '''
+        Returns the numpy dtype of the elements as they're stored. The size and
+        flags have to agree with the datatype: integers are signed exactly when
+        flag 0x01 is set, floats have no flags, strings are ASCII or UTF-8.
+        '''
+        if np is None:
+            raise ImportError('numpy is required for typed arrays')
+        if self.datatype == 0x10:
+            if self.flags >> 4 not in (StringEncoding.ASCII, StringEncoding.UTF8):
+                raise TypeError('unsupported string encoding 0x%x' % (self.flags >> 4))
+            return np.dtype('S%d' % self.size)
+        if self.datatype not in numpy_types:
+            raise TypeError('datatype 0x%02x has no numpy equivalent' % self.datatype)
+        dtype = np.dtype(numpy_types[self.datatype])
+        if dtype.itemsize != self.size:
+            raise TypeError('datatype 0x%02x with a size of %d' % (self.datatype, self.size))
+        flags = 0x01 if dtype.kind == 'i' else 0x00
+        if self.flags != flags:
+            raise TypeError('datatype 0x%02x with flags 0x%x, expected 0x%x' % (self.datatype, self.flags, flags))
+        return dtype
+
+    @classmethod
+    def from_numpy(cls, dtype):
+        '''
+        Returns the datatype of a numpy dtype (or anything numpy.dtype()
+        accepts), the byte order is ignored
+        '''
+        if np is None:
+            raise ImportError('numpy is required for typed arrays')
+        dtype = np.dtype(dtype)
+        if dtype.kind == 'S':
+            return cls(0x10, 0, dtype.itemsize)
+        key = (dtype.kind, dtype.itemsize)
+        if key not in numpy_datatypes:
+            raise TypeError('no datatype for numpy dtype %s' % dtype)
+        return numpy_datatypes[key]()
+
 class MFSUByteType(DatatypeHeader):
     def __init__(self):
         datatype = 0x00
@@ -169,6 +210,35 @@ class MFSStringType(DatatypeHeader):
 
 
 
+# datatype -> numpy dtype of the stored elements
+numpy_types = {
+    0x00 : '<u1',
+    0x01 : '<i1',
+    0x02 : '<u2',
+    0x03 : '<i2',
+    0x04 : '<u4',
+    0x05 : '<i4',
+    0x06 : '<u8',
+    0x07 : '<i8',
+    0x08 : '<f4',
+    0x09 : '<f8',
+}
+
+# (numpy kind, size) -> datatype
+numpy_datatypes = {
+    ('u', 1) : MFSUByteType,
+    ('i', 1) : MFSByteType,
+    ('u', 2) : MFSUShortType,
+    ('i', 2) : MFSShortType,
+    ('u', 4) : MFSUIntType,
+    ('i', 4) : MFSIntType,
+    ('u', 8) : MFSUInt64Type,
+    ('i', 8) : MFSInt64Type,
+    ('f', 4) : MFSFloat32Type,
+    ('f', 8) : MFSDoubleType,
+    ('b', 1) : MFSUByteType,
+}
+
 class Datatype(MFSObject):
     '''
     This may contain a property field but mostly it'll be used in VLEN situations which I won't support yet
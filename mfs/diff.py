@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file mfs/diff.py
+@description Merkle tree diff
+'''
+
+from mfs.node import MerkleNodeHeader
+from mfs.types import MFSTypes
+
+class MerkleChange:
+    '''
+    A child that differs between two versions of a tree
+
+    status - ADDED, REMOVED or MODIFIED
+    path   - tuple of child indexes leading from the root to the child
+    old    - digest of the child in the old tree (None if it was added)
+    new    - digest of the child in the new tree (None if it was removed)
+    '''
+    ADDED    = 'added'
+    REMOVED  = 'removed'
+    MODIFIED = 'modified'
+
+    status = None
+    path   = None
+    old    = None
+    new    = None
+
+    def __init__(self, status, path, old, new):
+        self.status = status
+        self.path = path
+        self.old = old
+        self.new = new
+
+    def __eq__(self, other):
+        return isinstance(other, MerkleChange) and \
+                (self.status, self.path, self.old, self.new) == (other.status, other.path, other.old, other.new)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'MerkleChange(%s, %r)' % (self.status, self.path)
+
+
+def diff(store, old_sha, new_sha):
+    '''
+    Walks the trees rooted at old_sha and new_sha side by side and yields a
+    MerkleChange for every path that was added, removed or modified. Deleted
+    (Nil) children count as absent. Subtrees whose digests match are skipped
+    without being read, so the cost follows the size of the change rather
+    than the size of the tree.
+
+    Children are matched by index, except in SORTED nodes where they're
+    matched by digest and in MerkleTrie branches where they're matched by
+    bucket (mode), so an insert that shifts the later children isn't reported
+    as a change to each of them. Paths use the new tree's indexes, removed
+    children the old tree's.
+    '''
+    if old_sha == new_sha:
+        return
+    old = store.load(old_sha)
+    new = store.load(new_sha)
+    if not (isinstance(old, MerkleNodeHeader) and isinstance(new, MerkleNodeHeader)):
+        yield MerkleChange(MerkleChange.MODIFIED, (), old_sha, new_sha)
+        return
+    for change in diff_nodes(store, old, new, ()):
+        yield change
+
+def children(node):
+    # (index, MerkleNode) of the children that aren't deleted
+    for i in xrange(node.children):
+        merkle_node = node.objects[i]
+        if merkle_node.mfs_type != MFSTypes.Nil:
+            yield i, merkle_node
+
+def members(store, node, path):
+    # (path, MerkleNode) of the children in the leaves below a trie node
+    if not node.flags & MerkleNodeHeader.BRANCH:
+        for i, merkle_node in children(node):
+            yield path + (i,), merkle_node
+        return
+    for i, merkle_node in children(node):
+        for member in members(store, store.load(merkle_node.sha), path + (i,)):
+            yield member
+
+def match(old_children, new_children, key):
+    '''
+    Pairs up (old path, old child, new path, new child) by key(child), the
+    children missing on one side are paired with None
+    '''
+    old_by_key = dict((key(merkle_node), (p, merkle_node)) for p, merkle_node in old_children)
+    for p, merkle_node in new_children:
+        old_path, old_node = old_by_key.pop(key(merkle_node), (None, None))
+        yield old_path, old_node, p, merkle_node
+    for old_path, old_node in sorted(old_by_key.itervalues()):
+        yield old_path, old_node, None, None
+
+def positional(old, new, path):
+    # Pairs up the children at the same index
+    old_children = dict(children(old))
+    new_children = dict(children(new))
+    for i in xrange(max(old.children, new.children)):
+        yield path + (i,), old_children.get(i), path + (i,), new_children.get(i)
+
+def diff_nodes(store, old, new, path):
+    indexed = lambda node: ((path + (i,), merkle_node) for i, merkle_node in children(node))
+    if old.flags & new.flags & MerkleNodeHeader.BRANCH:
+        pairs = match(indexed(old), indexed(new), lambda merkle_node: merkle_node.mode)
+    elif (old.flags | new.flags) & MerkleNodeHeader.BRANCH:
+        # A trie node that was split or folded, compare the members below it
+        pairs = match(members(store, old, path), members(store, new, path), lambda merkle_node: merkle_node.sha)
+    elif (old.flags | new.flags) & MerkleNodeHeader.SORTED:
+        pairs = match(indexed(old), indexed(new), lambda merkle_node: merkle_node.sha)
+    else:
+        pairs = positional(old, new, path)
+
+    for old_path, a, new_path, b in pairs:
+        if a is None and b is None:
+            continue
+        if a is None:
+            yield MerkleChange(MerkleChange.ADDED, new_path, None, b.sha)
+        elif b is None:
+            yield MerkleChange(MerkleChange.REMOVED, old_path, a.sha, None)
+        elif a.sha == b.sha:
+            continue # Identical subtree, prune
+        elif a.mfs_type == b.mfs_type == MFSTypes.MerkleNode:
+            for change in diff_nodes(store, store.load(a.sha), store.load(b.sha), new_path):
+                yield change
+        else:
+            yield MerkleChange(MerkleChange.MODIFIED, new_path, a.sha, b.sha)
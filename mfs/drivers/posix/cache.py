@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file mfs/drivers/posix/cache.py
+@description LRU cache of decoded chunks
+'''
+
+from collections import OrderedDict
+from threading import Lock
+
+class ChunkCache:
+    '''
+    Least recently used cache of decoded data blocks keyed by their digest,
+    holding at most capacity bytes of chunk data.
+
+    Objects are immutable so a cached chunk is never stale and nothing is ever
+    invalidated, one cache can be shared by every dataset and store. All the
+    methods can be called from several threads at once. Two threads missing
+    the same chunk both load it, the second put() replaces the first.
+
+    hits, misses and evictions count the lookups and the chunks dropped to
+    stay under the capacity.
+    '''
+    capacity  = 64 * 1024 * 1024
+    size      = 0
+
+    # Statistics
+    hits      = 0
+    misses    = 0
+    evictions = 0
+
+    def __init__(self, capacity=64 * 1024 * 1024):
+        self.capacity = capacity
+        self.entries = OrderedDict() # sha -> (value, size), least recently used first
+        self.lock = Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, sha):
+        '''
+        Returns the cached value for sha or None
+        '''
+        with self.lock:
+            entry = self.entries.pop(sha, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[sha] = entry # Most recently used
+            self.hits += 1
+            return entry[0]
+
+    def put(self, sha, value, size):
+        '''
+        Caches value, which costs size bytes, under sha and evicts the least
+        recently used chunks until the cache fits. Values larger than the
+        whole cache aren't kept.
+        '''
+        with self.lock:
+            old = self.entries.pop(sha, None)
+            if old is not None:
+                self.size -= old[1]
+            if size > self.capacity:
+                return
+            self.entries[sha] = (value, size)
+            self.size += size
+            while self.size > self.capacity:
+                evicted, (value, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def __contains__(self, sha):
+        with self.lock:
+            return sha in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def clear(self):
+        '''
+        Drops every chunk, the statistics are kept
+        '''
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        '''
+        Returns the statistics and current usage as a dict
+        '''
+        with self.lock:
+            return {
+                'hits'      : self.hits,
+                'misses'    : self.misses,
+                'evictions' : self.evictions,
+                'chunks'    : len(self.entries),
+                'size'      : self.size,
+                'capacity'  : self.capacity,
+            }
+
+
+# Used by datasets that aren't given a cache
+chunk_cache = ChunkCache()
+
@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file mfs/drivers/posix/collector.py
+@description Reachability based garbage collection for the object store
+'''
+
+from mfs.drivers.posix.pack import write_pack
+from mfs.node import MerkleNodeHeader
+from mfs.exceptions import ObjectNotFound
+from mfs.types import MFSTypes
+import time
+import errno
+import os
+
+class GarbageCollector:
+    '''
+    Mark and sweep collector for an ObjectStore
+
+    Everything reachable from roots (a list of digests) through MerkleNode
+    children is marked, deleted (Nil) children are not followed. Loose objects
+    that weren't marked and are older than grace_period seconds are deleted
+    and packs holding unmarked objects are rewritten without them.
+
+    The objects present when the collection starts are numbered by their
+    position in a pack index or in a sorted snapshot of the loose digests, and
+    the marks are one bit per object, so marking 100M packed objects takes
+    about 12MB. Loose objects cost their digest in the snapshot, repack first
+    when there are many of them.
+
+    step() runs the collection in slices of at most time_budget seconds (one
+    pack rewrite can overrun a slice). Readers can keep using the store
+    throughout, loose objects are unlinked and packs replaced with renames.
+    Objects written while the collection runs are never swept and are marked
+    from before the sweep starts so that old objects they reference survive.
+    While the collection runs ObjectStore.write() appends every digest it
+    writes or finds already present to the journal (<path>/objects/gc-journal),
+    and the sweep reads the journal and marks from it before deleting anything,
+    so an old object a writer reuses mid sweep is kept with what it references.
+    Writers must only reference objects they wrote or that are reachable. A
+    collection that is abandoned leaves its journal behind until the next one.
+    The store's Bloom filter is rebuilt at the end, no other process should
+    be writing at that point.
+    '''
+    START       = 'start'
+    MARK        = 'mark'
+    REMARK      = 'remark'
+    SWEEP_LOOSE = 'sweep_loose'
+    SWEEP_PACKS = 'sweep_packs'
+    DONE        = 'done'
+
+    store          = None
+    roots          = None
+    grace_period   = 3600
+    phase          = START
+
+    # Statistics
+    marked         = 0
+    swept_loose    = 0
+    swept_packed   = 0
+    packs_rewritten = 0
+
+    def __init__(self, store, roots, grace_period=3600):
+        self.store = store
+        self.roots = list(roots)
+        self.grace_period = grace_period
+        self.phase = self.START
+        self.marked = 0
+        self.swept_loose = 0
+        self.swept_packed = 0
+        self.packs_rewritten = 0
+
+    def collect(self):
+        '''
+        Runs the whole collection
+        '''
+        while not self.step():
+            pass
+
+    def step(self, time_budget=None):
+        '''
+        Runs the collection for up to time_budget seconds (to completion if
+        None) and returns True once it's done
+        '''
+        deadline = None if time_budget is None else time.time() + time_budget
+        while self.phase != self.DONE:
+            if self.phase == self.START:
+                self.start()
+            elif self.phase == self.MARK:
+                if self.mark(deadline):
+                    self.phase = self.REMARK
+            elif self.phase == self.REMARK:
+                self.remark()
+                self.phase = self.SWEEP_LOOSE
+            elif self.phase == self.SWEEP_LOOSE:
+                if self.sweep_loose(deadline):
+                    self.phase = self.SWEEP_PACKS
+            elif self.phase == self.SWEEP_PACKS:
+                if self.sweep_packs(deadline):
+                    self.finish()
+                    self.phase = self.DONE
+            if deadline is not None and time.time() >= deadline:
+                break
+        return self.phase == self.DONE
+
+    def start(self):
+        self.started = time.time()
+        # Opened first, writes from now on are journaled or in the snapshots below
+        self.journal = os.open(self.store.journal_path(), os.O_RDWR | os.O_CREAT | os.O_TRUNC)
+        self.journal_offset = 0
+        self.store.reload_packs()
+        self.packs = list(self.store.packs)
+        self.pack_marks = [bytearray((len(pack) + 7) // 8) for pack in self.packs]
+
+        # loose_objects() yields the digests in order
+        self.loose = bytearray()
+        for sha in self.store.loose_objects():
+            self.loose += sha
+        self.loose_count = len(self.loose) // self.store.digest_size
+        self.loose_marks = bytearray((self.loose_count + 7) // 8)
+
+        self.unindexed = set() # Marked objects written after the collection started
+        self.stack = list(self.roots)
+        self.sweep_position = 0
+        self.phase = self.MARK
+
+    def finish(self):
+        self.store.reload_packs()
+        self.store.rebuild_filter()
+        os.unlink(self.store.journal_path())
+        os.close(self.journal)
+        self.journal = None
+
+    def find_loose(self, sha):
+        width = self.store.digest_size
+        lo, hi = 0, self.loose_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_sha = str(self.loose[mid * width : (mid + 1) * width])
+            if mid_sha < sha:
+                lo = mid + 1
+            elif mid_sha > sha:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def locate(self, sha):
+        '''
+        Returns the mark bitmap and bit number of sha, or (None, -1) if the
+        object wasn't in the store when the collection started
+        '''
+        for pack, marks in zip(self.packs, self.pack_marks):
+            i = pack.find(sha)
+            if i >= 0:
+                return marks, i
+        i = self.find_loose(sha)
+        if i >= 0:
+            return self.loose_marks, i
+        return None, -1
+
+    def set_mark(self, sha):
+        '''
+        Marks sha, returns False if it was marked already
+        '''
+        marks, i = self.locate(sha)
+        if marks is None:
+            if sha in self.unindexed:
+                return False
+            self.unindexed.add(sha)
+            return True
+        if marks[i >> 3] & (1 << (i & 7)):
+            return False
+        marks[i >> 3] |= 1 << (i & 7)
+        self.marked += 1
+        return True
+
+    def mark(self, deadline=None):
+        '''
+        Marks objects until the stack is empty (returns True) or the deadline passes
+        '''
+        while self.stack:
+            sha = self.stack.pop()
+            if self.set_mark(sha):
+                self.push_children(sha)
+            if deadline is not None and time.time() >= deadline:
+                return not self.stack
+        return True
+
+    def push_children(self, sha):
+        try:
+            sb = self.store.read(sha)
+        except ObjectNotFound:
+            # Dangling, or journaled by a write that hasn't put it in place yet
+            # and will journal it again once it has
+            self.unindexed.discard(sha)
+            return
+        if sb.read_u8() != MFSTypes.MerkleNode:
+            return
+        sb.seek(0)
+        node = MerkleNodeHeader.deserialize(sb)
+        node.deserialize_body(sb)
+        children = node.objects # Read straight from the buffer, see MerkleChildren
+        for i in xrange(len(children)):
+            if children.mfs_type(i) != MFSTypes.Nil:
+                self.stack.append(children.sha(i))
+
+    def remark(self):
+        '''
+        Marks from the objects written since the collection started, they may
+        reference objects that were otherwise unreachable
+        '''
+        for sha in self.store.loose_objects():
+            if self.find_loose(sha) < 0:
+                self.stack.append(sha)
+        self.read_journal()
+
+    def read_journal(self):
+        '''
+        Marks from the digests appended to the journal since it was last read
+        '''
+        width = self.store.digest_size
+        size = os.fstat(self.journal).st_size
+        size -= (size - self.journal_offset) % width
+        if size > self.journal_offset:
+            os.lseek(self.journal, self.journal_offset, os.SEEK_SET)
+            data = ''
+            while len(data) < size - self.journal_offset:
+                data += os.read(self.journal, size - self.journal_offset - len(data))
+            self.journal_offset = size
+            for i in xrange(0, len(data), width):
+                self.stack.append(data[i:i + width])
+        self.mark()
+
+    def sweep_loose(self, deadline=None):
+        width = self.store.digest_size
+        cutoff = self.started - self.grace_period
+        while self.sweep_position < self.loose_count:
+            i = self.sweep_position
+            self.sweep_position += 1
+            if self.loose_marks[i >> 3] & (1 << (i & 7)):
+                continue
+            path = self.store.object_path(str(self.loose[i * width : (i + 1) * width]))
+            try:
+                if os.stat(path).st_mtime > cutoff:
+                    continue
+                self.read_journal()
+                if self.loose_marks[i >> 3] & (1 << (i & 7)):
+                    continue # Reused by a writer
+                os.unlink(path)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+                continue # Moved into a pack meanwhile, its pack wasn't in the snapshot
+            self.swept_loose += 1
+            if deadline is not None and time.time() >= deadline:
+                break
+        if self.sweep_position < self.loose_count:
+            return False
+        self.sweep_position = 0
+        return True
+
+    def sweep_packs(self, deadline=None):
+        while self.sweep_position < len(self.packs):
+            pack = self.packs[self.sweep_position]
+            marks = self.pack_marks[self.sweep_position]
+            self.sweep_position += 1
+            dropped = self.rewrite_pack(pack, marks)
+            if not dropped:
+                continue
+            self.swept_packed += dropped
+            self.packs_rewritten += 1
+            if deadline is not None and time.time() >= deadline:
+                break
+        return self.sweep_position >= len(self.packs)
+
+    def rewrite_pack(self, pack, marks):
+        '''
+        Replaces pack with a pack of its marked objects and returns the number
+        of objects dropped. The journal is read again once the new pack is
+        written, objects reused meanwhile send it back to be rewritten.
+        '''
+        names = set(p.name for p in self.packs)
+        while True:
+            self.read_journal()
+            kept = [i for i in xrange(len(pack)) if marks[i >> 3] & (1 << (i & 7))]
+            if len(kept) == len(pack):
+                return 0
+            path = None
+            if kept:
+                objects = ((sha, pack.read(sha)) for sha in (pack.digest_at(i) for i in kept))
+                path = write_pack(os.path.dirname(pack.path), objects, pack.digest)
+            self.read_journal()
+            if sum(1 for i in xrange(len(pack)) if marks[i >> 3] & (1 << (i & 7))) == len(kept):
+                break
+            if path is not None and os.path.basename(path)[len('pack-'):] not in names:
+                os.unlink(path + '.idx')
+                os.unlink(path + '.pack')
+        # Readers that already mapped the old pack keep using it, the rest
+        # find the objects in the new one
+        os.unlink(pack.path + '.idx')
+        os.unlink(pack.path + '.pack')
+        return len(pack) - len(kept)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file mfs/drivers/posix/datablock.py
+@description Chunk index, maps the chunks of a dataset to their data blocks
+'''
+
+from mfs.datablock import DataBlockHeader
+from mfs.node import MerkleNode, MerkleNodeHeader
+from mfs.types import MFSTypes
+
+class ChunkIndex:
+    '''
+    The data blocks of a dataset's count chunks, numbered in row-major order
+    of the chunk grid, held by two levels of MerkleNodeHeaders:
+
+        root ------+-- page 0 ----+-- chunk 0
+                   |              +-- chunk 1 (Nil)
+                   |              +-- ...
+                   +-- page 1 (Nil)
+                   +-- ...
+
+    Page p holds chunks p * page_size to (p + 1) * page_size - 1, every page is
+    full except for the last one. Chunks that were never written, and pages
+    without any written chunk, are Nil entries and get() returns None for them.
+
+    A chunk is located by position so looking it up reads one page (its
+    entries aren't decoded, see MerkleChildren). Writing a chunk dirties its
+    page and the root only and commit() writes just those. Blocks read from
+    the store go through cache, a ChunkCache, when one is given.
+
+    Blocks flagged FILTERED are decoded with pipeline, the dataset's
+    FilterPipelineHeader, when they're read and cached decoded.
+    '''
+    page_size = 1024
+    store     = None
+    count     = 0
+    root      = None
+    cache     = None
+    pipeline  = None
+
+    def __init__(self, store, count, root=None, page_size=1024, cache=None, pipeline=None):
+        '''
+        root can be a loaded MerkleNodeHeader or its digest, None starts an index with no chunks written
+        '''
+        self.store = store
+        self.count = count
+        self.page_size = page_size
+        self.cache = cache
+        self.pipeline = pipeline
+        pages = (count + page_size - 1) // page_size
+        if pages > 0xffff:
+            raise ValueError('too many chunks (%d), use larger chunks' % count)
+        if root is None:
+            root = self.new_node(pages)
+        elif isinstance(root, basestring):
+            root = store.load(root)
+        if root.children != pages:
+            raise ValueError('chunk index has %d pages, expected %d' % (root.children, pages))
+        self.root = root
+
+    def new_node(self, children):
+        node = MerkleNodeHeader(self.store.digest)
+        nil = '\0' * node.digest_size
+        for i in xrange(children):
+            node.add_child(MerkleNode(MFSTypes.Nil, 0, 0, nil))
+        return node
+
+    def locate(self, n):
+        if not 0 <= n < self.count:
+            raise IndexError('chunk %d out of range' % n)
+        return divmod(n, self.page_size)
+
+    def page(self, p, create=False):
+        '''
+        Returns page p, None if it's Nil unless create is set
+        '''
+        if self.root.objects[p].mfs_type == MFSTypes.Nil:
+            if not create:
+                return None
+            page = self.new_node(min(self.page_size, self.count - p * self.page_size))
+            self.root.set_child(p, page)
+            return page
+        return self.root.load_child(p, self.store)
+
+    def entry(self, n):
+        '''
+        Returns the MerkleNode of chunk n or None if it was never written
+        '''
+        p, i = self.locate(n)
+        page = self.page(p)
+        if page is None:
+            return None
+        entry = page.objects[i]
+        if entry.mfs_type == MFSTypes.Nil:
+            return None
+        return entry
+
+    def sha(self, n):
+        '''
+        Returns the digest of chunk n's data block, None if it isn't written or committed yet
+        '''
+        entry = self.entry(n)
+        return entry.sha if entry is not None else None
+
+    def get(self, n):
+        '''
+        Returns the decoded DataBlockHeader of chunk n or None. Blocks read
+        from the store aren't attached to their page (see load_child), only cached.
+        '''
+        return self.load(self.entry(n))
+
+    def load(self, entry):
+        '''
+        Returns the decoded DataBlockHeader behind an entry() or None if entry
+        is None. Unlike entry() this can be called from several threads.
+        '''
+        if entry is None:
+            return None
+        if entry.obj is not None:
+            return self.decode(entry.obj) # Not committed yet
+        if self.cache is None:
+            return self.decode(self.store.load(entry.sha))
+        key = entry.sha if self.pipeline is None else (entry.sha, self.pipeline.key())
+        block = self.cache.get(key)
+        if block is None:
+            block = self.decode(self.store.load(entry.sha))
+            self.cache.put(key, block, block.total_size)
+        return block
+
+    def decode(self, block):
+        if not block.flags & DataBlockHeader.FILTERED:
+            return block
+        if self.pipeline is None:
+            raise TypeError('filtered data block in a dataset without filters')
+        return DataBlockHeader(self.pipeline.decode(block.data))
+
+    def set(self, n, block):
+        '''
+        Sets chunk n to a DataBlockHeader, or back to Nil if block is None
+        '''
+        p, i = self.locate(n)
+        page = self.page(p, create=block is not None)
+        if page is None:
+            return
+        if block is not None:
+            page.set_child(i, block)
+            return
+        page.clear_child(i)
+        if all(o.mfs_type == MFSTypes.Nil for o in page.objects):
+            self.root.clear_child(p) # Same tree as if the page was never written
+
+    def commit(self):
+        '''
+        Writes the changed pages and blocks and returns the digest of the root
+        '''
+        return self.root.commit(self.store)
+
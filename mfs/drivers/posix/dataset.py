@@ -0,0 +1,357 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file mfs/drivers/posix/dataset.py
+@description Chunked n-dimensional dataset storage
+'''
+
+from mfs.drivers.posix.datablock import ChunkIndex
+from mfs.drivers.posix.cache import chunk_cache
+from mfs.datablock import DataBlockHeader
+from mfs.datatype import DatatypeHeader
+from mfs.filters import FilterPipelineHeader, map_chunks
+from mfs.dataspace import DataspaceHeader
+from mfs.node import MerkleNode, MerkleNodeHeader
+from mfs.selection import Hyperslab
+from mfs.types import MFSTypes
+from itertools import islice, product
+
+# Default chunks are shrunk until they hold at most this many bytes
+CHUNK_TARGET = 64 * 1024
+
+# Chunks loaded or encoded by the thread pool at once
+CHUNK_BATCH = 64
+
+def product_of(values):
+    total = 1
+    for v in values:
+        total *= v
+    return total
+
+def guess_chunks(shape, element_size):
+    '''
+    Returns a chunk shape of at most CHUNK_TARGET bytes for a dataset of shape,
+    the largest dimension is halved until the chunk fits
+    '''
+    chunks = [max(1, s) for s in shape]
+    while product_of(chunks) * element_size > CHUNK_TARGET and max(chunks) > 1:
+        d = chunks.index(max(chunks))
+        chunks[d] = (chunks[d] + 1) // 2
+    return tuple(chunks)
+
+def strides(shape, element_size):
+    '''
+    Returns the byte strides of a row-major array of shape
+    '''
+    result = [element_size] * len(shape)
+    for d in xrange(len(shape) - 2, -1, -1):
+        result[d] = result[d + 1] * shape[d + 1]
+    return result
+
+def copy_box(src, src_shape, src_start, dst, dst_shape, dst_start, count, element_size):
+    '''
+    Copies the box of count elements at src_start in src, a row-major array of
+    src_shape, to dst_start in dst. The box is copied one contiguous run at a
+    time, trailing dimensions that both arrays hold whole are merged into the run.
+    '''
+    src_shape, src_start = list(src_shape), list(src_start)
+    dst_shape, dst_start = list(dst_shape), list(dst_start)
+    count = list(count)
+    if 0 in count:
+        return
+    if not count: # Scalar
+        dst[0:element_size] = src[0:element_size]
+        return
+    while len(count) > 1 and count[-1] == src_shape[-1] == dst_shape[-1]:
+        for shape, start in ((src_shape, src_start), (dst_shape, dst_start)):
+            last = shape.pop()
+            start.pop() # Always 0, the dimension is held whole
+            start[-1] *= last
+            shape[-1] *= last
+        last = count.pop()
+        count[-1] *= last
+
+    run = count[-1] * element_size
+    src_strides = strides(src_shape, element_size)
+    dst_strides = strides(dst_shape, element_size)
+    src_base = sum(s * t for s, t in zip(src_start, src_strides))
+    dst_base = sum(s * t for s, t in zip(dst_start, dst_strides))
+    for index in product(*[xrange(c) for c in count[:-1]]):
+        so = src_base + sum(i * t for i, t in zip(index, src_strides))
+        do = dst_base + sum(i * t for i, t in zip(index, dst_strides))
+        dst[do:do + run] = src[so:so + run]
+
+
+class Dataset:
+    '''
+    An n-dimensional array of fixed size elements stored as chunks, every chunk
+    is a DataBlockHeader holding a chunks shaped box of the array in row-major
+    order. Chunks on the upper edges are stored whole, the elements past the
+    end of the array are zeros.
+
+    The dataset is a MerkleNodeHeader with four or five children:
+
+        0  Datatype       - element type, its size is the element size in bytes
+        1  Dataspace      - shape of the array
+        2  Dataspace      - shape of a chunk
+        3  MerkleNode     - ChunkIndex root
+        4  FilterPipeline - filters the chunks are encoded by, if any
+
+    Chunks are run through the pipeline when they're written and stored
+    FILTERED if that made them smaller, otherwise as they are.
+
+    Reading or writing a region only reads and writes the chunks it overlaps,
+    chunks that were never written read as zeros. read_selection() reads
+    strided Hyperslabs the same way. Chunks read from the store are kept in a
+    ChunkCache, the one shared by every dataset unless another one is given.
+    Chunks are content addressed so equal chunks (like repeated fill values)
+    are stored once.
+    '''
+    DATATYPE = 0
+    SHAPE    = 1
+    CHUNKS   = 2
+    INDEX    = 3
+    FILTERS  = 4 # Only when the dataset has filters
+
+    store        = None
+    node         = None
+    datatype     = None
+    shape        = None
+    chunks       = None
+    element_size = None
+    index        = None
+    cache        = None
+    pipeline     = None
+
+    def __init__(self, store, root=None, shape=None, datatype=None, chunks=None, cache=None, filters=None):
+        '''
+        Opens the dataset at root (a loaded MerkleNodeHeader or its digest) or,
+        when root is None, creates one of shape holding datatype elements,
+        chunked as guess_chunks() decides unless chunks is given. The chunks of
+        a new dataset are encoded by filters, a FilterPipelineHeader or a list
+        of Filters, when it's given.
+        '''
+        self.store = store
+        self.cache = cache if cache is not None else chunk_cache
+        if root is None:
+            self.create(shape, datatype, chunks, filters)
+        else:
+            if isinstance(root, basestring):
+                root = store.load(root)
+            self.open(root)
+
+    def create(self, shape, datatype, chunks, filters=None):
+        if shape is None or datatype is None:
+            raise ValueError('a new dataset needs a shape and a datatype')
+        shape = tuple(shape)
+        if datatype.size < 1:
+            raise ValueError('invalid element size')
+        if chunks is None:
+            chunks = guess_chunks(shape, datatype.size)
+        chunks = tuple(chunks)
+        if len(chunks) != len(shape) or min(chunks or (1,)) < 1:
+            raise ValueError('chunk shape %s does not fit dataset shape %s' % (chunks, shape))
+        if filters is not None and not isinstance(filters, FilterPipelineHeader):
+            filters = FilterPipelineHeader(filters)
+        if filters is not None and filters.filters:
+            for f in filters.filters:
+                f.codec() # Fail now rather than at the first write
+            self.pipeline = filters
+        self.set_geometry(datatype, shape, chunks)
+        self.index = ChunkIndex(self.store, self.chunk_count(), cache=self.cache, pipeline=self.pipeline)
+
+        node = MerkleNodeHeader(self.store.digest)
+        node.add_child(MerkleNode(MFSTypes.Datatype, 0, 0, None, datatype))
+        node.add_child(MerkleNode(MFSTypes.Dataspace, 0, 0, None, DataspaceHeader(shape)))
+        node.add_child(MerkleNode(MFSTypes.Dataspace, 0, 0, None, DataspaceHeader(chunks)))
+        node.add_child(MerkleNode(MFSTypes.MerkleNode, 0, 0, None, self.index.root))
+        if self.pipeline is not None:
+            node.add_child(MerkleNode(MFSTypes.FilterPipeline, 0, 0, None, self.pipeline))
+        self.node = node
+
+    def open(self, node):
+        if node.children not in (4, 5):
+            raise TypeError('not a dataset')
+        datatype = node.load_child(self.DATATYPE, self.store)
+        shape = node.load_child(self.SHAPE, self.store)
+        chunks = node.load_child(self.CHUNKS, self.store)
+        if not isinstance(datatype, DatatypeHeader) or not isinstance(shape, DataspaceHeader) or \
+                not isinstance(chunks, DataspaceHeader) or shape.dims != chunks.dims:
+            raise TypeError('not a dataset')
+        if node.children == 5:
+            self.pipeline = node.load_child(self.FILTERS, self.store)
+            if not isinstance(self.pipeline, FilterPipelineHeader):
+                raise TypeError('not a dataset')
+        self.set_geometry(datatype,
+                          tuple(d.dim_size for d in shape.dataspaces),
+                          tuple(d.dim_size for d in chunks.dataspaces))
+        self.index = ChunkIndex(self.store, self.chunk_count(), node.load_child(self.INDEX, self.store),
+                                cache=self.cache, pipeline=self.pipeline)
+        self.node = node
+
+    def set_geometry(self, datatype, shape, chunks):
+        self.datatype = datatype
+        self.element_size = datatype.size
+        self.shape = shape
+        self.chunks = chunks
+        self.grid = tuple((s + c - 1) // c for s, c in zip(shape, chunks))
+        self.chunk_bytes = product_of(chunks) * self.element_size
+
+    def chunk_count(self):
+        return product_of(self.grid)
+
+    def chunk_number(self, coords):
+        '''
+        Returns the position in the chunk index of the chunk at grid coordinates coords
+        '''
+        n = 0
+        for c, g in zip(coords, self.grid):
+            n = n * g + c
+        return n
+
+    def check_region(self, start, count):
+        if start is None:
+            start = (0,) * len(self.shape)
+        if count is None:
+            count = tuple(s - o for s, o in zip(self.shape, start))
+        start, count = tuple(start), tuple(count)
+        if len(start) != len(self.shape) or len(count) != len(self.shape):
+            raise ValueError('region has the wrong number of dimensions')
+        for o, c, s in zip(start, count, self.shape):
+            if o < 0 or c < 0 or o + c > s:
+                raise ValueError('region %s + %s exceeds the dataset shape %s' % (start, count, self.shape))
+        return start, count
+
+    def overlapping(self, start, count):
+        '''
+        Yields (chunk number, chunk start, box start, box count) for every
+        chunk the region overlaps, box is the part of the region in the chunk
+        '''
+        if 0 in count:
+            return
+        ranges = [xrange(o // c, (o + n - 1) // c + 1) for o, n, c in zip(start, count, self.chunks)]
+        for coords in product(*ranges):
+            chunk_start = tuple(i * c for i, c in zip(coords, self.chunks))
+            lo = tuple(max(o, cs) for o, cs in zip(start, chunk_start))
+            hi = tuple(min(o + n, cs + c) for o, n, cs, c in zip(start, count, chunk_start, self.chunks))
+            yield self.chunk_number(coords), chunk_start, lo, tuple(h - l for h, l in zip(hi, lo))
+
+    def chunk_data(self, selection):
+        '''
+        Returns the stored data of the chunk selection is exactly, or None when
+        the selection isn't one whole chunk or the chunk was never written
+        '''
+        selection.check(self.shape)
+        coords = []
+        for d, c in enumerate(self.chunks):
+            runs = selection.runs(d)
+            if len(runs) != 1 or runs[0][0] % c or runs[0][1] != c:
+                return None
+            coords.append(runs[0][0] // c)
+        block = self.index.get(self.chunk_number(coords))
+        if block is None:
+            return None
+        return block.data
+
+    def load_chunks(self, numbers):
+        '''
+        Returns the decoded blocks (None for the chunks never written) of the
+        chunk numbers. They're loaded and decoded by the thread pool.
+        '''
+        return map_chunks(self.index.load, [self.index.entry(n) for n in numbers])
+
+    def encode_chunk(self, chunk):
+        '''
+        Returns the block to store for chunk, encoded by the pipeline if that makes it smaller
+        '''
+        if self.pipeline is not None:
+            data = self.pipeline.encode(chunk)
+            if len(data) < len(chunk):
+                return DataBlockHeader(data, DataBlockHeader.FILTERED)
+        return DataBlockHeader(chunk)
+
+    def read(self, start=None, count=None):
+        '''
+        Returns the count shaped region at start (the whole dataset by default)
+        as a bytearray of elements in row-major order
+        '''
+        start, count = self.check_region(start, count)
+        return self.read_selection(Hyperslab(start, count))
+
+    def read_selection(self, selection, out=None):
+        '''
+        Reads a Hyperslab into out, a writable buffer of at least
+        product(selection.shape()) elements (a new bytearray by default), and
+        returns it. Only the chunks holding selected elements are read and each
+        of them is read once, the selected parts are copied straight to out.
+        '''
+        selection.check(self.shape)
+        out_shape = selection.shape()
+        size = product_of(out_shape) * self.element_size
+        zeros = None
+        if out is None:
+            out = bytearray(size)
+        else:
+            if len(out) < size:
+                raise ValueError('output buffer too small, %d bytes needed' % size)
+            zeros = bytearray(self.chunk_bytes) # Copied for the chunks that were never written
+        if size == 0:
+            return out
+
+        plan = selection.plan(self.chunks)
+        touched = product(*[sorted(pieces) for pieces in plan])
+        while True:
+            batch = list(islice(touched, CHUNK_BATCH))
+            if not batch:
+                break
+            blocks = self.load_chunks([self.chunk_number(coords) for coords in batch])
+            for coords, block in zip(batch, blocks):
+                if block is not None:
+                    data = memoryview(block.data)
+                elif zeros is not None:
+                    data = zeros
+                else:
+                    continue
+                for piece in product(*[pieces[c] for pieces, c in zip(plan, coords)]):
+                    copy_box(data, self.chunks, [p[0] for p in piece],
+                             out, out_shape, [p[2] for p in piece], [p[1] for p in piece], self.element_size)
+        return out
+
+    def write(self, data, start=None, count=None):
+        '''
+        Writes data, the count shaped region's elements in row-major order, at
+        start. Chunks the region covers entirely are replaced, the others are
+        read and patched. The chunks are read and encoded CHUNK_BATCH at a time
+        by the thread pool.
+        '''
+        start, count = self.check_region(start, count)
+        data = memoryview(data)
+        if len(data) != product_of(count) * self.element_size:
+            raise ValueError('expected %d bytes of data' % (product_of(count) * self.element_size))
+        overlapping = self.overlapping(start, count)
+        while True:
+            batch = list(islice(overlapping, CHUNK_BATCH))
+            if not batch:
+                break
+            partial = []
+            for n, chunk_start, lo, box in batch:
+                inside = [min(cs + c, s) - cs for cs, c, s in zip(chunk_start, self.chunks, self.shape)]
+                if list(box) != inside:
+                    partial.append(n)
+            blocks = dict(zip(partial, self.load_chunks(partial)))
+            chunks = []
+            for n, chunk_start, lo, box in batch:
+                block = blocks.get(n)
+                chunk = bytearray(block.data) if block is not None else bytearray(self.chunk_bytes)
+                copy_box(data, count, [l - o for l, o in zip(lo, start)],
+                         chunk, self.chunks, [l - c for l, c in zip(lo, chunk_start)], box, self.element_size)
+                chunks.append(chunk)
+            for (n, _, _, _), block in zip(batch, map_chunks(self.encode_chunk, chunks)):
+                self.index.set(n, block)
+
+    def commit(self):
+        '''
+        Writes the changed chunks and pages and returns the digest of the dataset
+        '''
+        return self.node.commit(self.store)
+
@@ -0,0 +1,238 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file mfs/drivers/posix/pack.py
+@description Pack files for small objects
+'''
+
+from mfs.string_buffer import StringBuffer, writev
+from mfs.types import MFSDigests
+from binascii import hexlify
+from hashlib import sha1
+from struct import unpack_from
+from tempfile import mkstemp
+import os
+
+PACK_SIGNATURE  = 'MPCK'
+INDEX_SIGNATURE = 'MIDX'
+PACK_VERSION    = 0
+
+# Objects are handed to writev in batches of this many
+WRITE_BATCH     = 256
+PADDING         = ['\0' * i for i in xrange(8)]
+
+def align(size):
+    if size % 8 != 0:
+        size += 8 - size % 8
+    return size
+
+class Pack:
+    '''
+    A pack stores many serialized objects back to back in one file so that
+    small objects don't each cost an inode and a seek.
+
+    pack-<name>.pack
+    +-----------------------------------------------------------------------------------+
+    |                               signature ('MPCK')                                  |
+    +-----------------------------------------------------------------------------------+
+    |     version        |    digest          |       res          |       res          |
+    +-----------------------------------------------------------------------------------+
+    |                               count                                               |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+    |                               objects*                                            |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+      * - Each object is padded to the word boundary
+
+    pack-<name>.idx
+    +-----------------------------------------------------------------------------------+
+    |                               signature ('MIDX')                                  |
+    +-----------------------------------------------------------------------------------+
+    |     version        |    digest          |       res          |       res          |
+    +-----------------------------------------------------------------------------------+
+    |                               count                                               |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+    |                               fan-out (256 x uint32)                              |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+    |                               digests (count x digest_size, sorted)*              |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+    |                               entries (count x (offset uint64, length uint64))    |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+      * - Padded to the word boundary
+
+    fan-out[b] is the number of digests whose first byte is <= b, so the digests
+    starting with b are the ones in [fan-out[b-1], fan-out[b]) and a lookup is a
+    binary search over that range alone. Both files are memory mapped, reading an
+    object touches one index entry and the object's own pages. Lookups and reads
+    only use positional reads, threads can share one Pack without locking.
+    '''
+
+    name           = None
+    digest         = None
+    digest_size    = None
+    count          = 0
+    fd             = None
+    mmap_threshold = 64 * 1024
+
+    def __init__(self, path):
+        '''
+        Opens the pack at path (without the .pack/.idx extension)
+        '''
+        self.path = path
+        self.name = os.path.basename(path)[len('pack-'):]
+
+        fd = os.open(path + '.idx', os.O_RDONLY)
+        try:
+            self.index = StringBuffer.from_mmap(fd, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
+        signature, version, self.digest, self.count = self.index.unpack_header('<4sBBxxQ')
+        if signature != INDEX_SIGNATURE or version != PACK_VERSION:
+            raise TypeError('not a pack index')
+        self.digest_size = MFSDigests.sizes[self.digest]
+        self.fan_out = list(unpack_from('<256I', self.index, 16))
+        self.digests_offset = 16 + 256 * 4
+        self.entries_offset = self.digests_offset + align(self.count * self.digest_size)
+
+        self.fd = os.open(path + '.pack', os.O_RDONLY)
+        self.data = StringBuffer.from_mmap(self.fd, os.fstat(self.fd).st_size)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def __del__(self):
+        self.close()
+
+    def digest_at(self, i):
+        return self.index.raw_read_at(self.digests_offset + i * self.digest_size, self.digest_size)
+
+    def find(self, sha):
+        '''
+        Returns the position of sha in the index or -1
+        '''
+        first = ord(sha[0])
+        lo = self.fan_out[first - 1] if first > 0 else 0
+        hi = self.fan_out[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_sha = self.digest_at(mid)
+            if mid_sha < sha:
+                lo = mid + 1
+            elif mid_sha > sha:
+                hi = mid
+            else:
+                return mid
+        return -1
+
+    def __contains__(self, sha):
+        return self.find(sha) >= 0
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self.digest_at(i)
+
+    def entry(self, i):
+        '''
+        Returns the (offset, length) of the ith object in the pack
+        '''
+        return self.index.unpack_header_at('<QQ', self.entries_offset + i * 16)
+
+    def read(self, sha):
+        '''
+        Returns the object stored under sha or None if the pack doesn't hold it
+        '''
+        i = self.find(sha)
+        if i < 0:
+            return None
+        offset, length = self.entry(i)
+        if length >= self.mmap_threshold:
+            return StringBuffer.from_mmap(self.fd, length, offset)
+        sb = StringBuffer(length, zero=False)
+        sb.write(self.data.view_at(offset, length))
+        sb.seek(0)
+        return sb
+
+
+def write_pack(pack_dir, objects, digest):
+    '''
+    Writes the (sha, StringBuffer) pairs in objects to a new pack in pack_dir
+    and returns the path of the pack without its extension, or None if there
+    were no objects. The index is renamed into place last so readers never see
+    a pack without its objects.
+    '''
+    digest_size = MFSDigests.sizes[digest]
+    entries = []
+    fd, data_path = mkstemp(prefix='tmp_', dir=pack_dir)
+    try:
+        try:
+            header = StringBuffer(16)
+            header.pack('<4sBBxxQ', PACK_SIGNATURE, PACK_VERSION, digest, 0)
+            offset = 16
+            batch = [header]
+            for sha, sb in objects:
+                if len(sha) != digest_size:
+                    raise ValueError('expected a %d byte digest' % digest_size)
+                length = sb.buffer_size()
+                batch.append(sb)
+                if length % 8 != 0:
+                    batch.append(PADDING[align(length) - length])
+                entries.append((sha, offset, length))
+                offset += align(length)
+                if len(batch) >= WRITE_BATCH:
+                    writev(fd, batch)
+                    batch = []
+            writev(fd, batch)
+            if not entries:
+                os.unlink(data_path)
+                return None
+            header.seek(0)
+            header.pack('<4sBBxxQ', PACK_SIGNATURE, PACK_VERSION, digest, len(entries))
+            header.pwrite(fd, 0)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        entries.sort()
+        digests_size = align(len(entries) * digest_size)
+        index = StringBuffer(16 + 256 * 4 + digests_size + len(entries) * 16)
+        index.pack('<4sBBxxQ', INDEX_SIGNATURE, PACK_VERSION, digest, len(entries))
+        fan_out = [0] * 256
+        for sha, offset, length in entries:
+            fan_out[ord(sha[0])] += 1
+        total = 0
+        for b in xrange(256):
+            total += fan_out[b]
+            index.write_u32(total)
+        for sha, offset, length in entries:
+            index.write(sha)
+        index.seek(16 + 256 * 4 + digests_size)
+        for sha, offset, length in entries:
+            index.pack('<QQ', offset, length)
+
+        name = hexlify(sha1(''.join(sha for sha, offset, length in entries)).digest())
+        path = os.path.join(pack_dir, 'pack-%s' % name)
+        os.rename(data_path, path + '.pack')
+
+        fd, index_path = mkstemp(prefix='tmp_', dir=pack_dir)
+        try:
+            index.fwrite(fd)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.rename(index_path, path + '.idx')
+        return path
+    except:
+        if os.path.exists(data_path):
+            os.unlink(data_path)
+        raise
+
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file mfs/drivers/posix/store.py
+@description Content addressed object store
+'''
+
+from mfs.string_buffer import StringBuffer
+from mfs.exceptions import ObjectNotFound, MFSException
+from mfs.types import MFSDigests
+from mfs.objects import MFSObjectHeader
+from mfs.node import MerkleNodeHeader
+from mfs.drivers.posix.pack import Pack, write_pack
+from mfs.bloom import BloomFilter, filter_size, buffer_size
+from binascii import hexlify, unhexlify
+from tempfile import mkstemp
+import errno
+import os
+
+class ObjectStore:
+    '''
+    Content addressed object store backed by a POSIX directory
+
+    Every object is stored under the digest of its serialized buffer. The
+    first byte of the digest names a fan-out directory so that no single
+    directory holds more than 1/256th of the objects:
+
+        <path>/objects/ab/cdef0123456789abcdef0123456789abcdef01
+
+    The digest algorithm is chosen when the store is created and recorded in
+    <path>/objects/digest, SHA-1 by default.
+
+    Objects are immutable, writing an object that is already present costs a
+    single stat() and no data is copied.
+
+    Objects at least mmap_threshold bytes long are memory mapped read-only
+    instead of being copied in, so opening a large object is cheap and only
+    the pages that are touched are read.
+
+    repack() folds the loose objects into a pack under <path>/objects/pack,
+    see mfs.drivers.posix.pack. Reads look for a loose object first and then
+    search the packs.
+
+    Every digest in the store is also added to a Bloom filter kept memory
+    mapped in <path>/objects/bloom, so asking for an object the store doesn't
+    have usually costs no system calls at all. Filters can't forget digests,
+    rebuild_filter() starts a fresh one sized for the current objects and
+    retires the old one, stores that still map it switch to the new filter
+    at their next miss or write.
+    '''
+    path           = None
+    packs          = []
+    filter         = None
+    bloom_capacity = 1 << 20
+    bloom_fp_rate  = 0.01
+    digest         = MFSDigests.SHA1
+    digest_size    = 20
+    mmap_threshold = 64 * 1024
+
+    def __init__(self, path, digest=None):
+        self.path = os.path.join(path, 'objects')
+        config_path = os.path.join(self.path, 'digest')
+        if not os.path.isdir(self.path):
+            os.mkdir(self.path)
+            with open(config_path, 'w') as f:
+                f.write(MFSDigests.names[digest or MFSDigests.SHA1] + '\n')
+
+        if os.path.exists(config_path):
+            with open(config_path) as f:
+                name = f.read().strip()
+            digests = dict((v, k) for k, v in MFSDigests.names.iteritems())
+            if name not in digests:
+                raise MFSException('unsupported digest: %s' % name)
+            self.digest = digests[name]
+        if digest is not None and digest != self.digest:
+            raise MFSException('object store uses %s digests' % MFSDigests.names[self.digest])
+        self.digest_size = MFSDigests.sizes[self.digest]
+        self.reload_packs()
+        self.open_filter()
+
+    def open_filter(self):
+        '''
+        Maps the store's Bloom filter, building it if the store doesn't have one yet
+        '''
+        path = os.path.join(self.path, 'bloom')
+        try:
+            fd = os.open(path, os.O_RDWR)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            self.rebuild_filter()
+            return
+        try:
+            sb = StringBuffer.from_mmap(fd, os.fstat(fd).st_size, writable=True)
+        finally:
+            os.close(fd)
+        self.filter = BloomFilter(sb)
+
+    def rebuild_filter(self, capacity=None):
+        '''
+        Replaces the Bloom filter with one holding every object currently in the
+        store and sized for at least capacity objects (twice the current number
+        of objects by default)
+        '''
+        shas = list(self.objects())
+        capacity = max(capacity or 0, self.bloom_capacity, 2 * len(shas))
+        bits, hashes = filter_size(capacity, self.bloom_fp_rate)
+        size = buffer_size(bits)
+
+        fd, tmp_path = mkstemp(prefix='tmp_', dir=self.path)
+        try:
+            try:
+                os.ftruncate(fd, size) # Sparse and zero filled
+                sb = StringBuffer.from_mmap(fd, size, writable=True)
+            finally:
+                os.close(fd)
+            bloom = BloomFilter.create(sb, bits, hashes)
+            for sha in shas:
+                bloom.add(sha)
+            sb.sync()
+            os.rename(tmp_path, os.path.join(self.path, 'bloom'))
+        except:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        if self.filter is not None:
+            self.filter.retire()
+        self.filter = bloom
+
+        # Writers add to the old filter until they see it retired, their
+        # objects are in place by then and are listed by a second pass
+        self.reload_packs()
+        for sha in self.objects():
+            bloom.add(sha)
+
+    def may_exist(self, sha):
+        '''
+        False if sha is certainly not in the store, see the Bloom filter
+        '''
+        if sha in self.filter:
+            return True
+        if not self.filter.retired:
+            return False
+        self.open_filter()
+        return sha in self.filter
+
+    def reload_packs(self):
+        '''
+        Opens the packs in the pack directory, packs that are already open are
+        kept. Returns True if the set of packs changed.
+        '''
+        pack_dir = os.path.join(self.path, 'pack')
+        names = []
+        if os.path.isdir(pack_dir):
+            for filename in sorted(os.listdir(pack_dir)):
+                if filename.startswith('pack-') and filename.endswith('.idx'):
+                    names.append(filename[len('pack-'):-len('.idx')])
+        if names == [pack.name for pack in self.packs]:
+            return False
+
+        packs = dict((pack.name, pack) for pack in self.packs)
+        self.packs = []
+        for name in names:
+            if name in packs:
+                self.packs.append(packs[name])
+            else:
+                self.packs.append(Pack(os.path.join(pack_dir, 'pack-%s' % name)))
+        return True
+
+    def object_path(self, sha):
+        '''
+        Returns the path of the loose object file for sha
+        '''
+        hex_sha = hexlify(sha)
+        return os.path.join(self.path, hex_sha[:2], hex_sha[2:])
+
+    def exists(self, sha):
+        if not self.may_exist(sha):
+            return False
+        if os.path.exists(self.object_path(sha)):
+            return True
+        return self.find_pack(sha) is not None
+
+    def find_pack(self, sha):
+        '''
+        Returns the pack holding sha or None. The pack directory is rescanned
+        before giving up since another process may have repacked the store.
+        '''
+        for pack in self.packs:
+            if sha in pack:
+                return pack
+        if self.reload_packs():
+            for pack in self.packs:
+                if sha in pack:
+                    return pack
+        return None
+
+    def loose_objects(self):
+        '''
+        Yields the digest of every loose object
+        '''
+        for fan_out in sorted(os.listdir(self.path)):
+            if len(fan_out) != 2:
+                continue # The digest config and the pack directory
+            for filename in sorted(os.listdir(os.path.join(self.path, fan_out))):
+                if filename.startswith('tmp_'):
+                    continue
+                yield unhexlify(fan_out + filename)
+
+    def objects(self):
+        '''
+        Yields the digest of every object, loose or packed
+        '''
+        for sha in self.loose_objects():
+            yield sha
+        for pack in self.packs:
+            for sha in pack:
+                yield sha
+
+    def write(self, string_buffer):
+        '''
+        Writes the buffer to the store if it isn't already present and returns
+        the digest the object is stored under
+
+        While a GarbageCollector runs every digest written is appended to its
+        journal, before the existence check so an object that is reused is
+        recorded before the collector could delete it, and again once a new
+        object is in place. The collector keeps what the journal lists and
+        everything it references.
+        '''
+        sha = string_buffer.hash(digest=self.digest).raw_read(self.digest_size)
+        path = self.object_path(sha)
+        collecting = self.log_write(sha)
+        if self.exists(sha):
+            return sha
+
+        fan_out = os.path.dirname(path)
+        try:
+            os.mkdir(fan_out)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Write to a temporary file and rename it into place so readers never
+        # see a partial object
+        fd, tmp_path = mkstemp(prefix='tmp_', dir=fan_out)
+        try:
+            try:
+                string_buffer.fwrite(fd)
+            finally:
+                os.close(fd)
+            os.rename(tmp_path, path)
+        except:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+        self.filter.add(sha)
+        while self.filter.retired:
+            self.open_filter()
+            self.filter.add(sha)
+        if collecting:
+            self.log_write(sha)
+        return sha
+
+    def log_write(self, sha):
+        '''
+        Appends sha to the journal of a running GarbageCollector, returns False
+        if no collection is running
+        '''
+        try:
+            fd = os.open(self.journal_path(), os.O_WRONLY | os.O_APPEND)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        try:
+            os.write(fd, sha) # Appends of a digest are atomic
+        finally:
+            os.close(fd)
+        return True
+
+    def journal_path(self):
+        '''
+        Path of the journal a GarbageCollector keeps while it runs
+        '''
+        return os.path.join(self.path, 'gc-journal')
+
+    def read(self, sha):
+        '''
+        Returns a StringBuffer containing the serialized object
+        '''
+        try:
+            fd = os.open(self.object_path(sha), os.O_RDONLY)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            pack = self.find_pack(sha)
+            if pack is not None:
+                return pack.read(sha)
+            raise ObjectNotFound('object %s not found' % hexlify(sha))
+        try:
+            size = os.fstat(fd).st_size
+            if size >= self.mmap_threshold:
+                return StringBuffer.from_mmap(fd, size)
+            return StringBuffer.from_file(fd, size)
+        finally:
+            os.close(fd)
+
+    def load(self, sha):
+        '''
+        Reads the object stored under sha and returns the decoded header
+        '''
+        sb = self.read(sha)
+        header = MFSObjectHeader.deserialize(sb)
+        header.deserialize_body(sb)
+        if isinstance(header, MerkleNodeHeader):
+            header.sha = sha
+        return header
+
+    def repack(self):
+        '''
+        Moves every loose object into a new pack and returns the pack, or None
+        if there were no loose objects
+        '''
+        pack_dir = os.path.join(self.path, 'pack')
+        try:
+            os.mkdir(pack_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        shas = list(self.loose_objects())
+        objects = ((sha, self.read(sha)) for sha in shas)
+        pack_path = write_pack(pack_dir, objects, self.digest)
+        if pack_path is None:
+            return None
+        self.reload_packs()
+
+        # The objects are reachable through the pack now
+        for sha in shas:
+            path = self.object_path(sha)
+            os.unlink(path)
+            try:
+                os.rmdir(os.path.dirname(path))
+            except OSError as e:
+                if e.errno != errno.ENOTEMPTY:
+                    raise
+
+        if self.filter.false_positive_rate() > self.bloom_fp_rate:
+            self.rebuild_filter()
+        name = os.path.basename(pack_path)[len('pack-'):]
+        for pack in self.packs:
+            if pack.name == name:
+                return pack
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) != 3 or sys.argv[1] != 'repack':
+        sys.stderr.write('usage: %s repack <path>\n' % sys.argv[0])
+        sys.exit(1)
+    pack = ObjectStore(sys.argv[2]).repack()
+    if pack is not None:
+        print 'packed %d objects into pack-%s' % (len(pack), pack.name)
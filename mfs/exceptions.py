@@ -9,3 +9,6 @@ class MFSException(Exception):
 class SerializationError(MFSException):
     pass
 
+
+class ObjectNotFound(MFSException):
+    pass
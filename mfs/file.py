@@ -5,7 +5,8 @@
 @description Merkle File
 '''
 
-from mfs.objects import MFSObjectHeader
+from mfs.drivers.posix.store import ObjectStore
+from mfs.diff import diff
 import os
 
 class MerkleFile:
@@ -14,17 +15,39 @@ class MerkleFile:
     '''
     path = None
     merkle_object_header = None
-    def __init__(self, path, merkle_object_header):
+    store = None
+    def __init__(self, path, merkle_object_header=None, digest=None):
         if not os.path.isdir(path):
             raise IOError('bad path: not a directory')
         self.path = path
         self.merkle_object_header = merkle_object_header
+        self.store = ObjectStore(path, digest)
 
     def write(self):
+        '''
+        Writes the object to the object store and returns its digest
+        '''
         sb = self.merkle_object_header.serialize()
-        #digest 
-
-
+        return self.store.write(sb)
+
+    def read(self, sha):
+        '''
+        Loads the object stored under sha and returns the decoded header
+        '''
+        return self.store.load(sha)
+
+    def commit(self):
+        '''
+        Writes the parts of the node tree that changed since the last commit and
+        returns the digest of the root
+        '''
+        return self.merkle_object_header.commit(self.store)
+
+    def diff(self, old_sha, new_sha):
+        '''
+        Yields a MerkleChange for each path that differs between two versions, see mfs.diff
+        '''
+        return diff(self.store, old_sha, new_sha)
 
     def __enter__(self):
         pass
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file mfs/filters.py
+@description Filter pipelines, compression of dataset chunks
+'''
+
+from mfs.objects import MFSObject, MFSObjectHeader
+from mfs.types import MFSTypes
+from mfs.shuffle import shuffle, unshuffle, delta_encode, delta_decode
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from threading import Lock
+import zlib
+import bz2
+
+try:
+    import lzma # Python 3 or backports.lzma installed as lzma
+except ImportError:
+    lzma = None
+
+class Filters:
+    SHUFFLE = 0x01
+    DELTA   = 0x02
+    ZLIB    = 0x10
+    BZ2     = 0x11
+    LZMA    = 0x12
+
+    names = {
+        SHUFFLE : 'shuffle',
+        DELTA   : 'delta',
+        ZLIB    : 'zlib',
+        BZ2     : 'bz2',
+        LZMA    : 'lzma',
+    }
+
+def readable(data):
+    # zlib, bz2 and lzma only take strings and old style buffers
+    if isinstance(data, memoryview):
+        return data.tobytes()
+    if isinstance(data, bytearray):
+        return buffer(data)
+    return data
+
+# (encode, decode) for each filter, both called with the data and the filter's param
+codecs = {
+    Filters.SHUFFLE : (shuffle, unshuffle),
+    Filters.DELTA   : (delta_encode, delta_decode),
+    Filters.ZLIB    : (lambda data, level: zlib.compress(readable(data), level),
+                       lambda data, level: zlib.decompress(readable(data))),
+    Filters.BZ2     : (lambda data, level: bz2.compress(readable(data), level),
+                       lambda data, level: bz2.decompress(readable(data))),
+}
+if lzma is not None:
+    codecs[Filters.LZMA] = (lambda data, preset: lzma.compress(readable(data), preset=preset),
+                            lambda data, preset: lzma.decompress(readable(data)))
+
+
+class FilterPipelineHeader(MFSObjectHeader):
+    '''
+    +-----------------------------------------------------------------------------------+
+    |     mfs_type       |    ver             |       filters      |       res          |
+    +-----------------------------------------------------------------------------------+
+    |                                  res                                              |
+    +-----------------------------------------------------------------------------------+
+    |                               total_size                                          |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+    |                               filter*                                             |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+      * - filters entries, applied in order when encoding and in reverse when decoding
+
+    mfs_type   - MFSObject Type
+    ver        - pipeline version (currently 0)
+    filters    - number of filters
+    total_size - size in bytes of the filter entries
+
+    A dataset's chunks are run through its pipeline before they're written,
+    typically pre-filters (shuffle, delta) that make numeric data easier to
+    compress followed by one codec. Chunks the pipeline doesn't shrink are
+    stored as they are, see DataBlockHeader.FILTERED.
+    '''
+    mfs_type   = MFSTypes.FilterPipeline
+    ver        = 0
+    total_size = 0
+    filters    = None
+
+    def __init__(self, filters=()):
+        self.filters = list(filters)
+        if len(self.filters) > 0xff:
+            raise ValueError('too many filters')
+        self.total_size = 8 * len(self.filters)
+
+    def serialize_into(self, string_buffer):
+        sb = string_buffer
+        sb.pack('<BBBxIQ', self.mfs_type, self.ver, len(self.filters), 0, self.total_size)
+        for f in self.filters:
+            f.serialize_into(sb)
+
+    @classmethod
+    def deserialize(cls, string_buffer):
+        mfs_type, ver, filters, total_size = string_buffer.unpack_header('<BBBxxxxxQ')
+        if mfs_type != cls.mfs_type:
+            raise TypeError('object is not a filter pipeline')
+        if ver != cls.ver:
+            raise TypeError('unsupported filter pipeline version')
+        inst = cls([None] * filters)
+        inst.total_size = total_size
+        return inst
+
+    def deserialize_body(self, string_buffer):
+        for i in xrange(len(self.filters)):
+            self.filters[i] = Filter.deserialize(string_buffer)
+
+    def key(self):
+        '''
+        Identifies the pipeline, chunks decoded by equal pipelines are equal
+        '''
+        return tuple((f.filter_id, f.param) for f in self.filters)
+
+    def encode(self, data):
+        for f in self.filters:
+            data = f.encode(data)
+        return data
+
+    def decode(self, data):
+        for f in reversed(self.filters):
+            data = f.decode(data)
+        return data
+
+    def __len__(self):
+        return 16 + self.total_size
+
+
+class Filter(MFSObject):
+    '''
+    +-----------------------------------------------------------------------------------+
+    |     filter_id      |    flags           |              res                        |
+    +-----------------------------------------------------------------------------------+
+    |                                  param                                            |
+    +-----------------------------------------------------------------------------------+
+
+    filter_id - one of Filters
+    flags     - filter flags (currently 0)
+    param     - element size for shuffle and delta, compression level for the codecs
+    '''
+    filter_id = None
+    flags     = 0
+    param     = 0
+
+    def __init__(self, filter_id, param=0, flags=0):
+        self.filter_id = filter_id
+        self.param = param
+        self.flags = flags
+
+    def serialized_size(self):
+        return 8
+
+    def serialize_into(self, string_buffer):
+        string_buffer.pack('<BBxxI', self.filter_id, self.flags, self.param)
+
+    @classmethod
+    def deserialize(cls, string_buffer):
+        filter_id, flags, param = string_buffer.unpack_header('<BBxxI')
+        return cls(filter_id, param, flags)
+
+    def codec(self):
+        if self.filter_id not in codecs:
+            raise TypeError('filter %s is not available' % Filters.names.get(self.filter_id, hex(self.filter_id)))
+        return codecs[self.filter_id]
+
+    def encode(self, data):
+        return self.codec()[0](data, self.param)
+
+    def decode(self, data):
+        return self.codec()[1](data, self.param)
+
+    def __len__(self):
+        return 8
+
+class ShuffleFilter(Filter):
+    def __init__(self, element_size):
+        Filter.__init__(self, Filters.SHUFFLE, element_size)
+
+class DeltaFilter(Filter):
+    def __init__(self, element_size):
+        Filter.__init__(self, Filters.DELTA, element_size)
+
+class ZlibFilter(Filter):
+    def __init__(self, level=6):
+        Filter.__init__(self, Filters.ZLIB, level)
+
+class BZ2Filter(Filter):
+    def __init__(self, level=9):
+        Filter.__init__(self, Filters.BZ2, level)
+
+class LZMAFilter(Filter):
+    def __init__(self, preset=6):
+        Filter.__init__(self, Filters.LZMA, preset)
+
+
+# Chunks are encoded and decoded by a pool of threads, one per CPU. zlib, bz2
+# and the pre-filters release the GIL so the threads run in parallel. The
+# pool is created the first time it's needed and shared by every dataset.
+
+pool = None
+pool_lock = Lock()
+
+def map_chunks(func, items):
+    '''
+    Returns [func(item) for item in items], computed by the shared thread pool
+    when there's more than one item. func must not call map_chunks itself.
+    '''
+    global pool
+    items = list(items)
+    if len(items) < 2 or cpu_count() < 2:
+        return [func(item) for item in items]
+    with pool_lock:
+        if pool is None:
+            pool = ThreadPool(cpu_count())
+    return pool.map(func, items)
+
@@ -0,0 +1,241 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file mfs/hamt.py
+@description Hash array mapped trie of Merkle nodes
+'''
+
+from mfs.node import MerkleNode, MerkleNodeHeader
+from mfs.types import MFSTypes
+
+class MerkleTrie:
+    '''
+    A set of MerkleNode children keyed by their digests and spread over a tree
+    of small MerkleNodeHeaders, for groups too large for a single node.
+
+    Leaves hold up to leaf_capacity children sorted by digest. A leaf that
+    outgrows it becomes a branch (flag BRANCH) whose children are leaves
+    keyed by the next byte of the digest:
+
+        depth 0                 depth 1                  depth 2
+        branch ------+-- mode 0x00 --> leaf
+                     +-- mode 0x3f --> branch ---+-- mode 0x10 --> leaf
+                     |                           +-- mode 0xc2 --> leaf
+                     +-- mode 0xf1 --> leaf
+
+    A branch entry's mode is the digest byte it covers and its flags the number
+    of children below it (saturating at 0xffff). Branches whose subtree shrinks
+    back to leaf_capacity are folded into a leaf again, so the same set of
+    children always produces the same tree and the same root digest.
+
+    Adding, removing or finding a child reads and rewrites one node per level.
+    The nodes are ordinary MerkleNodeHeaders, commit() writes only the path
+    that changed.
+    '''
+    leaf_capacity = 64
+    store = None
+    root  = None
+
+    def __init__(self, store, root=None, leaf_capacity=64):
+        '''
+        root can be a loaded MerkleNodeHeader or its digest, None starts an empty set
+        '''
+        self.store = store
+        self.leaf_capacity = leaf_capacity
+        if root is None:
+            root = self.new_leaf()
+        elif isinstance(root, basestring):
+            root = store.load(root)
+        self.root = root
+
+    def new_leaf(self):
+        leaf = MerkleNodeHeader(self.store.digest)
+        leaf.flags = MerkleNodeHeader.SORTED
+        return leaf
+
+    def is_branch(self, node):
+        return bool(node.flags & MerkleNodeHeader.BRANCH)
+
+    def count(self, node):
+        '''
+        Number of children below node, saturating at 0xffff
+        '''
+        if not self.is_branch(node):
+            return node.children
+        return min(sum(o.flags for o in node.objects), 0xffff)
+
+    def find_bucket(self, node, bucket):
+        '''
+        Returns the index of the branch entry for bucket or, if there is none,
+        -1 - the index it would be inserted at
+        '''
+        lo, hi = 0, node.children
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mode = node.objects[mid].mode
+            if mode < bucket:
+                lo = mid + 1
+            elif mode > bucket:
+                hi = mid
+            else:
+                return mid
+        return -1 - lo
+
+    def find_position(self, leaf, sha):
+        lo, hi = 0, leaf.children
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if leaf.objects[mid].sha < sha:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, sha):
+        '''
+        Returns the child with digest sha or None, nothing is cached or decoded
+        beyond the nodes on the path
+        '''
+        node = self.root
+        depth = 0
+        while self.is_branch(node):
+            i = self.find_bucket(node, ord(sha[depth]))
+            if i < 0:
+                return None
+            entry = node.objects[i]
+            node = entry.obj if entry.obj is not None else self.store.load(entry.sha)
+            depth += 1
+        i = node.find_child(sha)
+        return node.objects[i] if i >= 0 else None
+
+    def __contains__(self, sha):
+        return self.get(sha) is not None
+
+    def __iter__(self):
+        '''
+        Yields every child in digest order
+        '''
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            if self.is_branch(node):
+                for i in xrange(node.children - 1, -1, -1):
+                    entry = node.objects[i]
+                    stack.append(entry.obj if entry.obj is not None else self.store.load(entry.sha))
+            else:
+                for o in node.objects:
+                    yield o
+
+    def add(self, merkle_node):
+        '''
+        Adds a child, returns False if a child with the same digest is already
+        present. Only the child's digest is kept, its obj (if any) must already
+        be in the store.
+        '''
+        sha = merkle_node.sha
+        if sha is None:
+            raise ValueError('trie children need a digest')
+        path = []
+        node = self.root
+        depth = 0
+        while self.is_branch(node):
+            bucket = ord(sha[depth])
+            i = self.find_bucket(node, bucket)
+            if i < 0:
+                i = -1 - i
+                node.insert_child(i, MerkleNode(MFSTypes.MerkleNode, bucket, 0, None, self.new_leaf()))
+            path.append((node, i))
+            node = node.load_child(i, self.store)
+            depth += 1
+
+        i = self.find_position(node, sha)
+        if i < node.children and node.objects[i].sha == sha:
+            return False
+        node.insert_child(i, self.entry(merkle_node))
+        for parent, index in path:
+            entry = parent.objects[index]
+            if entry.flags < 0xffff:
+                entry.flags += 1
+        if node.children > self.leaf_capacity and depth < len(sha):
+            self.split(node, depth)
+        return True
+
+    def split(self, node, depth):
+        '''
+        Turns an overfull leaf at depth into a branch
+        '''
+        members = list(node.objects)
+        node.clear_children()
+        node.flags = MerkleNodeHeader.BRANCH
+        start = 0
+        while start < len(members):
+            bucket = members[start].sha[depth]
+            end = start
+            while end < len(members) and members[end].sha[depth] == bucket:
+                end += 1
+            leaf = self.new_leaf()
+            for merkle_node in members[start:end]:
+                leaf.add_child(self.entry(merkle_node))
+            node.add_child(MerkleNode(MFSTypes.MerkleNode, ord(bucket), min(end - start, 0xffff), None, leaf))
+            if leaf.children > self.leaf_capacity and depth + 1 < len(members[start].sha):
+                self.split(leaf, depth + 1)
+            start = end
+
+    def remove(self, sha):
+        '''
+        Removes the child with digest sha, returns False if there is none
+        '''
+        path = []
+        node = self.root
+        depth = 0
+        while self.is_branch(node):
+            i = self.find_bucket(node, ord(sha[depth]))
+            if i < 0:
+                return False
+            path.append((node, i))
+            node = node.load_child(i, self.store)
+            depth += 1
+
+        i = self.find_position(node, sha)
+        if i >= node.children or node.objects[i].sha != sha:
+            return False
+        node.remove_child(i)
+
+        # Fix up the counts from the bottom, dropping empty leaves and folding
+        # branches that got small enough
+        for parent, index in reversed(path):
+            entry = parent.objects[index]
+            child = entry.obj
+            if child.children == 0:
+                parent.remove_child(index)
+            elif entry.flags < 0xffff:
+                entry.flags -= 1
+            else:
+                entry.flags = self.count(child)
+            if self.count(parent) <= self.leaf_capacity:
+                self.collapse(parent)
+        return True
+
+    def collapse(self, node):
+        '''
+        Turns a branch whose children are all leaves back into a leaf
+        '''
+        members = []
+        for i in xrange(node.children):
+            leaf = node.load_child(i, self.store)
+            members.extend(leaf.objects)
+        node.clear_children()
+        node.flags = MerkleNodeHeader.SORTED
+        for merkle_node in members:
+            node.add_child(self.entry(merkle_node))
+
+    def entry(self, merkle_node):
+        # A digest only copy, a child with an obj would clear the leaf's SORTED flag
+        return MerkleNode(merkle_node.mfs_type, merkle_node.mode, merkle_node.flags, merkle_node.sha)
+
+    def commit(self):
+        '''
+        Writes the changed nodes and returns the digest of the root
+        '''
+        return self.root.commit(self.store)
+
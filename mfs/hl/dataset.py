@@ -5,23 +5,118 @@
 @description High Level Dataset Definition
 '''
 
-from mfs.util.decor import not_implemented
+from mfs.drivers.posix.dataset import Dataset
+from mfs.datatype import DatatypeHeader
+from mfs.selection import Hyperslab
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def as_tuple(value):
+    if value is None or isinstance(value, tuple):
+        return value
+    if isinstance(value, (int, long)):
+        return (value,)
+    return tuple(value)
 
 class MFSDataset:
+    '''
+    A chunked n-dimensional dataset in an object store, see
+    mfs.drivers.posix.dataset.Dataset. Regions are given as a start and a
+    count per dimension (plain integers for one dimensional datasets), reads
+    also take a stride and a block, and the data is the region's elements in
+    row-major order.
+
+    With numpy installed read_array() returns selections as ndarrays and
+    set() takes ndarrays, converted to the dataset's little-endian dtype.
+    '''
+    dataset = None
+    shape   = None
+    chunks  = None
+    dtype   = None
 
-    @not_implemented
-    def __init__(self, *args, **kwargs):
-        pass
+    def __init__(self, store, shape=None, datatype=None, chunks=None, sha=None, cache=None, filters=None):
+        '''
+        Opens the dataset committed under sha, or creates one of shape holding
+        datatype (a DatatypeHeader or a numpy dtype) elements, compressed by filters (a list of
+        mfs.filters Filters) if given. Chunks are cached in cache, a
+        ChunkCache, or the shared one.
+        '''
+        if sha is not None:
+            self.dataset = Dataset(store, sha, cache=cache)
+        else:
+            if datatype is not None and not isinstance(datatype, DatatypeHeader):
+                datatype = DatatypeHeader.from_numpy(datatype)
+            self.dataset = Dataset(store, shape=as_tuple(shape), datatype=datatype, chunks=as_tuple(chunks),
+                                   cache=cache, filters=filters)
+        self.shape = self.dataset.shape
+        self.chunks = self.dataset.chunks
+        self.dtype = self.dataset.datatype
 
-    @not_implemented
-    def get(self, *args, **kwargs):
-        pass
+    def get(self, start=None, count=None, stride=None, block=None, out=None):
+        '''
+        Returns the hyperslab selection as a bytearray (or in out, a writable
+        buffer), see mfs.selection.Hyperslab. Without a count as many blocks
+        as fit are selected, without any arguments the whole dataset. The
+        stride defaults to the block, so the blocks are adjacent.
+        '''
+        return self.dataset.read_selection(self.selection(start, count, stride, block), out)
 
-    @not_implemented
-    def set(self, *args, **kwargs):
-        pass
+    def read_array(self, start=None, count=None, stride=None, block=None):
+        '''
+        Returns the selection, like get(), as an ndarray of the selection's
+        shape. A selection that is exactly one stored chunk is a read-only view
+        of the chunk's buffer, nothing is copied.
+        '''
+        dtype = self.dtype.numpy_dtype()
+        selection = self.selection(start, count, stride, block)
+        data = self.dataset.chunk_data(selection)
+        if data is None:
+            return np.frombuffer(self.dataset.read_selection(selection), dtype).reshape(selection.shape())
+        array = np.asarray(memoryview(data)).view(dtype).reshape(selection.shape())
+        array.flags.writeable = False # The chunk may be cached or mapped from the store
+        return array
 
+    def selection(self, start, count, stride, block):
+        start, count, stride, block = [as_tuple(v) for v in (start, count, stride, block)]
+        if stride is None and block is not None:
+            stride = block # Blocks next to each other
+        dims = len(self.shape)
+        if start is None:
+            start = (0,) * dims
+        if count is None:
+            steps = stride or (1,) * dims
+            sizes = block or (1,) * dims
+            count = tuple(max(0, (s - o - b) // t + 1) for s, o, b, t in zip(self.shape, start, sizes, steps))
+        return Hyperslab(start, count, stride, block)
 
+    def __getitem__(self, key):
+        '''
+        dataset[5, 10:20, ::2], integers and slices with positive steps, see Hyperslab.from_slices
+        '''
+        return self.dataset.read_selection(Hyperslab.from_slices(self.shape, key))
 
+    def set(self, data, start=None, count=None):
+        '''
+        Writes data to the region, the whole dataset by default. An ndarray is
+        written to a region of its shape unless count is given, its elements
+        are converted to the dataset's dtype (same kind casts only) and
+        byte-swapped when they aren't little-endian.
+        '''
+        start, count = as_tuple(start), as_tuple(count)
+        if np is not None and isinstance(data, np.ndarray):
+            dtype = self.dtype.numpy_dtype()
+            if count is None and data.ndim == len(self.shape):
+                count = data.shape
+            data = np.ascontiguousarray(data.astype(dtype, casting='same_kind', copy=False))
+            data = data.reshape(-1).view(np.uint8)
+        self.dataset.write(data, start, count)
 
+    def commit(self):
+        '''
+        Writes the changes to the store and returns the digest of the dataset
+        '''
+        return self.dataset.commit()
 
@@ -6,8 +6,17 @@
 '''
 
 from mfs.objects import MFSObject, MFSObjectHeader
-from mfs.string_buffer import StringBuffer
-from mfs.types import MFSTypes
+from mfs.types import MFSTypes, MFSDigests
+from mfs.exceptions import BufferOverflow, MFSException
+
+def entry_size(digest_size):
+    '''
+    Returns the size in bytes of a serialized MerkleNode holding a digest of digest_size bytes
+    '''
+    size = 4 + digest_size
+    if size % 8 != 0:
+        size += 8 - size % 8
+    return size
 
 class MerkleNodeHeader(MFSObjectHeader):
     '''
@@ -19,70 +28,414 @@ class MerkleNodeHeader(MFSObjectHeader):
     |                               total_size                                          |
     |                                                                                   |
     +-----------------------------------------------------------------------------------+
+    |     digest         |    flags           |       res          |       res          |
+    +-----------------------------------------------------------------------------------+
+    |                                  res                                              |
+    +-----------------------------------------------------------------------------------+
 
     mfs_type   - MFS Object Type (0x02 in this case)
-    version    - Node version number, currently 0
+    version    - Node version number, currently 1
     children   - number of children that the node contains
     total_size - total size in bytes of the node
+    digest     - MFSDigests algorithm of the children's digests (version 1 only)
+    flags      - node flags (version 1 only), SORTED if the children are
+                 ordered by digest, BRANCH on the internal nodes of a MerkleTrie
+
+    The digest word is the first word of the node body and is counted in
+    total_size. Version 0 nodes have no digest word and always hold SHA-1 digests.
+    Each child is a MerkleNode padded to entry_size(digest_size) bytes.
+
+    Nodes held in memory track which of their children changed since they were
+    last committed. Changing a child marks every node on the path up to the root
+    dirty and commit() only reserializes and rehashes those nodes.
+
+    Deserialized nodes don't decode their children, objects is a MerkleChildren
+    view over the serialized buffer until the node is modified.
     '''
-    signature  = '.MFS'
-    version    = 0
-    total_size = 0
-    objects    = []
-    children   = 0
-    mfs_type   = MFSTypes.MerkleNode
-
-    def __init__(self):
-        self.total_size = 0
+    SORTED      = 0x01
+    BRANCH      = 0x02
+
+    signature   = '.MFS'
+    version     = 1
+    total_size  = 8
+    objects     = []
+    children    = 0
+    mfs_type    = MFSTypes.MerkleNode
+    digest      = MFSDigests.SHA1
+    digest_size = 20
+    flags       = 0
+
+    sha            = None  # Digest the node was last loaded or committed under
+    dirty          = True
+    dirty_children = None  # Indexes of children whose objects need committing
+    loaded         = None  # index -> object loaded by load_child() while the children aren't materialized
+    parent         = None
+    parent_index   = None
+
+    def __init__(self, digest=MFSDigests.SHA1, version=1):
+        self.version = version
+        self.digest = digest
+        self.digest_size = MFSDigests.sizes[digest]
+        self.total_size = 8 if version > 0 else 0
         self.objects = []
         self.children = 0
+        self.flags = 0
+        self.dirty = True
+        self.dirty_children = set()
+        self.loaded = {}
 
-    def serialize(self):
-        sb = StringBuffer(16 + self.total_size)
-        sb.pack('<BBH', self.mfs_type, self.version, self.children)
-        sb.write(self.signature)
-        sb.pack('<Q', self.total_size)
+    def serialize_into(self, string_buffer):
+        sb = string_buffer
+        sb.pack('<BBH4sQ', self.mfs_type, self.version, self.children, self.signature, self.total_size)
+        if self.version > 0:
+            sb.pack('<BBxxxxxx', self.digest, self.flags)
+        if isinstance(self.objects, MerkleChildren):
+            sb.write(self.objects.raw()) # Unchanged since it was read
+            return
         for o in self.objects:
-            sb.write(o.serialize())
-        return sb
+            o.serialize_into(sb)
 
     @classmethod
     def deserialize(cls, string_buffer):
-        sb = string_buffer
-        mfs_type = sb.read_uint(1)
+        mfs_type, version, children, signature, total_size = string_buffer.unpack_header('<BBH4sQ')
         if mfs_type != cls.mfs_type:
             raise TypeError('not a node header')
-        version = sb.read_uint(1)
-        if version != cls.version:
+        if version > cls.version:
             raise TypeError('version mismatch')
-        children = sb.read_uint(2)
-        signature = sb.raw_read(4)
         if signature != cls.signature:
             raise TypeError('signature mismatch')
 
-        total_size = sb.read_uint(8)
-
-        inst = cls()
+        inst = cls(version=version)
         inst.total_size = total_size
         inst.children = children
+        inst.dirty = False
         return inst
 
     def deserialize_children(self, string_buffer):
         sb = string_buffer
-        for i in xrange(self.children):
-            o = MerkleNode.deserialize(sb)
-            self.objects.append(o)
+        if self.version > 0:
+            self.digest, self.flags = sb.unpack_header('<BBxxxxxx')
+            if self.digest not in MFSDigests.sizes:
+                raise TypeError('unsupported digest')
+            self.digest_size = MFSDigests.sizes[self.digest]
+        offset = sb.offset()
+        end = offset + self.children * entry_size(self.digest_size)
+        if end > sb.buffer_size():
+            raise BufferOverflow('Offset exceeds buffer size')
+        self.objects = MerkleChildren(sb, offset, self.children, self.digest_size,
+                                      self.flags & self.SORTED)
+        sb.seek(end)
+
+    def deserialize_body(self, string_buffer):
+        self.deserialize_children(string_buffer)
+
+    def materialize(self):
+        '''
+        Decodes the children so they can be modified, the objects loaded so far
+        are attached to their entries
+        '''
+        if isinstance(self.objects, MerkleChildren):
+            self.objects = list(self.objects)
+            for index, obj in self.loaded.iteritems():
+                self.objects[index].obj = obj
+            self.loaded = {}
+
+    def find_child(self, sha):
+        '''
+        Returns the index of the child with digest sha or -1, a binary search
+        if the children are sorted
+        '''
+        if isinstance(self.objects, MerkleChildren):
+            return self.objects.find(sha)
+        if self.flags & self.SORTED:
+            lo, hi = 0, len(self.objects)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.objects[mid].sha < sha:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < len(self.objects) and self.objects[lo].sha == sha:
+                return lo
+            return -1
+        for i, o in enumerate(self.objects):
+            if o.sha == sha:
+                return i
+        return -1
+
+    def sort_children(self):
+        '''
+        Orders the children by digest so find_child() can binary search them.
+        Children are looked up by index elsewhere, sort before handing out indexes.
+        '''
+        if self.dirty_children:
+            raise ValueError('commit the children before sorting them')
+        self.materialize()
+        self.objects.sort(key=lambda o: o.sha)
+        for i, o in enumerate(self.objects):
+            if isinstance(o.obj, MerkleNodeHeader):
+                o.obj.parent_index = i
+        self.dirty_children = set()
+        self.flags |= self.SORTED
+        self.mark_dirty()
 
     def add_child(self, merkle_node):
-        self.total_size += len(merkle_node)
+        '''
+        Appends a child. The child's sha can be left as None when its obj is set,
+        it's filled in when the node is committed.
+        '''
+        self.insert_child(self.children, merkle_node)
+
+    def insert_child(self, index, merkle_node):
+        '''
+        Inserts a child before index, the children after it move up by one
+        '''
+        self.materialize()
+        if self.children >= 0xffff:
+            raise ValueError('node is full') # children is a uint16
+        if merkle_node.sha is None:
+            if merkle_node.obj is None:
+                raise ValueError('child has neither a digest nor an object')
+        elif len(merkle_node.sha) != self.digest_size:
+            raise ValueError('expected a %d byte digest' % self.digest_size)
+        if self.flags & self.SORTED:
+            sha = merkle_node.sha
+            if sha is None or (index > 0 and sha < self.objects[index - 1].sha) or \
+                    (index < self.children and sha > self.objects[index].sha):
+                self.flags &= ~self.SORTED
+        self.total_size += entry_size(self.digest_size)
         self.children += 1 
-        self.objects.append(merkle_node)
+        self.objects.insert(index, merkle_node)
+        self.renumber(index, 1)
+        if merkle_node.obj is not None:
+            self.set_child(index, merkle_node.obj)
+        else:
+            self.mark_dirty()
+
+    def remove_child(self, index):
+        '''
+        Removes child index, unlike delete_child() the children after it move
+        down by one
+        '''
+        self.materialize()
+        merkle_node = self.objects.pop(index)
+        self.total_size -= entry_size(self.digest_size)
+        self.children -= 1
+        self.dirty_children.discard(index)
+        self.renumber(index, -1)
+        if isinstance(merkle_node.obj, MerkleNodeHeader):
+            merkle_node.obj.parent = None
+        self.mark_dirty()
+        return merkle_node
+
+    def renumber(self, index, shift):
+        # Children from index on moved by shift
+        self.dirty_children = set(i + shift if i >= index else i for i in self.dirty_children)
+        for i in xrange(max(index, 0), self.children):
+            obj = self.objects[i].obj
+            if isinstance(obj, MerkleNodeHeader):
+                obj.parent_index = i
+
+    def clear_children(self):
+        '''
+        Removes every child
+        '''
+        self.materialize()
+        for merkle_node in self.objects:
+            if isinstance(merkle_node.obj, MerkleNodeHeader):
+                merkle_node.obj.parent = None
+        self.objects = []
+        self.children = 0
+        self.total_size = 8 if self.version > 0 else 0
+        self.dirty_children = set()
+        self.mark_dirty()
 
     def delete_child(self, sha):
+        self.materialize()
         for o in self.objects:
             if o.sha == sha:
                 o.mfs_type = MFSTypes.Nil # Delete it
+                self.mark_dirty()
+
+    def clear_child(self, index):
+        '''
+        Replaces child index with a Nil entry (zero digest), its position is kept
+        '''
+        self.materialize()
+        self.flags &= ~self.SORTED
+        obj = self.objects[index].obj
+        if isinstance(obj, MerkleNodeHeader):
+            obj.parent = None
+        self.objects[index] = MerkleNode(MFSTypes.Nil, 0, 0, '\0' * self.digest_size)
+        self.dirty_children.discard(index)
+        self.mark_dirty()
+
+    def set_child(self, index, obj):
+        '''
+        Replaces the object behind child index, the new object is written and the
+        child's digest updated on the next commit
+        '''
+        self.materialize()
+        self.flags &= ~self.SORTED # The new digest isn't known until commit
+        merkle_node = self.objects[index]
+        merkle_node.obj = obj
+        merkle_node.mfs_type = obj.mfs_type
+        if isinstance(obj, MerkleNodeHeader):
+            obj.parent = self
+            obj.parent_index = index
+        self.touch_child(index)
+
+    def touch_child(self, index):
+        '''
+        Records that the object behind child index was modified in place
+        '''
+        self.materialize()
+        self.flags &= ~self.SORTED
+        self.dirty_children.add(index)
+        self.mark_dirty()
+
+    def mark_dirty(self):
+        '''
+        Marks this node and its ancestors as needing a commit
+        '''
+        node = self
+        while node is not None:
+            node.dirty = True
+            parent = node.parent
+            if parent is None:
+                break
+            if parent.dirty and node.parent_index in parent.dirty_children:
+                break # The rest of the path is already dirty
+            parent.materialize() # The child's entry gets a new digest
+            parent.dirty_children.add(node.parent_index)
+            node = parent
+
+    def load_child(self, index, store):
+        '''
+        Returns the decoded object behind child index, loading it from the object
+        store the first time. Loaded nodes are linked to this node so changes to
+        them propagate up on commit. Loading doesn't decode the other children,
+        the entries are only materialized once one of them changes.
+        '''
+        if isinstance(self.objects, MerkleChildren):
+            obj = self.loaded.get(index)
+            if obj is None:
+                obj = store.load(self.objects.sha(index))
+                if isinstance(obj, MerkleNodeHeader):
+                    obj.parent = self
+                    obj.parent_index = index
+                self.loaded[index] = obj
+            return obj
+        merkle_node = self.objects[index]
+        if merkle_node.obj is None:
+            obj = store.load(merkle_node.sha)
+            if isinstance(obj, MerkleNodeHeader):
+                obj.parent = self
+                obj.parent_index = index
+            merkle_node.obj = obj
+        return merkle_node.obj
+
+    def commit(self, store):
+        '''
+        Writes the dirty part of the tree below this node to the object store and
+        returns the node's digest. Clean subtrees are neither reserialized nor rehashed.
+        The node's digest has to be the store's, see MerkleNodeHeader(digest).
+        '''
+        if self.digest != store.digest:
+            raise MFSException('node uses %s digests but the object store uses %s' %
+                               (MFSDigests.names[self.digest], MFSDigests.names[store.digest]))
+        if not self.dirty and self.sha is not None:
+            return self.sha
+        for index in sorted(self.dirty_children):
+            merkle_node = self.objects[index]
+            obj = merkle_node.obj
+            if isinstance(obj, MerkleNodeHeader):
+                sha = obj.commit(store)
+            else:
+                sha = store.write(obj.serialize())
+            if len(sha) != self.digest_size:
+                raise MFSException('child %d has a %d byte digest, expected %d' % (index, len(sha), self.digest_size))
+            merkle_node.sha = sha
+        self.dirty_children = set()
+        self.sha = store.write(self.serialize())
+        self.dirty = False
+        return self.sha
+
+
+class MerkleChildren:
+    '''
+    Read-only sequence of the children of a deserialized node, straight over
+    the serialized entries. Indexing decodes a single entry, len() and sha()
+    decode nothing, so a node with tens of thousands of children can be opened
+    and searched without creating an object per child. The entries are read
+    at their offsets, the buffer's cursor is never used.
+    '''
+    def __init__(self, string_buffer, offset, count, digest_size, sorted=False):
+        self.string_buffer = string_buffer
+        self.offset = offset
+        self.count = count
+        self.digest_size = digest_size
+        self.entry_size = entry_size(digest_size)
+        self.sorted = bool(sorted)
 
+    def __len__(self):
+        return self.count
+
+    def position(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError('child index out of range')
+        return self.offset + index * self.entry_size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in xrange(*index.indices(self.count))]
+        mfs_type, mode, flags = self.string_buffer.unpack_header_at('<BBH', self.position(index))
+        return MerkleNode(mfs_type, mode, flags, self.sha(index))
+
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self[i]
+
+    def sha(self, index):
+        '''
+        Returns the digest of child index
+        '''
+        return self.string_buffer.raw_read_at(self.position(index) + 4, self.digest_size)
+
+    def mfs_type(self, index):
+        return self.string_buffer.read_uint_at(self.position(index), 1)
+
+    def shas(self):
+        for i in xrange(self.count):
+            yield self.sha(i)
+
+    def find(self, sha):
+        '''
+        Returns the index of the child with digest sha or -1
+        '''
+        if self.sorted:
+            lo, hi = 0, self.count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self.sha(mid) < sha:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            if lo < self.count and self.sha(lo) == sha:
+                return lo
+            return -1
+        for i in xrange(self.count):
+            if self.sha(i) == sha:
+                return i
+        return -1
+
+    def raw(self):
+        '''
+        Returns the serialized entries
+        '''
+        return self.string_buffer.view_at(self.offset, self.count * self.entry_size)
 
 
 class MerkleNode(MFSObject):
@@ -90,39 +443,38 @@ class MerkleNode(MFSObject):
     +-----------------------------------------------------------------------------------+
     |      mfs_type      |     mode           |              flags                      |
     +-----------------------------------------------------------------------------------+
-    |                               sha                                                 |
+    |                               sha*                                                |
     |                                                                                   |
     +-----------------------------------------------------------------------------------+
+      * - Digest of the child, as wide as the node's digest and zero padded to the
+          word boundary
     '''
     mfs_type = None
     mode = None
     flags = None
     sha = None
+    obj = None # The child object when it's held in memory, never serialized
 
-    def __init__(self, mfs_type, mode, flags, sha):
+    def __init__(self, mfs_type, mode, flags, sha, obj=None):
         self.mfs_type = mfs_type
         self.mode = mode
         self.flags = flags
         self.sha = sha
+        self.obj = obj
 
     @classmethod
-    def deserialize(cls, string_buffer):
-        sb = string_buffer
-        mfs_type = sb.read_uint(1)
-        mode = sb.read_uint(1)
-        flags = sb.read_uint(2)
-        sha = sb.raw_read(20)
-
+    def deserialize(cls, string_buffer, digest_size=20):
+        padding = entry_size(digest_size) - 4 - digest_size
+        mfs_type, mode, flags, sha = string_buffer.unpack_header('<BBH%ds%dx' % (digest_size, padding))
         return cls(mfs_type, mode, flags, sha)
 
-    def serialize(self):
-        sb = StringBuffer(24)
-        sb.pack('<BBH', self.mfs_type, self.mode, self.flags)
-        sb.write(self.sha)
-        sb.seek(0)
+    def serialized_size(self):
+        return entry_size(len(self.sha))
 
-        return sb
+    def serialize_into(self, string_buffer):
+        padding = entry_size(len(self.sha)) - 4 - len(self.sha)
+        string_buffer.pack('<BBH%ds%dx' % (len(self.sha), padding), self.mfs_type, self.mode, self.flags, self.sha)
         
     def __len__(self): 
-        return 24
+        return entry_size(len(self.sha))
 
@@ -6,6 +6,40 @@
 '''
 
 from mfs.types import MFSTypes
+from mfs.string_buffer import StringBuffer
+from mfs.exceptions import SerializationError
+from struct import unpack
+import os
+
+# Header class for each object type, as (module, class name). The modules
+# import this one so the classes are looked up the first time an object is
+# decoded, not at import time.
+header_modules = {
+    MFSTypes.MerkleNode     : ('mfs.node', 'MerkleNodeHeader'),
+    MFSTypes.SymbolTable    : ('mfs.symbol_table', 'SymbolTableHeader'),
+    MFSTypes.Datatype       : ('mfs.datatype', 'DatatypeHeader'),
+    MFSTypes.Dataspace      : ('mfs.dataspace', 'DataspaceHeader'),
+    MFSTypes.Attribute      : ('mfs.attribute', 'AttributeHeader'),
+    MFSTypes.DataBlock      : ('mfs.datablock', 'DataBlockHeader'),
+    MFSTypes.FilterPipeline : ('mfs.filters', 'FilterPipelineHeader'),
+}
+
+header_classes = {}
+
+def resolve_header_classes():
+    '''
+    Imports the header classes in header_modules into header_classes
+    '''
+    for mfs_type, (module, name) in header_modules.iteritems():
+        header_classes[mfs_type] = getattr(__import__(module, fromlist=[name]), name)
+    return header_classes
+
+def register_header(mfs_type, module, name):
+    '''
+    Adds a header class to the decoder table
+    '''
+    header_modules[mfs_type] = (module, name)
+    header_classes.clear()
 
 class MFSObjectHeader:
     '''
@@ -21,25 +55,39 @@ class MFSObjectHeader:
     '''
     mfs_type = None
 
+    def serialized_size(self):
+        '''
+        Returns the size in bytes of the serialized header and body
+        '''
+        return 16 + self.total_size
+
+    def serialize_into(self, string_buffer):
+        '''
+        Writes the header and body into string_buffer at its current offset,
+        the offset is left at the end of the object
+        '''
+        raise NotImplementedError('abstract class')
+
+    def serialize(self):
+        return serialize_object(self)
+
     @classmethod
     def deserialize(cls, string_buffer):
         offset = string_buffer.offset()
-        mfs_type = string_buffer.read_uint(1)
+        mfs_type = string_buffer.read_u8()
         string_buffer.seek(offset)
 
-        if mfs_type == MFSTypes.MerkleNode:
-            from mfs.node import MerkleNodeHeader
-            return MerkleNodeHeader.deserialize(string_buffer)
-        elif mfs_type == MFSTypes.SymbolTable:
-            from mfs.symbol_table import SymbolTableHeader
-            return SymbolTableHeader.deserialize(string_buffer)
-        elif mfs_type == MFSTypes.Datatype:
-            from mfs.datatype import DatatypeHeader
-            return DatatypeHeader.deserialize(string_buffer)
-        elif mfs_type == MFSTypes.Dataspace:
-            from mfs.dataspace import DataspaceHeader
-            return DataspaceHeader.deserialize(string_buffer)
-        raise TypeError("unrecognized object type")
+        header_cls = (header_classes or resolve_header_classes()).get(mfs_type)
+        if header_cls is None:
+            raise TypeError("unrecognized object type")
+        return header_cls.deserialize(string_buffer)
+
+    def deserialize_body(self, string_buffer):
+        '''
+        Decodes the part of the object that follows the header, objects without
+        a body don't need to override this
+        '''
+        pass
 
 
 
@@ -49,12 +97,98 @@ class MFSObject:
     def __init__(self):
         raise NotImplementedError('abstract class')
 
-    def serialize(self):
+    def serialized_size(self):
+        raise NotImplementedError('abstract class')
+
+    def serialize_into(self, string_buffer):
         raise NotImplementedError('abstract class')
 
+    def serialize(self):
+        return serialize_object(self)
+
     @classmethod
     def deserialize(cls):
         raise NotImplementedError('abstract class')
 
 
+def serialize_object(obj):
+    '''
+    Returns a new buffer holding the serialized object. serialize_into writes
+    every byte, so the buffer is taken from the pool without being zeroed first.
+    '''
+    size = obj.serialized_size()
+    sb = StringBuffer(size, zero=False)
+    obj.serialize_into(sb)
+    if sb.offset() != size:
+        raise SerializationError('%s wrote %d bytes, expected %d' % (obj.__class__.__name__, sb.offset(), size))
+    sb.seek(0)
+    return sb
+
+def serialize_objects(objects, string_buffer=None):
+    '''
+    Serializes the objects back to back into string_buffer, a new growable
+    buffer by default, and returns the buffer. See iter_objects.
+    '''
+    sb = string_buffer
+    if sb is None:
+        sb = StringBuffer.growable()
+    for o in objects:
+        o.serialize_into(sb)
+        if sb.offset() % 8 != 0:
+            sb.write('\0' * (8 - sb.offset() % 8))
+    return sb
+
+def read_exactly(fd, size):
+    chunks = []
+    while size > 0:
+        chunk = os.read(fd, size)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        size -= len(chunk)
+    return ''.join(chunks)
+
+def iter_objects(buffer_or_fd):
+    '''
+    Decodes a stream of serialized objects laid back to back (each padded to the
+    word boundary) and yields the headers with their bodies decoded. The stream
+    is a StringBuffer (read from its current offset), any object exporting a
+    buffer, or a file descriptor that is read one object at a time.
+    '''
+    if isinstance(buffer_or_fd, (int, long)):
+        fd = buffer_or_fd
+        while True:
+            head = read_exactly(fd, 16)
+            if not head:
+                return
+            if len(head) < 16:
+                raise IOError('truncated object header')
+            total_size = unpack('<Q', head[8:])[0]
+            size = 16 + total_size
+            if size % 8 != 0:
+                size += 8 - size % 8
+            body = read_exactly(fd, size - 16)
+            if len(body) < size - 16:
+                raise IOError('truncated object')
+            sb = StringBuffer(size)
+            sb.write(head)
+            sb.write(body)
+            sb.seek(0)
+            header = MFSObjectHeader.deserialize(sb)
+            header.deserialize_body(sb)
+            yield header
+        return
 
+    sb = buffer_or_fd
+    if not isinstance(sb, StringBuffer):
+        sb = StringBuffer.wrap(sb)
+    offset = sb.offset()
+    end = sb.buffer_size()
+    while offset < end:
+        header = MFSObjectHeader.deserialize(sb)
+        header.deserialize_body(sb)
+        offset += 16 + header.total_size
+        if offset % 8 != 0:
+            offset += 8 - offset % 8
+        sb.seek(min(offset, end))
+        yield header
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file mfs/selection.py
+@description Hyperslab selections
+'''
+
+class Hyperslab:
+    '''
+    HDF5 style hyperslab, in each dimension count blocks of block elements
+    are selected, the first one at start and each following one stride
+    elements after the previous one:
+
+        start=1, stride=4, count=3, block=2
+
+        0   1   2   3   4   5   6   7   8   9   10  11
+            [=====]         [=====]         [======]
+
+    stride defaults to 1 and block to 1, so start and count alone select a
+    box. The selected elements are packed into an array of shape() in
+    row-major order, count * block elements in each dimension.
+    '''
+    start  = None
+    count  = None
+    stride = None
+    block  = None
+
+    def __init__(self, start, count, stride=None, block=None):
+        self.start = tuple(start)
+        self.count = tuple(count)
+        dims = len(self.start)
+        self.stride = tuple(stride) if stride is not None else (1,) * dims
+        self.block = tuple(block) if block is not None else (1,) * dims
+        if not len(self.count) == len(self.stride) == len(self.block) == dims:
+            raise ValueError('start, count, stride and block need one value per dimension')
+        for o, c, s, b in zip(self.start, self.count, self.stride, self.block):
+            if o < 0 or c < 0 or b < 1:
+                raise ValueError('invalid hyperslab %s' % self)
+            if c > 1 and s < b:
+                raise ValueError('hyperslab blocks overlap (stride %d, block %d)' % (s, b))
+
+    @classmethod
+    def from_slices(cls, shape, key):
+        '''
+        Returns the selection for an index expression made of integers and
+        slices with positive steps, like dataset[5, 10:20, ::2]. Trailing
+        dimensions that aren't given are selected whole. Indexed dimensions
+        are kept with a size of 1.
+        '''
+        if not isinstance(key, tuple):
+            key = (key,)
+        if len(key) > len(shape):
+            raise IndexError('too many indices')
+        start, count, stride = [], [], []
+        for d, size in enumerate(shape):
+            k = key[d] if d < len(key) else slice(None)
+            if isinstance(k, slice):
+                first, stop, step = k.indices(size)
+                if step < 1:
+                    raise ValueError('slice steps must be positive')
+                start.append(first)
+                count.append(len(xrange(first, stop, step)))
+                stride.append(step)
+            elif isinstance(k, (int, long)):
+                if k < 0:
+                    k += size
+                if not 0 <= k < size:
+                    raise IndexError('index %d out of range' % key[d])
+                start.append(k)
+                count.append(1)
+                stride.append(1)
+            else:
+                raise TypeError('unsupported index %r' % (k,))
+        return cls(start, count, stride)
+
+    def __repr__(self):
+        return 'Hyperslab(start=%s, count=%s, stride=%s, block=%s)' % (self.start, self.count, self.stride, self.block)
+
+    def shape(self):
+        '''
+        Shape of the array the selection is packed into
+        '''
+        return tuple(c * b for c, b in zip(self.count, self.block))
+
+    def check(self, shape):
+        '''
+        Raises ValueError if the selection doesn't fit in an array of shape
+        '''
+        if len(shape) != len(self.start):
+            raise ValueError('selection has %d dimensions, expected %d' % (len(self.start), len(shape)))
+        for o, c, s, b, size in zip(self.start, self.count, self.stride, self.block, shape):
+            if c and o + (c - 1) * s + b > size:
+                raise ValueError('%s exceeds the shape %s' % (self, shape))
+
+    def runs(self, d):
+        '''
+        Returns the selection along dimension d as (offset, length, output
+        offset) runs, blocks that follow each other are merged
+        '''
+        o, c, s, b = self.start[d], self.count[d], self.stride[d], self.block[d]
+        if c == 0:
+            return []
+        if s == b:
+            return [(o, c * b, 0)]
+        return [(o + i * s, b, i * b) for i in xrange(c)]
+
+    def plan(self, chunks):
+        '''
+        Splits the runs of every dimension at the chunk boundaries. Returns a
+        list with a dict per dimension mapping the chunk coordinate to the
+        (offset in the chunk, length, output offset) pieces in that chunk,
+        only chunks holding a part of the selection are listed.
+        '''
+        plan = []
+        for d, c in enumerate(chunks):
+            pieces = {}
+            for offset, length, out in self.runs(d):
+                end = offset + length
+                while offset < end:
+                    chunk, inside = divmod(offset, c)
+                    n = min(end - offset, c - inside)
+                    pieces.setdefault(chunk, []).append((inside, n, out))
+                    offset += n
+                    out += n
+            plan.append(pieces)
+        return plan
+
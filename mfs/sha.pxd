@@ -1,5 +1,5 @@
 
-cdef extern from "openssl/sha.h":
+cdef extern from "openssl/sha.h" nogil:
     ctypedef struct SHA_CTX:
         unsigned int h0
         unsigned int h1
@@ -20,6 +20,27 @@ cdef extern from "openssl/sha.h":
 
 cdef class PySHA1:
     cdef SHA_CTX ctx
-    cdef int update(self,char *block, size_t blocksize) except 0
-    cdef int final(self, unsigned char *md) except 0
+    cdef int update(self,char *block, size_t blocksize) nogil
+    cdef int final(self, unsigned char *md) nogil
 
+
+cdef extern from "openssl/evp.h" nogil:
+    ctypedef struct EVP_MD:
+        pass
+    ctypedef struct EVP_MD_CTX:
+        pass
+
+    const EVP_MD *EVP_get_digestbyname(const char *name)
+    int EVP_MD_size(const EVP_MD *md)
+    EVP_MD_CTX *EVP_MD_CTX_new()
+    void EVP_MD_CTX_free(EVP_MD_CTX *ctx)
+    int EVP_DigestInit_ex(EVP_MD_CTX *ctx, const EVP_MD *type, void *impl)
+    int EVP_DigestUpdate(EVP_MD_CTX *ctx, const void *d, size_t cnt)
+    int EVP_DigestFinal_ex(EVP_MD_CTX *ctx, unsigned char *md, unsigned int *s)
+
+
+cdef class PyDigest:
+    cdef EVP_MD_CTX *ctx
+    cdef readonly int digest_size
+    cdef int update(self, char *block, size_t blocksize) nogil
+    cdef int final(self, unsigned char *md) nogil
@@ -1,5 +1,7 @@
 
 from sha cimport SHA1_Init, SHA1_Update, SHA1_Final, SHA1, SHA1_Transform, SHA1
+from sha cimport EVP_MD, EVP_get_digestbyname, EVP_MD_size, EVP_MD_CTX_new, EVP_MD_CTX_free
+from sha cimport EVP_DigestInit_ex, EVP_DigestUpdate, EVP_DigestFinal_ex
 
 cdef class PySHA1:
     def __cinit__(self):
@@ -7,12 +9,38 @@ cdef class PySHA1:
         if retval != 1:
             raise RuntimeError("failed to initialize sha1 context")
 
-    cdef int update(self,char *block, size_t blocksize) except 0:
+    # Both return 1 on success and 0 on failure, they don't need the GIL so
+    # callers can hash without blocking other threads
+
+    cdef int update(self,char *block, size_t blocksize) nogil:
         cdef int retval = SHA1_Update(&self.ctx, block, blocksize)
         return retval
 
-    cdef int final(self, unsigned char *md) except 0:
+    cdef int final(self, unsigned char *md) nogil:
         cdef int retval = SHA1_Final(md, &self.ctx)
         return retval
 
 
+cdef class PyDigest:
+    '''
+    Any digest OpenSSL knows by name (SHA1, SHA256, BLAKE2b512 ...)
+    '''
+    def __cinit__(self, name):
+        cdef const EVP_MD *md = EVP_get_digestbyname(name)
+        if md == NULL:
+            raise ValueError("unsupported digest %s" % name)
+        self.digest_size = EVP_MD_size(md)
+        self.ctx = EVP_MD_CTX_new()
+        if self.ctx == NULL:
+            raise MemoryError()
+        if EVP_DigestInit_ex(self.ctx, md, NULL) != 1:
+            raise RuntimeError("failed to initialize %s context" % name)
+
+    def __dealloc__(self):
+        EVP_MD_CTX_free(self.ctx)
+
+    cdef int update(self, char *block, size_t blocksize) nogil:
+        return EVP_DigestUpdate(self.ctx, block, blocksize)
+
+    cdef int final(self, unsigned char *md) nogil:
+        return EVP_DigestFinal_ex(self.ctx, md, NULL)
@@ -0,0 +1,113 @@
+from libc.stdint cimport uint8_t, uint64_t
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_C_CONTIGUOUS
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+
+# Byte shuffle and delta pre-filters for chunks of fixed size elements. They
+# don't compress anything themselves, they rearrange numeric data so that the
+# codec after them in a filter pipeline finds long runs. The GIL is released
+# while they run so chunks can be filtered by several threads at once.
+
+cdef object new_bytes(Py_ssize_t length):
+    return PyBytes_FromStringAndSize(NULL, length)
+
+cdef int check_size(Py_ssize_t length, Py_ssize_t element_size) except -1:
+    if element_size < 1:
+        raise ValueError('invalid element size')
+    if length % element_size != 0:
+        raise ValueError('data is not a whole number of %d byte elements' % element_size)
+    return 0
+
+cdef void shuffle_bytes(const uint8_t *src, uint8_t *dst, Py_ssize_t count, Py_ssize_t element_size, bint forward) nogil:
+    cdef Py_ssize_t i, j
+    for i in range(count):
+        for j in range(element_size):
+            if forward:
+                dst[j * count + i] = src[i * element_size + j]
+            else:
+                dst[i * element_size + j] = src[j * count + i]
+
+def shuffle(data, Py_ssize_t element_size):
+    '''
+    Returns data with the bytes of its elements regrouped by significance, the
+    first byte of every element, then the second byte of every element ...
+    '''
+    return run_shuffle(data, element_size, True)
+
+def unshuffle(data, Py_ssize_t element_size):
+    '''
+    Undoes shuffle()
+    '''
+    return run_shuffle(data, element_size, False)
+
+cdef object run_shuffle(data, Py_ssize_t element_size, bint forward):
+    cdef Py_buffer view
+    cdef uint8_t *dst
+    PyObject_GetBuffer(data, &view, PyBUF_C_CONTIGUOUS)
+    try:
+        check_size(view.len, element_size)
+        result = new_bytes(view.len)
+        dst = <uint8_t *> PyBytes_AS_STRING(result)
+        with nogil:
+            shuffle_bytes(<const uint8_t *> view.buf, dst, view.len // element_size, element_size, forward)
+        return result
+    finally:
+        PyBuffer_Release(&view)
+
+cdef inline uint64_t load_element(const uint8_t *p, int width) nogil:
+    cdef uint64_t value = 0
+    cdef int i
+    for i in range(width - 1, -1, -1):
+        value = (value << 8) | p[i]
+    return value
+
+cdef inline void store_element(uint8_t *p, uint64_t value, int width) nogil:
+    cdef int i
+    for i in range(width):
+        p[i] = value & 0xff
+        value >>= 8
+
+cdef void delta_bytes(const uint8_t *src, uint8_t *dst, Py_ssize_t count, int width, bint forward) nogil:
+    # Little-endian unsigned elements, differences wrap around so any bit
+    # pattern (signed integers, floats) comes back exactly
+    cdef uint64_t previous = 0
+    cdef uint64_t value
+    cdef uint64_t mask = (<uint64_t> -1) if width == 8 else ((<uint64_t> 1) << (8 * width)) - 1
+    cdef Py_ssize_t i
+    for i in range(count):
+        value = load_element(src + i * width, width)
+        if forward:
+            store_element(dst + i * width, (value - previous) & mask, width)
+            previous = value
+        else:
+            previous = (previous + value) & mask
+            store_element(dst + i * width, previous, width)
+
+def delta_encode(data, int element_size):
+    '''
+    Replaces every element (1, 2, 4 or 8 bytes, little-endian) with its
+    difference to the previous one
+    '''
+    return run_delta(data, element_size, True)
+
+def delta_decode(data, int element_size):
+    '''
+    Undoes delta_encode()
+    '''
+    return run_delta(data, element_size, False)
+
+cdef object run_delta(data, int element_size, bint forward):
+    cdef Py_buffer view
+    cdef uint8_t *dst
+    if element_size not in (1, 2, 4, 8):
+        raise ValueError('delta needs 1, 2, 4 or 8 byte elements')
+    PyObject_GetBuffer(data, &view, PyBUF_C_CONTIGUOUS)
+    try:
+        check_size(view.len, element_size)
+        result = new_bytes(view.len)
+        dst = <uint8_t *> PyBytes_AS_STRING(result)
+        with nogil:
+            delta_bytes(<const uint8_t *> view.buf, dst, view.len // element_size, element_size, forward)
+        return result
+    finally:
+        PyBuffer_Release(&view)
+
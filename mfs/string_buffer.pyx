@@ -1,72 +1,598 @@
-from libc.stdlib cimport malloc, free
-from libc.string cimport memset, strerror, memcpy
-from libc.errno cimport errno, EAGAIN
+from libc.stdlib cimport malloc, realloc, free
+from libc.string cimport memset, strerror, memcpy, memchr
+from libc.limits cimport LONG_MAX
+from libc.stdint cimport uint16_t, uint32_t, uint64_t, int8_t, int16_t, int32_t, int64_t
+from libc.errno cimport errno, EAGAIN, EINTR
 from mfs.exceptions import BufferOverflow
-from sha cimport SHA1, PySHA1
+from sha cimport PyDigest
+from mfs.types import MFSDigests
+from multiprocessing import cpu_count
+from threading import Thread
 import sys
 
+from posix.types cimport off_t
+from cpython.buffer cimport PyObject_CheckBuffer, PyObject_GetBuffer, PyBuffer_Release, PyBuffer_FillInfo
+from cpython.buffer cimport PyBUF_C_CONTIGUOUS, PyBUF_WRITABLE
+from cpython.bytes cimport PyBytes_FromStringAndSize
+
 cdef extern from "unistd.h" nogil:
     ssize_t write(int filedes, void *buf, size_t nbyte)
     ssize_t read(int filedes, void *buf, size_t nbyte)
+    ssize_t pwrite(int filedes, void *buf, size_t nbyte, off_t offset)
+    ssize_t pread(int filedes, void *buf, size_t nbyte, off_t offset)
+    long sysconf(int name)
+    int _SC_PAGESIZE
+    int _SC_IOV_MAX
+
+cdef extern from "sys/uio.h" nogil:
+    struct iovec:
+        void *iov_base
+        size_t iov_len
+    ssize_t c_writev "writev" (int filedes, const iovec *iov, int iovcnt)
+    ssize_t c_readv "readv" (int filedes, const iovec *iov, int iovcnt)
+    ssize_t c_pwritev "pwritev" (int filedes, const iovec *iov, int iovcnt, off_t offset)
+    ssize_t c_preadv "preadv" (int filedes, const iovec *iov, int iovcnt, off_t offset)
+
+cdef extern from "sys/mman.h" nogil:
+    void *mmap(void *addr, size_t length, int prot, int flags, int fd, off_t offset)
+    int munmap(void *addr, size_t length)
+    int msync(void *addr, size_t length, int flags)
+    int MS_SYNC
+    int PROT_READ
+    int PROT_WRITE
+    int MAP_SHARED
+    int MAP_PRIVATE
+    void *MAP_FAILED
+
+cdef enum:
+    BACKING_HEAP = 0
+    BACKING_MMAP = 1
+    BACKING_BORROWED = 2
+
+cdef Py_ssize_t buffer_length(obj) except -1:
+    cdef Py_buffer view
+    PyObject_GetBuffer(obj, &view, PyBUF_C_CONTIGUOUS)
+    length = view.len
+    PyBuffer_Release(&view)
+    return length
+
+cdef inline uint64_t load_le(const unsigned char *p, int width) nogil:
+    cdef uint64_t value = 0
+    cdef int i
+    for i in range(width - 1, -1, -1):
+        value = (value << 8) | p[i]
+    return value
+
+cdef inline void store_le(unsigned char *p, uint64_t value, int width) nogil:
+    cdef int i
+    for i in range(width):
+        p[i] = value & 0xff
+        value >>= 8
+
+cdef inline object uint_object(uint64_t value):
+    # Same as struct.unpack, a Python 2 int when the value fits and a long otherwise
+    if value <= <uint64_t> LONG_MAX:
+        return <long> value
+    return value
+
+cdef inline int64_t sign_extend(uint64_t value, int width) nogil:
+    if width < 8 and (value >> (8 * width - 1)) & 1:
+        value |= (<uint64_t> -1) << (8 * width)
+    return <int64_t> value
+
+cdef inline float load_f32(const unsigned char *p) nogil:
+    cdef uint32_t bits = <uint32_t> load_le(p, 4)
+    cdef float value
+    memcpy(&value, &bits, 4)
+    return value
+
+cdef inline double load_f64(const unsigned char *p) nogil:
+    cdef uint64_t bits = load_le(p, 8)
+    cdef double value
+    memcpy(&value, &bits, 8)
+    return value
+
+cdef inline uint64_t f32_bits(float value) nogil:
+    cdef uint32_t bits
+    memcpy(&bits, &value, 4)
+    return bits
+
+cdef inline uint64_t f64_bits(double value) nogil:
+    cdef uint64_t bits
+    memcpy(&bits, &value, 8)
+    return bits
+
+
+DEF MAX_FIELDS = 32
+
+cdef enum:
+    FIELD_PAD   = 0
+    FIELD_UINT  = 1
+    FIELD_INT   = 2
+    FIELD_F32   = 3
+    FIELD_F64   = 4
+    FIELD_BYTES = 5
+
+FIELD_TYPES = {
+    'B' : (FIELD_UINT, 1),
+    'b' : (FIELD_INT,  1),
+    'H' : (FIELD_UINT, 2),
+    'h' : (FIELD_INT,  2),
+    'I' : (FIELD_UINT, 4),
+    'i' : (FIELD_INT,  4),
+    'Q' : (FIELD_UINT, 8),
+    'q' : (FIELD_INT,  8),
+    'f' : (FIELD_F32,  4),
+    'd' : (FIELD_F64,  8),
+}
+
+cdef class StructCodec:
+    '''
+    A struct format compiled once into a table of fields so that packing and
+    unpacking run in C without building intermediate strings.
+    Only little-endian ('<') formats made of x B b H h I i Q q f d and s are supported.
+    '''
+    cdef readonly object fmt
+    cdef readonly size_t size
+    cdef int nfields
+    cdef int nvalues
+    cdef int kinds[MAX_FIELDS]
+    cdef size_t widths[MAX_FIELDS]
+
+    def __cinit__(self, fmt):
+        self.fmt = fmt
+        self.size = 0
+        self.nfields = 0
+        self.nvalues = 0
+        if not fmt.startswith('<'):
+            raise ValueError('only little-endian struct formats are supported')
+        count = ''
+        for c in fmt[1:]:
+            if c.isdigit():
+                count += c
+                continue
+            repeat = int(count) if count else 1
+            count = ''
+            if c == 's':
+                self.add_field(FIELD_BYTES, repeat)
+            elif c == 'x':
+                self.add_field(FIELD_PAD, repeat)
+            elif c in FIELD_TYPES:
+                kind, width = FIELD_TYPES[c]
+                for i in xrange(repeat):
+                    self.add_field(kind, width)
+            else:
+                raise ValueError('bad char in struct format: %r' % c)
+
+    cdef add_field(self, int kind, size_t width):
+        if self.nfields == MAX_FIELDS:
+            raise ValueError('struct format has too many fields')
+        self.kinds[self.nfields] = kind
+        self.widths[self.nfields] = width
+        self.nfields += 1
+        self.size += width
+        if kind != FIELD_PAD:
+            self.nvalues += 1
+
+    cdef tuple unpack_ptr(self, const unsigned char *p):
+        cdef int i
+        cdef int j = 0
+        cdef size_t width
+        values = [None] * self.nvalues
+        for i in range(self.nfields):
+            width = self.widths[i]
+            if self.kinds[i] == FIELD_UINT:
+                values[j] = uint_object(load_le(p, width))
+            elif self.kinds[i] == FIELD_INT:
+                values[j] = sign_extend(load_le(p, width), width)
+            elif self.kinds[i] == FIELD_F32:
+                values[j] = load_f32(p)
+            elif self.kinds[i] == FIELD_F64:
+                values[j] = load_f64(p)
+            elif self.kinds[i] == FIELD_BYTES:
+                values[j] = PyBytes_FromStringAndSize(<char *> p, width)
+            else:
+                j -= 1
+            j += 1
+            p += width
+        return tuple(values)
+
+    cdef int pack_ptr(self, unsigned char *p, tuple args) except -1:
+        cdef int i
+        cdef int j = 0
+        cdef size_t width
+        cdef size_t length
+        cdef uint64_t uvalue
+        cdef int64_t ivalue
+        cdef int64_t limit
+        if len(args) != self.nvalues:
+            raise TypeError('pack expected %d items for packing (got %d)' % (self.nvalues, len(args)))
+        for i in range(self.nfields):
+            width = self.widths[i]
+            if self.kinds[i] == FIELD_PAD:
+                memset(p, 0x0, width)
+                p += width
+                continue
+            value = args[j]
+            j += 1
+            if self.kinds[i] == FIELD_UINT:
+                uvalue = value
+                if width < 8 and uvalue >> (8 * width):
+                    raise OverflowError('value out of range for a %d byte unsigned integer' % width)
+                store_le(p, uvalue, width)
+            elif self.kinds[i] == FIELD_INT:
+                ivalue = value
+                if width < 8:
+                    limit = (<int64_t> 1) << (8 * width - 1)
+                    if ivalue < -limit or ivalue >= limit:
+                        raise OverflowError('value out of range for a %d byte integer' % width)
+                store_le(p, <uint64_t> ivalue, width)
+            elif self.kinds[i] == FIELD_F32:
+                store_le(p, f32_bits(value), 4)
+            elif self.kinds[i] == FIELD_F64:
+                store_le(p, f64_bits(value), 8)
+            else:
+                if not isinstance(value, bytes):
+                    raise TypeError('argument for \'s\' must be a string')
+                length = min(<size_t> len(value), width)
+                memcpy(p, <char *> value, length)
+                memset(p + length, 0x0, width - length)
+            p += width
+        return 0
+
+    def __repr__(self):
+        return 'StructCodec(%r)' % self.fmt
+
+cdef dict codecs = {}
+
+cpdef StructCodec get_codec(fmt):
+    '''
+    Returns the compiled codec for fmt, codecs are compiled once and cached
+    '''
+    codec = codecs.get(fmt)
+    if codec is None:
+        codec = codecs[fmt] = StructCodec(fmt)
+    return codec
+
+# Default number of bytes handed to SHA-1 per update
+HASH_BLOCK_SIZE = 1 << 20
+
+
+# Buffer pool
+#
+# Heap buffers up to POOL_MAX_SIZE bytes are carved from power of two size
+# classes, and freed blocks are kept on a per class free list (up to
+# POOL_DEPTH blocks each) for the next buffer of that class. Serializing a tree
+# allocates thousands of small short lived buffers, they end up recycling a
+# handful of blocks instead of going through malloc and free every time.
+# The free lists are only touched with the GIL held.
+
+cdef enum:
+    POOL_CLASSES  = 10   # 8 bytes to 4KB
+    POOL_MAX_SIZE = 4096
+    POOL_DEPTH    = 64
+
+cdef char *pool_blocks[POOL_CLASSES][POOL_DEPTH]
+cdef int pool_counts[POOL_CLASSES]
+
+cdef inline int pool_class(size_t size) nogil:
+    cdef int c = 0
+    cdef size_t class_size = 8
+    while class_size < size:
+        class_size <<= 1
+        c += 1
+    return c
+
+cdef char *pool_alloc(size_t size, size_t *capacity):
+    '''
+    Returns a block of at least size bytes, its actual size is stored in capacity
+    '''
+    cdef int c
+    if size > POOL_MAX_SIZE:
+        capacity[0] = size
+        return <char *> malloc(size)
+    c = pool_class(size)
+    capacity[0] = (<size_t> 8) << c
+    if pool_counts[c] > 0:
+        pool_counts[c] -= 1
+        return pool_blocks[c][pool_counts[c]]
+    return <char *> malloc(capacity[0])
+
+cdef void pool_free(char *block, size_t capacity):
+    cdef int c
+    if capacity <= POOL_MAX_SIZE:
+        c = pool_class(capacity)
+        if (<size_t> 8) << c == capacity and pool_counts[c] < POOL_DEPTH:
+            pool_blocks[c][pool_counts[c]] = block
+            pool_counts[c] += 1
+            return
+    free(block)
+
+def buffer_pool_stats():
+    '''
+    Returns the number of free blocks held for each size class
+    '''
+    cdef int c
+    return dict(((8 << c), pool_counts[c]) for c in range(POOL_CLASSES))
+
+def clear_buffer_pool():
+    '''
+    Releases the free blocks held by the pool
+    '''
+    cdef int c
+    for c in range(POOL_CLASSES):
+        while pool_counts[c] > 0:
+            pool_counts[c] -= 1
+            free(pool_blocks[c][pool_counts[c]])
 
-from struct import pack, unpack
 
 cdef class StringBuffer:
 
     cdef char* buff
     cdef size_t size
     cdef size_t s_offset
+    cdef int backing
+    cdef bint readonly
+    cdef char* map_base
+    cdef size_t map_size
+    cdef Py_buffer borrowed
+    cdef int exports
+    cdef bint grows
+    cdef size_t capacity
 
-    def __cinit__(self, initializer):
+    def __cinit__(self, initializer, bint zero=True):
         cdef size_t size = 0
+        cdef size_t requested
         string = None
 
+        self.backing = BACKING_HEAP
+        self.readonly = False
+        self.s_offset = 0x0
+        self.exports = 0
+        if initializer is None: # Unbacked, used by the alternate constructors
+            self.buff = NULL
+            self.size = 0
+            return
+
         if isinstance(initializer, (basestring, StringBuffer)):
             string = initializer
             size = len(string)
+        elif PyObject_CheckBuffer(initializer):
+            string = initializer
+            size = buffer_length(string)
         else:
             size = initializer
+        requested = size
 
         # Align the size on a word boundary
         if size % 8 != 0:
             size += 8 - size % 8
         self.size = size
-        self.buff = <char *> malloc(size)
+        self.buff = pool_alloc(size, &self.capacity)
         if self.buff == NULL:
             raise MemoryError(strerror(errno))
-        memset(self.buff, 0x0, self.size)
+        if string is not None or not zero:
+            # Only the padding, the rest is about to be overwritten
+            memset(self.buff + requested, 0x0, size - requested)
+        else:
+            memset(self.buff, 0x0, self.size)
         self.s_offset = 0x0
 
-        if string is not None and isinstance(string,(basestring, StringBuffer)):
+        if string is not None:
             self.write(string)
             self.seek(0)
 
     def __dealloc__(self):
-        free(self.buff)
+        if self.backing == BACKING_MMAP:
+            munmap(self.map_base, self.map_size)
+        elif self.backing == BACKING_BORROWED:
+            PyBuffer_Release(&self.borrowed)
+        elif self.buff != NULL:
+            pool_free(self.buff, self.capacity)
+
+    def __getbuffer__(self, Py_buffer *view, int flags):
+        PyBuffer_FillInfo(view, self, self.buff, self.size, self.readonly, flags)
+        self.exports += 1
+
+    def __releasebuffer__(self, Py_buffer *view):
+        self.exports -= 1
+
+    # Old style buffer interface, still used by parts of Python 2 and numpy.frombuffer
+    def __getsegcount__(self, Py_ssize_t *lenp):
+        if lenp != NULL:
+            lenp[0] = self.size
+        return 1
+
+    def __getreadbuffer__(self, Py_ssize_t idx, void **p):
+        if idx != 0:
+            raise SystemError("accessing non-existent buffer segment")
+        p[0] = self.buff
+        return self.size
+
+    def __getwritebuffer__(self, Py_ssize_t idx, void **p):
+        self.check_writable()
+        if idx != 0:
+            raise SystemError("accessing non-existent buffer segment")
+        p[0] = self.buff
+        return self.size
 
     cdef int check_offset(self, size_t offset):
         return (offset > self.size)
 
+    cdef int check_writable(self) except -1:
+        if self.readonly:
+            raise TypeError("buffer is read-only")
+        return 0
+
+    @classmethod
+    def from_mmap(cls, fd, size_t length, off_t offset=0, copy_on_write=False, writable=False):
+        '''
+        Maps length bytes of the file starting at offset into a new buffer.
+        Nothing is read up front, pages are faulted in as they're touched.
+        The mapping is read-only unless copy_on_write is set, in which case
+        writes are private to the buffer and never reach the file, or writable
+        is set, in which case writes go to the file (fd must be open for writing).
+        The file descriptor can be closed once the buffer is created.
+        '''
+        cdef StringBuffer sb = cls(None)
+        sb._map(fd, length, offset, copy_on_write, writable)
+        return sb
+
+    cdef _map(self, int fd, size_t length, off_t offset, bint copy_on_write, bint writable):
+        cdef off_t page_offset = offset % sysconf(_SC_PAGESIZE) # mmap offsets must be page aligned
+        cdef int prot = PROT_READ
+        cdef int flags = MAP_SHARED
+        cdef void *addr
+        if copy_on_write:
+            prot = PROT_READ | PROT_WRITE
+            flags = MAP_PRIVATE
+        elif writable:
+            prot = PROT_READ | PROT_WRITE
+        self.readonly = not (copy_on_write or writable)
+        if length == 0: # mmap(2) refuses empty mappings
+            return
+        addr = mmap(NULL, length + page_offset, prot, flags, fd, offset - page_offset)
+        if addr == MAP_FAILED:
+            raise IOError(strerror(errno))
+        self.backing = BACKING_MMAP
+        self.map_base = <char *> addr
+        self.map_size = length + page_offset
+        self.buff = self.map_base + page_offset
+        self.size = length
+
+    @classmethod
+    def wrap(cls, obj):
+        '''
+        Returns a buffer that shares memory with obj, any object exporting a
+        C-contiguous buffer (bytearray, memoryview, numpy arrays ...). Nothing is
+        copied, fread into the buffer reads straight into obj's memory and fwrite
+        writes straight out of it. The buffer is read-only if obj is.
+        '''
+        cdef StringBuffer sb = cls(None)
+        sb._borrow(obj)
+        return sb
+
+    @classmethod
+    def growable(cls, size_t capacity=64):
+        '''
+        Returns an empty buffer that grows as it's written to. The storage
+        doubles whenever a write runs past it, so writing n bytes costs O(n)
+        overall. buffer_size() is the number of bytes written (the furthest
+        offset reached), bytes skipped over by seek are zero.
+        The storage can't move while views of the buffer are exported, a write
+        that would need to move it raises BufferError instead.
+        '''
+        cdef StringBuffer sb = cls(None)
+        sb.grows = True
+        sb.buff = <char *> malloc(max(capacity, 8))
+        if sb.buff == NULL:
+            raise MemoryError(strerror(errno))
+        sb.capacity = max(capacity, 8)
+        memset(sb.buff, 0x0, sb.capacity)
+        return sb
+
+    cdef int resize(self, size_t capacity) except -1:
+        cdef char *buff
+        if self.exports > 0:
+            raise BufferError('buffer has exported views, it can\'t be resized')
+        buff = <char *> realloc(self.buff, max(capacity, 8))
+        if buff == NULL:
+            raise MemoryError(strerror(errno))
+        if capacity > self.capacity:
+            memset(buff + self.capacity, 0x0, capacity - self.capacity)
+        self.buff = buff
+        self.capacity = max(capacity, 8)
+        return 0
+
+    cdef Py_ssize_t advance_write(self, size_t byte_count) except -1:
+        '''
+        Like advance but for writes, growable buffers are extended to fit
+        '''
+        cdef size_t offset = self.s_offset
+        cdef size_t end = offset + byte_count
+        cdef size_t capacity
+        self.check_writable()
+        if end > self.size:
+            if not self.grows:
+                raise BufferOverflow("string length exceeds buffer size")
+            if end > self.capacity:
+                capacity = self.capacity * 2
+                if capacity < end:
+                    capacity = end
+                if capacity % 8 != 0:
+                    capacity += 8 - capacity % 8
+                self.resize(capacity)
+            self.size = end
+        self.s_offset = end
+        return offset
+
+    def reserve(self, size_t capacity):
+        '''
+        Makes room for capacity bytes in a growable buffer without writing
+        '''
+        if not self.grows:
+            raise TypeError('buffer is not growable')
+        if capacity > self.capacity:
+            self.resize(capacity)
+
+    def shrink_to_fit(self):
+        '''
+        Releases the storage of a growable buffer past its size
+        '''
+        if not self.grows:
+            raise TypeError('buffer is not growable')
+        if self.capacity > self.size:
+            self.resize(self.size)
+
+    def buffer_capacity(self):
+        '''
+        Returns the number of bytes the buffer can hold before it has to grow
+        '''
+        return self.capacity if self.backing == BACKING_HEAP else self.size
+
+    def is_growable(self):
+        return self.grows
+
+    cdef _borrow(self, obj):
+        try:
+            PyObject_GetBuffer(obj, &self.borrowed, PyBUF_C_CONTIGUOUS | PyBUF_WRITABLE)
+            self.readonly = False
+        except (BufferError, TypeError, ValueError):
+            PyObject_GetBuffer(obj, &self.borrowed, PyBUF_C_CONTIGUOUS)
+            self.readonly = True
+        self.backing = BACKING_BORROWED
+        self.buff = <char *> self.borrowed.buf
+        self.size = self.borrowed.len
+
     def write(self, string):
         '''
         Copies the string argument into the buffer. The buffer offset is set to the end of the string.
         If the string is too long an IOError is raised indicating an overflow, no data is written in this case
+        Besides strings and StringBuffers any object exporting a C-contiguous buffer can be written.
         '''
-        if self.check_offset(self.s_offset + len(string)):
-            raise BufferOverflow("string length exceeds buffer size")
         if isinstance(string, basestring):
-            memcpy(self.buff + self.s_offset, <char *> string, len(string))
+            self._write_raw(<char *> string, len(string))
         elif isinstance(string, StringBuffer):
-            return self._write_sb(string)
+            self._write_sb(string)
+        elif PyObject_CheckBuffer(string):
+            self._write_buffer(string)
         else:
             raise TypeError('unsupported type')
-        self.s_offset += len(string)
-        
+
+    cdef _write_raw(self, char *src, size_t length):
+        memcpy(self.buff + self.advance_write(length), src, length)
+
+    cdef _write_buffer(self, obj):
+        cdef Py_buffer view
+        PyObject_GetBuffer(obj, &view, PyBUF_C_CONTIGUOUS)
+        try:
+            self._write_raw(<char *> view.buf, view.len)
+        finally:
+            PyBuffer_Release(&view)
+
     cdef _write_sb(self, StringBuffer string):
-        if self.check_offset(self.s_offset + len(string)):
-            raise BufferOverflow("string length exceeds buffer size")
-        memcpy(self.buff + self.s_offset, string.buff + string.s_offset, string.size  - string.s_offset)
-        self.s_offset += string.size - string.s_offset
+        cdef size_t length = string.size - string.s_offset
+        memcpy(self.buff + self.advance_write(length), string.buff + string.s_offset, length)
 
 
     def seek(self, size_t offset):
@@ -79,10 +605,23 @@ cdef class StringBuffer:
 
     def read(self):
         '''
-        Returns a python object that points to the buffer's offset (interpreted as null terminated)
+        Returns a copy of the string at the buffer's offset, up to the first null
+        byte or the end of the buffer (mapped and wrapped buffers aren't null terminated)
         '''
-        py_string = <bytes> (self.buff+self.s_offset)
-        return py_string
+        return self.raw_read_at(self.s_offset, self.size - self.s_offset, True)
+
+    def view(self, read_bytes=-1):
+        '''
+        Like raw_read but returns a memoryview over the buffer instead of a copy.
+        The view keeps the buffer alive.
+        '''
+        if read_bytes < 0:
+            read_bytes = self.size - self.s_offset
+        if self.check_offset(self.s_offset + read_bytes):
+            raise BufferOverflow("offset exceeds buffer size")
+        v = memoryview(self)[self.s_offset : self.s_offset + read_bytes]
+        self.s_offset += read_bytes
+        return v
 
     def raw_read(self, read_bytes=-1, strip_null=False):
         if read_bytes < 0:
@@ -90,7 +629,7 @@ cdef class StringBuffer:
         if self.check_offset(self.s_offset + read_bytes):
             raise BufferOverflow("offset exceeds buffer size")
         if strip_null:
-            py_string = <bytes> (self.buff + self.s_offset)
+            py_string = self.raw_read_at(self.s_offset, read_bytes, True)
         else:
             py_string = <bytes> self.buff[self.s_offset : self.s_offset + read_bytes]
         self.s_offset += read_bytes
@@ -98,9 +637,143 @@ cdef class StringBuffer:
 
     def pack(self, fmt, *args):
         '''
-        See struct.pack
+        See struct.pack, fmt must be a little-endian format
+        '''
+        cdef StructCodec codec = get_codec(fmt)
+        cdef Py_ssize_t offset
+        offset = self.advance_write(codec.size)
+        try:
+            codec.pack_ptr(<unsigned char *> self.buff + offset, args)
+        except:
+            self.s_offset = offset
+            raise
+
+    def unpack_header(self, fmt):
+        '''
+        Decodes all the fields of a little-endian struct format at the offset in one call
+        and returns them as a tuple, see struct.unpack
         '''
-        self.write(pack(fmt, *args))
+        cdef StructCodec codec = get_codec(fmt)
+        return codec.unpack_ptr(<unsigned char *> self.buff + self.advance(codec.size))
+
+    # Positional access
+    #
+    # The *_at methods and pread/pwrite take the offset explicitly and neither
+    # read nor move the cursor, so any number of threads can read one buffer
+    # (or share one file descriptor) without locking. They aren't safe against
+    # a concurrent write that grows a growable buffer.
+
+    cdef Py_ssize_t check_range(self, size_t offset, size_t byte_count) except -1:
+        if offset > self.size or byte_count > self.size - offset:
+            raise BufferOverflow("offset exceeds buffer size")
+        return offset
+
+    def read_uint_at(self, size_t offset, byte_count):
+        '''
+        Reads an unsigned integer of byte_count bytes at offset
+        '''
+        if byte_count not in (1, 2, 4, 8):
+            raise IOError("Can't unpack unsigned integer of %s bytes" % byte_count)
+        return uint_object(load_le(<unsigned char *> self.buff + self.check_range(offset, byte_count), byte_count))
+
+    def read_int_at(self, size_t offset, byte_count):
+        '''
+        Reads a signed integer of byte_count bytes at offset
+        '''
+        if byte_count not in (1, 2, 4, 8):
+            raise IOError("Can't unpack integer of %s bytes" % byte_count)
+        return sign_extend(load_le(<unsigned char *> self.buff + self.check_range(offset, byte_count), byte_count), byte_count)
+
+    def raw_read_at(self, size_t offset, size_t read_bytes, strip_null=False):
+        '''
+        Returns a copy of read_bytes bytes at offset, up to the first null byte if strip_null is set
+        '''
+        cdef char *start = self.buff + self.check_range(offset, read_bytes)
+        cdef char *end = start + read_bytes
+        cdef char *null
+        if strip_null:
+            null = <char *> memchr(start, 0, read_bytes)
+            if null != NULL:
+                end = null
+        return PyBytes_FromStringAndSize(start, end - start)
+
+    def view_at(self, size_t offset, size_t read_bytes):
+        '''
+        Returns a memoryview over read_bytes bytes at offset, the view keeps the buffer alive
+        '''
+        self.check_range(offset, read_bytes)
+        return memoryview(self)[offset : offset + read_bytes]
+
+    def unpack_header_at(self, fmt, size_t offset):
+        '''
+        Like unpack_header but decodes the struct at offset, see struct.unpack_from
+        '''
+        cdef StructCodec codec = get_codec(fmt)
+        return codec.unpack_ptr(<unsigned char *> self.buff + self.check_range(offset, codec.size))
+
+    def pwrite(self, int fd, off_t file_offset, bytes_to_write=-1, size_t offset=0):
+        '''
+        Writes bytes_to_write bytes (the rest of the buffer by default) starting
+        at offset in the buffer to the file at file_offset. The file position is
+        left alone and the GIL is released while writing.
+        '''
+        cdef size_t total = 0
+        cdef size_t length
+        cdef ssize_t written = 0
+        cdef char *src
+        if bytes_to_write < 0:
+            bytes_to_write = self.size - min(offset, self.size)
+        length = bytes_to_write
+        src = self.buff + self.check_range(offset, length)
+        self.exports += 1 # Pin the memory while the GIL is released
+        try:
+            with nogil:
+                while total < length:
+                    written = pwrite(fd, src + total, length - total, file_offset + total)
+                    if written < 0:
+                        if errno == EINTR or errno == EAGAIN:
+                            continue
+                        break
+                    total += written
+        finally:
+            self.exports -= 1
+        if written < 0:
+            raise IOError(strerror(errno))
+        return total
+
+    def pread(self, int fd, off_t file_offset, bytes_to_read=-1, size_t offset=0):
+        '''
+        Reads up to bytes_to_read bytes (enough to fill the buffer by default)
+        from the file at file_offset into the buffer at offset and returns the
+        number of bytes read, which is short only at the end of the file. The
+        file position is left alone and the GIL is released while reading.
+        '''
+        cdef size_t total = 0
+        cdef size_t length
+        cdef ssize_t bytes_read = 0
+        cdef char *dst
+        self.check_writable()
+        if bytes_to_read < 0:
+            bytes_to_read = self.size - min(offset, self.size)
+        length = bytes_to_read
+        dst = self.buff + self.check_range(offset, length)
+        self.exports += 1
+        try:
+            with nogil:
+                while total < length:
+                    bytes_read = pread(fd, dst + total, length - total, file_offset + total)
+                    if bytes_read < 0:
+                        if errno == EINTR or errno == EAGAIN:
+                            continue
+                        break
+                    if bytes_read == 0: # EOF
+                        break
+                    total += bytes_read
+        finally:
+            self.exports -= 1
+        if bytes_read < 0:
+            raise IOError(strerror(errno))
+        return total
 
     def offset(self):
         '''
@@ -114,6 +787,7 @@ cdef class StringBuffer:
         the offset is set to 0 at the end of this operation.
         Ideal for clearing the buffer or reinitializing an existing buffer
         '''
+        self.check_writable()
         memset(self.buff, 0x0, self.size)
         self.seek(0)
         self.write(string)
@@ -125,6 +799,20 @@ cdef class StringBuffer:
         '''
         return self.size
 
+    def is_readonly(self):
+        return self.readonly
+
+    def is_mapped(self):
+        return self.backing == BACKING_MMAP
+
+    def sync(self):
+        '''
+        Flushes the changes made through a writable mapping to the file
+        '''
+        if self.backing == BACKING_MMAP and not self.readonly:
+            if msync(self.map_base, self.map_size, MS_SYNC) != 0:
+                raise IOError(strerror(errno))
+
     def fwrite(self, fd, bytes_to_write=-1):
         cdef ssize_t written = 0
         cdef size_t total = 0
@@ -146,7 +834,13 @@ cdef class StringBuffer:
         if bytes_to_read > 0:
             br = bytes_to_read
         cdef int filedes = fd
-        if self.check_offset(self.s_offset + br):
+        cdef size_t offset = self.s_offset
+        cdef size_t size = self.size
+        self.check_writable()
+        if self.grows:
+            self.advance_write(br) # Make room, the offset is set below
+            self.s_offset = offset
+        elif self.check_offset(self.s_offset + br):
             raise BufferOverflow("read buffer exceeds string buffer size")
 
         while total < br:
@@ -157,6 +851,8 @@ cdef class StringBuffer:
                 if errno != EAGAIN:
                     raise IOError(strerror(errno))
             total += bytes_read
+        if self.grows and self.size > size and self.size > offset + total:
+            self.size = max(size, offset + total) # Hit EOF early
         self.seek(self.s_offset + total)
 
     @classmethod
@@ -185,40 +881,256 @@ cdef class StringBuffer:
             sys.stdout.write('\n')
         # It's always on a word boundary so I don't need to deal with the edge case :)
 
+    cdef Py_ssize_t advance(self, size_t byte_count) except -1:
+        '''
+        Moves the offset past byte_count bytes and returns where it was
+        '''
+        cdef size_t offset = self.s_offset
+        if self.check_offset(offset + byte_count):
+            raise BufferOverflow("Offset exceeds buffer size")
+        self.s_offset = offset + byte_count
+        return offset
+
+    cdef int write_le(self, uint64_t value, int width) except -1:
+        store_le(<unsigned char *> self.buff + self.advance_write(width), value, width)
+        return 0
+
     def read_uint(self, byte_count):
         '''
         Reads an unsigned integer of a specified number of bytes
         '''
-        if self.check_offset(self.s_offset + byte_count):
-            raise BufferOverflow("Offset exceeds buffer size")
-        buf = <bytes> self.buff[self.s_offset : self.s_offset + byte_count]
-        self.s_offset += byte_count
+        if byte_count not in (1, 2, 4, 8):
+            raise IOError("Can't unpack unsigned integer of %s bytes" % byte_count)
+        return uint_object(load_le(<unsigned char *> self.buff + self.advance(byte_count), byte_count))
+
+    # Typed little-endian readers and writers
+
+    def read_u8(self):
+        return uint_object(load_le(<unsigned char *> self.buff + self.advance(1), 1))
+
+    def read_u16(self):
+        return uint_object(load_le(<unsigned char *> self.buff + self.advance(2), 2))
+
+    def read_u32(self):
+        return uint_object(load_le(<unsigned char *> self.buff + self.advance(4), 4))
+
+    def read_u64(self):
+        return uint_object(load_le(<unsigned char *> self.buff + self.advance(8), 8))
+
+    def read_i8(self):
+        return sign_extend(load_le(<unsigned char *> self.buff + self.advance(1), 1), 1)
+
+    def read_i16(self):
+        return sign_extend(load_le(<unsigned char *> self.buff + self.advance(2), 2), 2)
+
+    def read_i32(self):
+        return sign_extend(load_le(<unsigned char *> self.buff + self.advance(4), 4), 4)
+
+    def read_i64(self):
+        return sign_extend(load_le(<unsigned char *> self.buff + self.advance(8), 8), 8)
+
+    def read_f32(self):
+        return load_f32(<unsigned char *> self.buff + self.advance(4))
+
+    def read_f64(self):
+        return load_f64(<unsigned char *> self.buff + self.advance(8))
+
+    def write_u8(self, unsigned char value):
+        self.write_le(value, 1)
+
+    def write_u16(self, uint16_t value):
+        self.write_le(value, 2)
+
+    def write_u32(self, uint32_t value):
+        self.write_le(value, 4)
 
-        if byte_count == 1:
-            return unpack('<B', buf)[0]
-        if byte_count == 2:
-            return unpack('<H', buf)[0]
-        if byte_count == 4:
-            return unpack('<I', buf)[0]
-        if byte_count == 8:
-            return unpack('<Q', buf)[0]
+    def write_u64(self, uint64_t value):
+        self.write_le(value, 8)
 
-        raise IOError("Can't unpack unsigned integer of %s bytes" % byte_count)
+    def write_i8(self, int8_t value):
+        self.write_le(<uint64_t> value, 1)
+
+    def write_i16(self, int16_t value):
+        self.write_le(<uint64_t> value, 2)
+
+    def write_i32(self, int32_t value):
+        self.write_le(<uint64_t> value, 4)
+
+    def write_i64(self, int64_t value):
+        self.write_le(<uint64_t> value, 8)
+
+    def write_f32(self, float value):
+        self.write_le(f32_bits(value), 4)
+
+    def write_f64(self, double value):
+        self.write_le(f64_bits(value), 8)
 
 
     def __len__(self):
         return self.size
 
-    def hash(self):
-        cdef StringBuffer md = StringBuffer(20)
-        cdef PySHA1 sha1 = PySHA1()
+    def hash(self, size_t block_size=HASH_BLOCK_SIZE, digest=MFSDigests.SHA1):
+        '''
+        Returns the digest of the buffer, SHA-1 unless another MFSDigests algorithm is
+        given. The buffer is hashed block_size bytes at a time with the GIL released
+        '''
+        cdef PyDigest md_ctx = PyDigest(MFSDigests.openssl_names[digest])
+        cdef StringBuffer md = StringBuffer(md_ctx.digest_size, zero=False)
         cdef size_t bytes_hashed = 0
         cdef size_t bytes_to_hash
-        while bytes_hashed < self.size:
-            bytes_to_hash = min(self.size - bytes_hashed, 4096)
-            sha1.update(self.buff + bytes_hashed, bytes_to_hash)
-            bytes_hashed += bytes_to_hash
-        sha1.final(<unsigned char *>md.buff)
+        cdef int retval = 1
+        if block_size == 0:
+            raise ValueError('block size must be positive')
+        self.exports += 1 # Pin the memory while the GIL is released
+        try:
+            with nogil:
+                while bytes_hashed < self.size and retval == 1:
+                    bytes_to_hash = min(self.size - bytes_hashed, block_size)
+                    retval = md_ctx.update(self.buff + bytes_hashed, bytes_to_hash)
+                    bytes_hashed += bytes_to_hash
+                if retval == 1:
+                    retval = md_ctx.final(<unsigned char *>md.buff)
+        finally:
+            self.exports -= 1
+        if retval != 1:
+            raise RuntimeError("failed to compute %s digest" % MFSDigests.names[digest])
 
         return md
 
+
+def hash_many(buffers, threads=None, size_t block_size=HASH_BLOCK_SIZE, digest=MFSDigests.SHA1):
+    '''
+    Hashes each buffer (SHA-1 unless another MFSDigests algorithm is given) and
+    returns the digests in the same order. Buffers can be
+    StringBuffers or any object exporting a C-contiguous buffer. The work is
+    shared by a pool of threads, one per CPU unless threads is given, and the
+    GIL is released while hashing so the threads run in parallel.
+    '''
+    buffers = [b if isinstance(b, StringBuffer) else StringBuffer.wrap(b) for b in buffers]
+    if threads is None:
+        threads = cpu_count()
+    threads = min(threads, len(buffers))
+    if threads <= 1:
+        return [b.hash(block_size, digest) for b in buffers]
+
+    digests = [None] * len(buffers)
+    errors = []
+    jobs = iter(xrange(len(buffers))) # Advancing a builtin iterator is atomic under the GIL
+
+    def worker():
+        try:
+            for i in jobs:
+                digests[i] = buffers[i].hash(block_size, digest)
+        except:
+            errors.append(sys.exc_info())
+
+    workers = [Thread(target=worker) for i in xrange(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return digests
+
+
+
+# Scatter/gather I/O
+
+cdef size_t vector_io(int fd, buffers, bint writing, bint positioned, off_t file_offset) except? 0:
+    '''
+    Writes (or reads into) every buffer in order with as few writev/readv
+    calls as possible, at most IOV_MAX buffers go in each call and partial
+    transfers are resumed. Returns the number of bytes transferred, short
+    only when reading hits the end of the file.
+    '''
+    buffers = list(buffers)
+    cdef int n = len(buffers)
+    cdef int flags = PyBUF_C_CONTIGUOUS | (PyBUF_WRITABLE if not writing else 0)
+    cdef Py_buffer *views = <Py_buffer *> malloc(max(n, 1) * sizeof(Py_buffer))
+    cdef iovec *iov = <iovec *> malloc(max(n, 1) * sizeof(iovec))
+    cdef int acquired = 0
+    cdef int i
+    cdef int first = 0
+    cdef int count
+    cdef int iov_max = sysconf(_SC_IOV_MAX)
+    cdef int error = 0
+    cdef ssize_t done = 0
+    cdef size_t total = 0
+    if views == NULL or iov == NULL:
+        free(views)
+        free(iov)
+        raise MemoryError()
+    if iov_max <= 0:
+        iov_max = 1024
+    try:
+        for acquired in range(n):
+            PyObject_GetBuffer(buffers[acquired], &views[acquired], flags)
+            iov[acquired].iov_base = views[acquired].buf
+            iov[acquired].iov_len = views[acquired].len
+        acquired = n
+
+        with nogil:
+            while True:
+                while first < n and iov[first].iov_len == 0:
+                    first += 1
+                if first == n:
+                    break
+                count = min(n - first, iov_max)
+                if writing and positioned:
+                    done = c_pwritev(fd, iov + first, count, file_offset + total)
+                elif writing:
+                    done = c_writev(fd, iov + first, count)
+                elif positioned:
+                    done = c_preadv(fd, iov + first, count, file_offset + total)
+                else:
+                    done = c_readv(fd, iov + first, count)
+                if done < 0:
+                    if errno == EINTR or errno == EAGAIN:
+                        continue
+                    error = errno
+                    break
+                if done == 0: # EOF
+                    break
+                total += done
+                while first < n and <size_t> done >= iov[first].iov_len:
+                    done -= iov[first].iov_len
+                    first += 1
+                if first < n:
+                    iov[first].iov_base = <char *> iov[first].iov_base + done
+                    iov[first].iov_len -= done
+        if error:
+            raise IOError(strerror(error))
+        return total
+    finally:
+        for i in range(acquired):
+            PyBuffer_Release(&views[i])
+        free(views)
+        free(iov)
+
+def writev(fd, buffers):
+    '''
+    Writes the buffers (StringBuffers, whole, or any objects exporting a
+    C-contiguous buffer) to fd back to back without joining them first and
+    returns the number of bytes written. The GIL is released while writing.
+    '''
+    return vector_io(fd, buffers, True, False, 0)
+
+def readv(fd, buffers):
+    '''
+    Fills the writable buffers in order from fd and returns the number of
+    bytes read, which is short only at the end of the file
+    '''
+    return vector_io(fd, buffers, False, False, 0)
+
+def pwritev(fd, buffers, off_t file_offset):
+    '''
+    Like writev but writes at file_offset and leaves the file position alone
+    '''
+    return vector_io(fd, buffers, True, True, file_offset)
+
+def preadv(fd, buffers, off_t file_offset):
+    '''
+    Like readv but reads from file_offset and leaves the file position alone
+    '''
+    return vector_io(fd, buffers, False, True, file_offset)
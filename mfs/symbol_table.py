@@ -7,73 +7,120 @@
 
 from mfs.objects import MFSObject, MFSObjectHeader
 from mfs.exceptions import SerializationError
-from mfs.string_buffer import StringBuffer
 from mfs.types import MFSTypes
 
 class SymbolTableHeader(MFSObjectHeader):
     '''
     Symbol Table Header
     +-----------------------------------------------------------------------------------+
-    |     mfs_type       |    res             |       res          |       res          |
+    |     mfs_type       |    version         |       res          |       res          |
     +-----------------------------------------------------------------------------------+
     |                               entry_no                                            |
     +-----------------------------------------------------------------------------------+
     |                               total_size                                          |
     |                                                                                   |
     +-----------------------------------------------------------------------------------+
+    |                               entries*                                            |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+    |                               name index (entry_no x uint32)                      |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+    |                               idx index (entry_no x uint32)                       |
+    |                                                                                   |
+    +-----------------------------------------------------------------------------------+
+      * - SymbolTableEntry, each aligned on an 8-byte boundary
 
     mfs_type   - MFS Object Type
+    version    - Table version number, currently 1
     res        - reserved
     entry_no   - Number of entries
     total_size - Total size in bytes of table after this field
+
+    The indexes hold the offsets of the entries, relative to the end of the
+    header, sorted by symbol and by idx so a single symbol can be found with a
+    binary search over the serialized table, see find_serialized(). Version 0
+    tables have no indexes, they're upgraded when they're read.
+
+    In memory the entries are also indexed by symbol and idx, find() and
+    lookup() don't scan.
     '''
 
     mfs_type = MFSTypes.SymbolTable
+    version = 1
     entry_no = 0
     total_size = 0
     symbols = None
-    def __init__(self, entry_no=0, total_size=0):
+    by_symbol = None
+    by_idx = None
+    next_idx = 0
+    def __init__(self, entry_no=0, total_size=0, version=1):
         self.entry_no = entry_no
         self.total_size = total_size
+        self.version = version
         self.symbols = []
+        self.by_symbol = {}
+        self.by_idx = {}
+        self.next_idx = 0
 
-    def serialize(self):
-        sb = StringBuffer(16 + self.total_size)
-        sb.pack('<BBHIQ', self.mfs_type, 0, 0, self.entry_no, self.total_size)
+    def serialize_into(self, string_buffer):
+        sb = string_buffer
+        sb.pack('<BBHIQ', self.mfs_type, self.version, 0, self.entry_no, self.total_size)
+        body = sb.offset()
+        offsets = []
         for symbol in self.symbols:
-            sb.write(symbol.serialize())
-        sb.seek(0)
-        return sb
+            offsets.append(sb.offset() - body)
+            symbol.serialize_into(sb)
+        order = range(len(self.symbols))
+        order.sort(key=lambda i: self.symbols[i].symbol)
+        for i in order:
+            sb.write_u32(offsets[i])
+        order.sort(key=lambda i: self.symbols[i].idx)
+        for i in order:
+            sb.write_u32(offsets[i])
 
     @classmethod
     def deserialize(cls, string_buffer):
-        sb = string_buffer
-        mfs_type = sb.read_uint(1)
+        return cls.from_header(*string_buffer.unpack_header('<BBxxIQ'))
+
+    @classmethod
+    def from_header(cls, mfs_type, version, entry_no, total_size):
         if not mfs_type == cls.mfs_type:
             raise TypeError("object is not a symbol table")
-        sb.seek(sb.offset()+3)
-        entry_no = sb.read_uint(4)
-        total_size = sb.read_uint(8)
-        return cls(entry_no, total_size)
+        if version > cls.version:
+            raise TypeError('version mismatch')
+        return cls(entry_no, total_size, version)
     
     def add(self, symbol):
         if isinstance(symbol, basestring):
-            if self.symbols:
-                idx = self.symbols[-1].idx + 1
-            else:
-                idx = 0
             symbol_length = len(symbol)+1
-            symbol = SymbolTableEntry(idx, symbol_length, symbol)
+            symbol = SymbolTableEntry(self.next_idx, symbol_length, symbol)
             return self.add(symbol)
         elif isinstance(symbol, SymbolTableEntry):
             self.entry_no += 1
-            self.total_size += len(symbol)
-            if self.total_size % 8 != 0:
-                self.total_size += 8 - (self.total_size % 8)
+            self.total_size += symbol.serialized_size() + 8 # Plus its slot in each index
+            self.index(symbol)
             self.symbols.append(symbol)
         else:
             raise TypeError("unknown symbol")
 
+    def index(self, symbol):
+        self.by_symbol.setdefault(symbol.symbol, symbol)
+        self.by_idx.setdefault(symbol.idx, symbol)
+        self.next_idx = max(self.next_idx, symbol.idx + 1)
+
+    def find(self, symbol):
+        '''
+        Returns the entry for symbol or None
+        '''
+        return self.by_symbol.get(symbol)
+
+    def lookup(self, idx):
+        '''
+        Returns the entry with index idx or None
+        '''
+        return self.by_idx.get(idx)
+
     def deserialize_table(self, string_buffer):
         sb = string_buffer
 
@@ -83,7 +130,67 @@ class SymbolTableHeader(MFSObjectHeader):
                 o += 8 - (o%8)
                 string_buffer.seek(o)
             symbol = SymbolTableEntry.deserialize(sb)
+            self.index(symbol)
             self.symbols.append(symbol)
+        if self.version == 0:
+            # Indexes are added when the table is written back
+            self.total_size += 8 * self.entry_no
+            self.version = self.__class__.version
+        elif self.entry_no:
+            o = string_buffer.offset()
+            if o % 8 != 0:
+                string_buffer.seek(o + 8 - o % 8)
+            string_buffer.seek(string_buffer.offset() + 8 * self.entry_no)
+
+    def deserialize_body(self, string_buffer):
+        self.deserialize_table(string_buffer)
+
+    @classmethod
+    def find_serialized(cls, string_buffer, symbol):
+        '''
+        Returns the entry for symbol read straight from a serialized table
+        (string_buffer positioned at its header) or None, only the entries
+        visited by the binary search are decoded
+        '''
+        return cls.search_serialized(string_buffer, 0, symbol, lambda entry: entry.symbol)
+
+    @classmethod
+    def lookup_serialized(cls, string_buffer, idx):
+        '''
+        Returns the entry with index idx read straight from a serialized table or None
+        '''
+        return cls.search_serialized(string_buffer, 1, idx, lambda entry: entry.idx)
+
+    @classmethod
+    def search_serialized(cls, string_buffer, index, key, entry_key):
+        # Only positional reads, several threads can search one buffer
+        sb = string_buffer
+        offset = sb.offset()
+        header = cls.from_header(*sb.unpack_header_at('<BBxxIQ', offset))
+        body = offset + 16
+        if header.version == 0:
+            # No indexes to search, decode the whole table
+            try:
+                sb.seek(body)
+                header.deserialize_table(sb)
+            finally:
+                sb.seek(offset)
+            return header.find(key) if index == 0 else header.lookup(key)
+        table = body + header.total_size - 4 * header.entry_no * (2 - index)
+
+        # Lower bound, the first entry of duplicate symbols wins like in memory
+        lo, hi = 0, header.entry_no
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = SymbolTableEntry.deserialize_at(sb, body + sb.read_uint_at(table + 4 * mid, 4))
+            if entry_key(entry) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == header.entry_no:
+            return None
+        entry = SymbolTableEntry.deserialize_at(sb, body + sb.read_uint_at(table + 4 * lo, 4))
+        return entry if entry_key(entry) == key else None
 
     def __len__(self):
         return 16 + self.total_size
@@ -120,22 +227,34 @@ class SymbolTableEntry(MFSObject):
         self.symbol = symbol
 
 
-    def serialize(self):
-        sb = StringBuffer(8 + self.symbol_length)
+    def serialized_size(self):
+        size = 8 + self.symbol_length
+        if size % 8 != 0: # Entries are aligned on an 8-byte boundary
+            size += 8 - size % 8
+        return size
+
+    def serialize_into(self, string_buffer):
+        sb = string_buffer
         sb.pack('<HHI', self.idx, 0, max(len(self.symbol)+1, self.symbol_length)) # Account for null-terminator
         sb.write(self.symbol)
-        sb.seek(0)
-        return sb
+        sb.write('\0' * (self.serialized_size() - 8 - len(self.symbol)))
 
     @classmethod
     def deserialize(cls, string_buffer):
         sb = string_buffer
-        idx = sb.read_uint(2)
-        sb.read_uint(2)
-        symbol_length = sb.read_uint(4)
+        idx, symbol_length = sb.unpack_header('<HxxI')
         symbol = sb.raw_read(symbol_length, strip_null=True)
         return cls(idx,symbol_length,symbol)
 
+    @classmethod
+    def deserialize_at(cls, string_buffer, offset):
+        '''
+        Decodes the entry at offset without moving the buffer's cursor
+        '''
+        idx, symbol_length = string_buffer.unpack_header_at('<HxxI', offset)
+        symbol = string_buffer.raw_read_at(offset + 8, symbol_length, strip_null=True)
+        return cls(idx, symbol_length, symbol)
+
     def __len__(self):
         return 8 + self.symbol_length
 
@@ -1,7 +1,35 @@
 
 class MFSTypes:
-    Nil         = 0x00
-    MerkleNode  = 0x02
-    SymbolTable = 0x03
-    Datatype    = 0x04
-    Dataspace   = 0x05
+    Nil            = 0x00
+    MerkleNode     = 0x02
+    SymbolTable    = 0x03
+    Datatype       = 0x04
+    Dataspace      = 0x05
+    Attribute      = 0x06
+    DataBlock      = 0x07
+    FilterPipeline = 0x08
+
+class MFSDigests:
+    SHA1        = 0x01
+    SHA256      = 0x02
+    BLAKE2B     = 0x03
+
+    names = {
+        SHA1    : 'sha1',
+        SHA256  : 'sha256',
+        BLAKE2B : 'blake2b',
+    }
+
+    # Name OpenSSL knows the algorithm by
+    openssl_names = {
+        SHA1    : 'SHA1',
+        SHA256  : 'SHA256',
+        BLAKE2B : 'BLAKE2b512',
+    }
+
+    # Digest width in bytes
+    sizes = {
+        SHA1    : 20,
+        SHA256  : 32,
+        BLAKE2B : 64,
+    }
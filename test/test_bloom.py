@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file test/test_bloom.py
+@description Bloom filter tests
+'''
+
+from test.test_case import MFSTestCase, attr
+
+from mfs.bloom import BloomFilter, filter_size, buffer_size
+from mfs.drivers.posix.store import ObjectStore
+from mfs.symbol_table import SymbolTableHeader
+from hashlib import sha1
+from tempfile import mkdtemp
+import shutil
+import os
+
+@attr('unit')
+class TestBloomFilter(MFSTestCase):
+    def test_filter(self):
+        bits, hashes = filter_size(1000, 0.01)
+        self.assertEquals(bits % 64, 0)
+        self.assertEquals(hashes, 7)
+        bloom = BloomFilter.create(bytearray(buffer_size(bits)), bits, hashes)
+        self.assertEquals(bloom.memory_usage(), buffer_size(bits))
+
+        new = sum(1 for i in xrange(1000) if not bloom.add(sha1(str(i)).digest()))
+        self.assertTrue(new > 990)
+        self.assertEquals(bloom.count, new)
+        self.assertTrue(bloom.add(sha1('0').digest()))
+        self.assertEquals(bloom.count, new)
+        for i in xrange(1000):
+            self.assertTrue(sha1(str(i)).digest() in bloom)
+
+        self.assertTrue(0.005 < bloom.false_positive_rate() < 0.02)
+        false_positives = sum(1 for i in xrange(1000, 11000) if sha1(str(i)).digest() in bloom)
+        self.assertTrue(false_positives < 300)
+
+        # The filter lives entirely in the buffer
+        buf = bytearray(bloom.buffer)
+        self.assertTrue(sha1('1').digest() in BloomFilter(buf))
+        self.assertEquals(BloomFilter(buf).count, new)
+        self.assertRaises(TypeError, BloomFilter, bytearray(64))
+
+@attr('unit')
+class TestStoreFilter(MFSTestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_store_filter(self):
+        store = ObjectStore(self.path)
+        st = SymbolTableHeader()
+        st.add('root')
+        sha = store.write(st.serialize())
+        self.assertTrue(sha in store.filter)
+        self.assertEquals(store.filter.count, 1)
+        self.assertFalse(store.exists(sha1('missing').digest()))
+
+        # Updates go straight to the mapped file
+        store = ObjectStore(self.path)
+        self.assertTrue(sha in store.filter)
+        self.assertTrue(store.exists(sha))
+
+        # Stores without a filter get one built from their objects
+        os.unlink(os.path.join(store.path, 'bloom'))
+        store.repack()
+        store = ObjectStore(self.path)
+        self.assertTrue(sha in store.filter)
+        self.assertEquals(store.filter.count, 1)
+
+        store.rebuild_filter(4 << 20)
+        self.assertTrue(sha in store.filter)
+        self.assertTrue(store.filter.bits >= filter_size(4 << 20, store.bloom_fp_rate)[0])
+
+    def test_replaced_filter(self):
+        # Stores sharing the path follow a filter rebuilt by another store
+        a = ObjectStore(self.path)
+        b = ObjectStore(self.path)
+        old = b.filter
+        a.rebuild_filter()
+        self.assertTrue(old.retired)
+        self.assertFalse(a.filter.retired)
+
+        st = SymbolTableHeader()
+        st.add('after rebuild')
+        sha = b.write(st.serialize())
+        self.assertFalse(b.filter is old)
+        self.assertTrue(a.exists(sha))
+        self.assertTrue(sha in a.filter)
+
+        # A store that only reads switches at its next miss
+        a.rebuild_filter()
+        self.assertTrue(b.exists(sha))
+        self.assertTrue(b.filter.retired) # Hits don't need the new filter
+        self.assertFalse(b.exists(sha1('missing').digest()))
+        self.assertFalse(b.filter.retired)
+        self.assertTrue(b.exists(sha))
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file test/test_cache.py
+@description Chunk cache tests
+'''
+
+from test.test_case import MFSTestCase, attr
+
+from mfs.drivers.posix.cache import ChunkCache
+from mfs.drivers.posix.dataset import Dataset
+from mfs.drivers.posix.store import ObjectStore
+from mfs.datatype import MFSDoubleType
+from threading import Thread
+from tempfile import mkdtemp
+import shutil
+
+@attr('unit')
+class TestChunkCache(MFSTestCase):
+    def test_lru(self):
+        cache = ChunkCache(100)
+        cache.put('a', 'A', 40)
+        cache.put('b', 'B', 40)
+        self.assertEquals(cache.get('a'), 'A') # b is now the least recently used
+        cache.put('c', 'C', 40)
+        self.assertFalse('b' in cache)
+        self.assertEquals(cache.get('b'), None)
+        self.assertEquals((cache.get('a'), cache.get('c')), ('A', 'C'))
+        self.assertEquals(cache.stats(), {'hits' : 3, 'misses' : 1, 'evictions' : 1,
+                                          'chunks' : 2, 'size' : 80, 'capacity' : 100})
+
+        cache.put('a', 'A2', 10) # Replacing adjusts the size
+        self.assertEquals(cache.size, 50)
+        cache.put('d', 'D', 101) # Larger than the whole cache
+        self.assertFalse('d' in cache)
+        self.assertEquals(len(cache), 2)
+        cache.clear()
+        self.assertEquals((len(cache), cache.size, cache.hits), (0, 0, 3))
+
+    def test_threads(self):
+        cache = ChunkCache(1000)
+        def worker(k):
+            for i in xrange(2000):
+                key = (k * 7 + i) % 50
+                if cache.get(key) is None:
+                    cache.put(key, key, 30)
+        threads = [Thread(target=worker, args=(k,)) for k in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertTrue(cache.size <= 1000)
+        self.assertEquals(cache.size, 30 * len(cache))
+        self.assertEquals(cache.hits + cache.misses, 8000)
+
+    def test_dataset(self):
+        path = mkdtemp()
+        try:
+            store = ObjectStore(path)
+            dataset = Dataset(store, shape=(40, 40), datatype=MFSDoubleType(), chunks=(10, 10))
+            dataset.write(''.join(chr(i % 251) for i in xrange(40 * 40 * 8)))
+            sha = dataset.commit()
+
+            loads = []
+            load = store.load
+            def counting_load(sha):
+                loads.append(sha)
+                return load(sha)
+            store.load = counting_load
+
+            cache = ChunkCache(4 * 800)
+            reopened = Dataset(store, sha, cache=cache)
+            del loads[:]
+            first = reopened.read((0, 0), (20, 15))
+            self.assertEquals(len(loads), 1 + 4) # The page and 2 x 2 chunks
+            self.assertEquals(reopened.read((0, 0), (20, 15)), first)
+            self.assertEquals(len(loads), 5) # Served from the cache
+            self.assertEquals(cache.stats()['hits'], 4)
+
+            reopened.read((20, 0), (20, 15)) # Evicts the first 4 chunks
+            self.assertEquals(len(loads), 9)
+            self.assertEquals(cache.stats()['evictions'], 4)
+            self.assertEquals(reopened.read((0, 0), (20, 15)), first)
+            self.assertEquals(len(loads), 13)
+        finally:
+            shutil.rmtree(path)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file test/test_collector.py
+@description Garbage collector tests
+'''
+
+from test.test_case import MFSTestCase, attr
+
+from mfs.drivers.posix.store import ObjectStore
+from mfs.drivers.posix.collector import GarbageCollector
+from mfs.drivers.posix import collector
+from mfs.node import MerkleNode, MerkleNodeHeader
+from mfs.symbol_table import SymbolTableHeader
+from tempfile import mkdtemp
+import shutil
+import time
+import os
+
+@attr('unit')
+class TestGarbageCollector(MFSTestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        self.store = ObjectStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def symbol_table(self, name):
+        st = SymbolTableHeader()
+        st.add(name)
+        return st
+
+    def build_tree(self):
+        '''
+        Returns the root and the digests of the objects it stops referencing
+        once its first subtree is deleted and its last leaf replaced
+        '''
+        root = MerkleNodeHeader()
+        for i in xrange(3):
+            mid = MerkleNodeHeader()
+            for j in xrange(3):
+                st = self.symbol_table('leaf %d.%d' % (i, j))
+                mid.add_child(MerkleNode(st.mfs_type, 0, 0, None, st))
+            root.add_child(MerkleNode(mid.mfs_type, 0, 0, None, mid))
+        root.commit(self.store)
+
+        garbage = [root.sha, root.objects[0].sha, root.objects[2].sha]
+        garbage += [o.sha for o in root.objects[0].obj.objects]
+        garbage.append(root.objects[2].obj.objects[2].sha)
+
+        root.delete_child(root.objects[0].sha)
+        root.objects[2].obj.set_child(2, self.symbol_table('replaced'))
+        root.commit(self.store)
+        return root, garbage
+
+    def age(self, seconds=7200):
+        then = time.time() - seconds
+        for sha in self.store.loose_objects():
+            os.utime(self.store.object_path(sha), (then, then))
+
+    def reachable(self, root):
+        shas = [root.sha]
+        for o in root.objects[1:]:
+            shas.append(o.sha)
+            shas.extend(c.sha for c in o.obj.objects)
+        return shas
+
+    def test_loose(self):
+        root, garbage = self.build_tree()
+        self.age()
+        gc = GarbageCollector(self.store, [root.sha])
+        gc.collect()
+
+        self.assertEquals(gc.swept_loose, len(garbage))
+        self.assertEquals(gc.marked, 9)
+        for sha in garbage:
+            self.assertFalse(self.store.exists(sha))
+        for sha in self.reachable(root):
+            self.assertTrue(self.store.exists(sha))
+        self.assertEquals(sorted(self.store.objects()), sorted(self.reachable(root)))
+
+    def test_packed(self):
+        root, garbage = self.build_tree()
+        self.store.repack()
+        gc = GarbageCollector(self.store, [root.sha])
+        gc.collect()
+
+        self.assertEquals(gc.swept_packed, len(garbage))
+        self.assertEquals(gc.packs_rewritten, 1)
+        self.assertEquals(len(self.store.packs), 1)
+        self.assertEquals(sorted(self.store.packs[0]), sorted(self.reachable(root)))
+        for sha in garbage:
+            self.assertFalse(self.store.exists(sha))
+
+        # Nothing left to collect
+        gc = GarbageCollector(self.store, [root.sha])
+        gc.collect()
+        self.assertEquals(gc.packs_rewritten, 0)
+
+        # An unreferenced root takes everything with it
+        gc = GarbageCollector(self.store, [])
+        gc.collect()
+        self.assertEquals(self.store.packs, [])
+
+    def test_grace_period(self):
+        root, garbage = self.build_tree()
+        gc = GarbageCollector(self.store, [root.sha])
+        gc.collect()
+        self.assertEquals(gc.swept_loose, 0)
+        for sha in garbage:
+            self.assertTrue(self.store.exists(sha))
+
+    def test_incremental(self):
+        root, garbage = self.build_tree()
+        self.age()
+        gc = GarbageCollector(self.store, [root.sha])
+        steps = 0
+        while not gc.step(0):
+            steps += 1
+            # Readers keep working between slices
+            self.assertEquals(self.store.load(root.sha).children, 3)
+        self.assertTrue(steps > 5)
+        self.assertEquals(gc.swept_loose, len(garbage))
+
+    def test_written_during_collection(self):
+        root, garbage = self.build_tree()
+        self.age()
+        gc = GarbageCollector(self.store, [])
+        gc.step(0)
+        # A new root picks up an otherwise unreachable subtree mid collection
+        node = MerkleNodeHeader()
+        node.add_child(MerkleNode(root.objects[1].mfs_type, 0, 0, root.objects[1].sha))
+        sha = node.commit(self.store)
+        gc.collect()
+        self.assertTrue(self.store.exists(sha))
+        self.assertTrue(self.store.exists(root.objects[1].sha))
+        self.assertFalse(self.store.exists(root.sha))
+
+    def test_reused_during_sweep(self):
+        # Writers that reuse unreachable objects after the remark keep them
+        root, garbage = self.build_tree()
+        self.store.repack()
+        packed = self.symbol_table('packed')
+        loose = self.symbol_table('loose')
+        packed_sha = self.store.write(packed.serialize())
+        self.store.repack()
+        loose_sha = self.store.write(loose.serialize())
+        self.age()
+
+        gc = GarbageCollector(self.store, [root.sha])
+        while gc.phase not in (gc.SWEEP_LOOSE, gc.DONE):
+            gc.step(0)
+        self.assertEquals(gc.phase, gc.SWEEP_LOOSE)
+        node = MerkleNodeHeader()
+        node.add_child(MerkleNode(packed.mfs_type, 0, 0, None, packed))
+        node.add_child(MerkleNode(loose.mfs_type, 0, 0, None, loose))
+        sha = node.commit(self.store)
+        gc.collect()
+
+        for digest in (sha, packed_sha, loose_sha):
+            self.assertTrue(self.store.exists(digest))
+        self.assertEquals(sorted(self.store.loose_objects()), sorted([loose_sha, sha]))
+        self.assertFalse(os.path.exists(self.store.journal_path()))
+        self.assertIsNotNone(self.store.load(sha).load_child(0, self.store).find('packed'))
+        for digest in garbage:
+            self.assertFalse(self.store.exists(digest))
+
+    def test_reused_during_pack_rewrite(self):
+        root, garbage = self.build_tree()
+        self.store.repack()
+        gc = GarbageCollector(self.store, [root.sha])
+        while gc.phase != gc.SWEEP_PACKS:
+            gc.step(0)
+
+        # A writer reuses a garbage subtree while its pack is being rewritten
+        subtree = self.store.load(garbage[1])
+        reused = []
+        original = collector.write_pack
+        def write_pack(pack_dir, objects, digest):
+            if not reused:
+                node = MerkleNodeHeader()
+                node.add_child(MerkleNode(subtree.mfs_type, 0, 0, None, subtree))
+                reused.append(node.commit(self.store))
+            return original(pack_dir, objects, digest)
+        collector.write_pack = write_pack
+        try:
+            gc.collect()
+        finally:
+            collector.write_pack = original
+
+        self.assertTrue(self.store.exists(reused[0]))
+        for o in subtree.objects:
+            self.assertTrue(self.store.exists(o.sha))
+        self.assertEquals(gc.swept_packed, len(garbage) - 1 - subtree.children)
+        self.assertEquals(len(self.store.packs), 1) # The first rewrite was dropped
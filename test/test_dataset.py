@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file test/test_dataset.py
+@description Chunked dataset tests
+'''
+
+from test.test_case import MFSTestCase, attr
+
+from mfs.drivers.posix.dataset import Dataset, guess_chunks, copy_box, strides
+from mfs.drivers.posix.datablock import ChunkIndex
+from mfs.drivers.posix.cache import ChunkCache
+from mfs.node import MerkleChildren
+from mfs.drivers.posix.store import ObjectStore
+from mfs.hl.dataset import MFSDataset
+from mfs.selection import Hyperslab
+from mfs.datablock import DataBlockHeader
+from mfs.datatype import MFSUShortType, MFSDoubleType, np
+from mfs.types import MFSTypes
+from itertools import product
+from struct import pack, unpack
+from tempfile import mkdtemp
+from unittest import skipIf
+import shutil
+import random
+
+@attr('unit')
+class TestDataset(MFSTestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        self.store = ObjectStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def region(self, reference, shape, start, count):
+        # Reads a region out of a flat row-major list
+        values = []
+        for index in product(*[xrange(o, o + c) for o, c in zip(start, count)]):
+            values.append(reference[sum(i * s for i, s in zip(index, strides(shape, 1)))])
+        return values
+
+    def test_guess_chunks(self):
+        self.assertEquals(guess_chunks((10, 10), 8), (10, 10))
+        chunks = guess_chunks((1000, 1000), 8)
+        self.assertTrue(chunks[0] * chunks[1] * 8 <= 64 * 1024)
+        self.assertEquals(guess_chunks((), 8), ())
+        self.assertEquals(guess_chunks((0, 3), 8), (1, 3))
+
+    def test_copy_box(self):
+        src = bytearray(range(24)) # 2 x 3 x 4
+        dst = bytearray(24)
+        copy_box(src, (2, 3, 4), (0, 0, 0), dst, (2, 3, 4), (0, 0, 0), (2, 3, 4), 1)
+        self.assertEquals(dst, src)
+        dst = bytearray(4)
+        copy_box(src, (2, 3, 4), (1, 1, 1), dst, (1, 2, 2), (0, 0, 0), (1, 2, 2), 1)
+        self.assertEquals(list(dst), [17, 18, 21, 22])
+
+    def test_read_write(self):
+        shape, chunks = (10, 7, 5), (4, 3, 2)
+        dataset = Dataset(self.store, shape=shape, datatype=MFSUShortType(), chunks=chunks)
+        self.assertEquals(dataset.chunk_count(), 3 * 3 * 3)
+        reference = [0] * (10 * 7 * 5)
+        self.assertEquals(dataset.read(), bytearray(2 * len(reference)))
+
+        rng = random.Random(7)
+        for i in xrange(40):
+            start = tuple(rng.randrange(s) for s in shape)
+            count = tuple(rng.randrange(1, s - o + 1) for o, s in zip(start, shape))
+            values = [rng.randrange(1 << 16) for j in xrange(count[0] * count[1] * count[2])]
+            dataset.write(pack('<%dH' % len(values), *values), start, count)
+            for index, value in zip(product(*[xrange(o, o + c) for o, c in zip(start, count)]), values):
+                reference[index[0] * 35 + index[1] * 5 + index[2]] = value
+
+            start = tuple(rng.randrange(s) for s in shape)
+            count = tuple(rng.randrange(1, s - o + 1) for o, s in zip(start, shape))
+            data = dataset.read(start, count)
+            self.assertEquals(list(unpack('<%dH' % (len(data) // 2), str(data))), self.region(reference, shape, start, count))
+
+        sha = dataset.commit()
+        reopened = Dataset(self.store, sha)
+        self.assertEquals((reopened.shape, reopened.chunks, reopened.element_size), (shape, chunks, 2))
+        self.assertEquals(list(unpack('<350H', str(reopened.read()))), reference)
+
+    def test_selection(self):
+        shape, chunks = (20, 9, 6), (4, 4, 4)
+        dataset = Dataset(self.store, shape=shape, datatype=MFSUShortType(), chunks=chunks)
+        reference = range(20 * 9 * 6)
+        dataset.write(pack('<%dH' % len(reference), *reference))
+        dataset.commit()
+
+        reads = []
+        entry = dataset.index.entry
+        def counting_entry(n):
+            reads.append(n)
+            return entry(n)
+        dataset.index.entry = counting_entry
+
+        selection = Hyperslab((1, 2, 0), (4, 2, 3), (5, 3, 2), (2, 1, 1))
+        data = dataset.read_selection(selection)
+        expected = []
+        for i in product(*[[o + k * s + j for k in xrange(c) for j in xrange(b)]
+                           for o, c, s, b in zip(selection.start, selection.count, selection.stride, selection.block)]):
+            expected.append(reference[i[0] * 54 + i[1] * 6 + i[2]])
+        self.assertEquals(list(unpack('<%dH' % len(expected), str(data))), expected)
+        self.assertEquals(len(reads), len(set(reads))) # Each chunk read once
+
+        # One column only reads the chunks along it
+        del reads[:]
+        column = dataset.read_selection(Hyperslab((0, 5, 3), (20, 1, 1)))
+        self.assertEquals(list(unpack('<20H', str(column))), [reference[i * 54 + 5 * 6 + 3] for i in xrange(20)])
+        self.assertEquals(len(reads), 5)
+
+        # Into a preallocated buffer, unwritten chunks are zeroed
+        empty = Dataset(self.store, shape=shape, datatype=MFSUShortType(), chunks=chunks)
+        out = bytearray('\xff' * 40)
+        self.assertTrue(empty.read_selection(Hyperslab((0, 5, 3), (20, 1, 1)), out) is out)
+        self.assertEquals(out, bytearray(40))
+        self.assertRaises(ValueError, dataset.read_selection, Hyperslab((0, 5, 3), (20, 1, 1)), bytearray(39))
+        self.assertRaises(ValueError, dataset.read_selection, Hyperslab((0, 5, 3), (21, 1, 1)))
+
+        hl = MFSDataset(self.store, sha=dataset.commit())
+        self.assertEquals(hl[:, 5, 3], column)
+        self.assertEquals(hl.get((0, 5, 3), (20, 1, 1)), column)
+        self.assertEquals(hl.get((1, 2, 0), (4, 2, 3), (5, 3, 2), (2, 1, 1)), data)
+        self.assertEquals(len(hl.get((0, 0, 0), stride=(7, 1, 1))), 3 * 9 * 6 * 2)
+
+    def test_touched_chunks(self):
+        dataset = Dataset(self.store, shape=(100, 100), datatype=MFSDoubleType(), chunks=(10, 10))
+        dataset.write('\x01' * 8 * 100 * 100)
+        dataset.commit()
+        writes = []
+        write = self.store.write
+        def counting_write(sb):
+            writes.append(sb)
+            return write(sb)
+        self.store.write = counting_write
+
+        dataset.write('\x02' * 8 * 3, (15, 27), (1, 3))
+        dataset.commit()
+        # The patched block, its page, the index root and the dataset node
+        self.assertEquals(len(writes), 4)
+        self.assertEquals(dataset.read((15, 26), (1, 5)), bytearray('\x01' * 8 + '\x02' * 24 + '\x01' * 8))
+
+    def test_dedup(self):
+        dataset = Dataset(self.store, shape=(64, 64), datatype=MFSDoubleType(), chunks=(8, 8))
+        dataset.write('\x07' * 8 * 64 * 64)
+        dataset.commit()
+        shas = set(dataset.index.sha(n) for n in xrange(dataset.chunk_count()))
+        self.assertEquals(len(shas), 1)
+        self.assertEquals(len([sha for sha in self.store.objects()]), 1 + 1 + 1 + 3 + 1) # Block, page, root, header objects, node
+
+    def test_missing_chunks(self):
+        dataset = Dataset(self.store, shape=(3000,), datatype=MFSUShortType(), chunks=(1,))
+        self.assertEquals(dataset.index.root.children, 3)
+        dataset.write('ab', (2500,), (1,))
+        sha = dataset.commit()
+        root = dataset.index.root
+        self.assertEquals([o.mfs_type for o in root.objects], [MFSTypes.Nil, MFSTypes.Nil, MFSTypes.MerkleNode])
+        self.assertEquals(dataset.index.get(0), None)
+        self.assertEquals(Dataset(self.store, sha).read((2499,), (3,)), bytearray('\0\0ab\0\0'))
+
+        # Clearing the only chunk of a page clears the page
+        dataset.index.set(2500, None)
+        self.assertEquals(root.objects[2].mfs_type, MFSTypes.Nil)
+        self.assertEquals(dataset.commit(), Dataset(self.store, shape=(3000,), datatype=MFSUShortType(), chunks=(1,)).commit())
+
+    def test_scalar(self):
+        dataset = Dataset(self.store, shape=(), datatype=MFSDoubleType())
+        dataset.write(pack('<d', 2.5))
+        self.assertEquals(unpack('<d', str(Dataset(self.store, dataset.commit()).read())), (2.5,))
+
+    def test_errors(self):
+        self.assertRaises(ValueError, Dataset, self.store, shape=(10,))
+        self.assertRaises(ValueError, Dataset, self.store, shape=(10,), datatype=MFSDoubleType(), chunks=(0,))
+        self.assertRaises(ValueError, Dataset, self.store, shape=(1 << 40,), datatype=MFSDoubleType(), chunks=(1,))
+        dataset = Dataset(self.store, shape=(10,), datatype=MFSDoubleType())
+        self.assertRaises(ValueError, dataset.read, (5,), (6,))
+        self.assertRaises(ValueError, dataset.write, 'x' * 8, (0,), (2,))
+        self.assertRaises(ValueError, dataset.write, 'x' * 8, (0, 0), (1, 1))
+        self.assertRaises(IndexError, ChunkIndex(self.store, 4).get, 4)
+
+    def test_datablock(self):
+        block = DataBlockHeader('hello')
+        sb = block.serialize()
+        self.assertEquals(sb.buffer_size(), 24)
+        header = DataBlockHeader.deserialize(sb)
+        header.deserialize_body(sb)
+        self.assertEquals(header.data.tobytes(), 'hello')
+
+    def test_hl(self):
+        dataset = MFSDataset(self.store, 100, MFSUShortType(), chunks=16)
+        self.assertEquals((dataset.shape, dataset.chunks), ((100,), (16,)))
+        dataset.set(pack('<10H', *range(10)), 45, 10)
+        sha = dataset.commit()
+        dataset = MFSDataset(self.store, sha=sha)
+        self.assertEquals(unpack('<12H', str(dataset.get(44, 12))), tuple([0] + range(10) + [0]))
+        self.assertEquals(unpack('<10H', str(dataset.get(45, 2, block=5))), tuple(range(10)))
+        self.assertEquals(len(dataset.get(45, block=5)), 11 * 5 * 2) # 11 blocks of 5 fit
+
+    @skipIf(np is None, 'numpy is not installed')
+    def test_hl_arrays(self):
+        dataset = MFSDataset(self.store, (10, 12), MFSDoubleType(), chunks=(5, 4))
+        reference = np.arange(120, dtype=np.float64).reshape(10, 12) / 4
+        dataset.set(reference)
+        dataset.set(np.array([[-1, -2]], dtype='>f4'), (9, 10)) # Converted and swapped
+        reference[9, 10:] = (-1, -2)
+        self.assertRaises(TypeError, dataset.set, np.zeros((2, 2), dtype=np.complex128), (0, 0))
+
+        dataset = MFSDataset(self.store, sha=dataset.commit())
+        array = dataset.read_array()
+        self.assertEquals((array.dtype, array.shape), (np.dtype('<f8'), (10, 12)))
+        self.assertTrue((array == reference).all())
+        self.assertTrue(array.flags.writeable)
+        self.assertTrue((dataset.read_array((1, 0), stride=(3, 5)) == reference[1::3, ::5]).all())
+        self.assertEquals(str(dataset.get((2, 3), (4, 5))), reference[2:6, 3:8].tobytes())
+
+        # A whole chunk is a view of the chunk
+        chunk = dataset.read_array((5, 4), (5, 4))
+        self.assertTrue((chunk == reference[5:, 4:8]).all())
+        self.assertFalse(chunk.flags.writeable)
+        self.assertFalse(chunk.flags.owndata)
+        empty = MFSDataset(self.store, 8, np.uint16, chunks=4)
+        self.assertTrue((empty.read_array(4, 4) == 0).all())
+
+    def test_lazy_open(self):
+        # Reading one chunk decodes no child list on the way to it
+        dataset = Dataset(self.store, shape=(64, 64), datatype=MFSUShortType(), chunks=(4, 4))
+        dataset.write(pack('<4096H', *range(4096)))
+        dataset = Dataset(self.store, dataset.commit(), cache=ChunkCache())
+        self.assertEquals(unpack('<4H', str(dataset.read((4, 4), (1, 4)))), tuple(range(260, 264)))
+        self.assertIsInstance(dataset.node.objects, MerkleChildren)
+        self.assertIsInstance(dataset.index.root.objects, MerkleChildren)
+        self.assertIsInstance(dataset.index.page(0, False).objects, MerkleChildren)
@@ -9,11 +9,12 @@ from test.test_case import MFSTestCase
 from test.performance import PerformanceTestCase
 from mfs.datatype import DatatypeHeader, MFSUByteType, MFSByteType, MFSUShortType
 from mfs.datatype import MFSShortType, MFSUIntType, MFSIntType, MFSUInt64Type, MFSInt64Type
-from mfs.datatype import MFSFloat32Type, MFSDoubleType, MFSStringType
+from mfs.datatype import MFSFloat32Type, MFSDoubleType, MFSStringType, StringEncoding, np
 from mfs.objects import MFSObjectHeader
 from mfs.string_buffer import StringBuffer
 from tempfile import TemporaryFile
 from nose.plugins.attrib import attr
+from unittest import skipIf
 
 
 @attr('unit')
@@ -81,6 +82,31 @@ class TestDatatype(MFSTestCase):
             dtype_h = MFSInt64Type()
             self.header_check(f, dtype_h, 7, 1, 8, 0)
 
+    @skipIf(np is None, 'numpy is not installed')
+    def test_numpy_dtype(self):
+        types = [(MFSUByteType, 'u1'), (MFSByteType, 'i1'), (MFSUShortType, 'u2'), (MFSShortType, 'i2'),
+                 (MFSUIntType, 'u4'), (MFSIntType, 'i4'), (MFSUInt64Type, 'u8'), (MFSInt64Type, 'i8'),
+                 (MFSFloat32Type, 'f4'), (MFSDoubleType, 'f8')]
+        for dtype_class, code in types:
+            self.assertEquals(dtype_class().numpy_dtype(), np.dtype('<' + code))
+            for order in '<>=':
+                dtype_h = DatatypeHeader.from_numpy(order + code)
+                self.assertIsInstance(dtype_h, dtype_class)
+                self.assertEquals(dtype_h.flags, dtype_class().flags)
+        self.assertIsInstance(DatatypeHeader.from_numpy(np.bool_), MFSUByteType)
+
+        self.assertEquals(DatatypeHeader(0x10, 0, 12).numpy_dtype(), np.dtype('S12'))
+        self.assertEquals(DatatypeHeader.from_numpy('S12').size, 12)
+        self.assertRaises(TypeError, DatatypeHeader(0x09, 0, 4).numpy_dtype)
+        self.assertRaises(TypeError, DatatypeHeader(0x05, 0x00, 4).numpy_dtype) # Unsigned int32
+        self.assertRaises(TypeError, DatatypeHeader(0x04, 0x01, 4).numpy_dtype) # Signed uint32
+        self.assertRaises(TypeError, DatatypeHeader(0x09, 0x01, 8).numpy_dtype)
+        self.assertRaises(TypeError, DatatypeHeader(0x10, 0x20, 4).numpy_dtype)
+        self.assertEquals(MFSStringType(StringEncoding.UTF8).numpy_dtype(), np.dtype('S1'))
+        self.assertRaises(TypeError, DatatypeHeader(0x20, 0, 4).numpy_dtype)
+        self.assertRaises(TypeError, DatatypeHeader.from_numpy, 'c16')
+        self.assertRaises(TypeError, DatatypeHeader.from_numpy, object)
+
 @attr('perf')
 class DatatypePerformance(PerformanceTestCase):
     def create_datatype(self, dtype_class):
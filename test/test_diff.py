@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file test/test_diff.py
+@description Merkle diff tests
+'''
+
+from test.test_case import MFSTestCase, attr
+
+from mfs.diff import diff, MerkleChange
+from mfs.node import MerkleNode, MerkleNodeHeader
+from mfs.symbol_table import SymbolTableHeader
+from mfs.drivers.posix.store import ObjectStore
+from mfs.hamt import MerkleTrie
+from hashlib import sha1
+from tempfile import mkdtemp
+import shutil
+
+@attr('unit')
+class TestDiff(MFSTestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        self.store = ObjectStore(self.path)
+        self.loads = []
+        load = self.store.load
+        def counting_load(sha):
+            self.loads.append(sha)
+            return load(sha)
+        self.store.load = counting_load
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def symbol_table(self, name):
+        st = SymbolTableHeader()
+        st.add(name)
+        return st
+
+    def build_tree(self):
+        root = MerkleNodeHeader()
+        for i in xrange(4):
+            mid = MerkleNodeHeader()
+            for j in xrange(4):
+                st = self.symbol_table('leaf %d.%d' % (i, j))
+                mid.add_child(MerkleNode(st.mfs_type, 0, 0, None, st))
+            root.add_child(MerkleNode(mid.mfs_type, 0, 0, None, mid))
+        return root
+
+    def test_identical(self):
+        sha = self.build_tree().commit(self.store)
+        self.assertEquals(list(diff(self.store, sha, sha)), [])
+        self.assertEquals(self.loads, [])
+
+    def test_diff(self):
+        root = self.build_tree()
+        old_sha = root.commit(self.store)
+
+        mid = root.objects[2].obj
+        mid.set_child(1, self.symbol_table('changed'))
+        st = self.symbol_table('new')
+        mid.add_child(MerkleNode(st.mfs_type, 0, 0, None, st))
+        root.objects[0].obj.delete_child(root.objects[0].obj.objects[3].sha)
+        new_sha = root.commit(self.store)
+
+        changes = list(diff(self.store, old_sha, new_sha))
+        self.assertEquals([(c.status, c.path) for c in changes], [
+            (MerkleChange.REMOVED, (0, 3)),
+            (MerkleChange.MODIFIED, (2, 1)),
+            (MerkleChange.ADDED, (2, 4)),
+        ])
+        self.assertEquals(changes[1].new, mid.objects[1].sha)
+        # Both roots plus the two changed subtrees, the untouched ones are pruned
+        self.assertEquals(len(self.loads), 6)
+
+        changes = list(diff(self.store, new_sha, old_sha))
+        self.assertEquals([c.status for c in changes], [MerkleChange.ADDED, MerkleChange.MODIFIED, MerkleChange.REMOVED])
+
+    def test_trie(self):
+        # One insert into a trie is one change, wherever it shifts the children
+        member = lambda i: MerkleNode(3, 0, 0, sha1(str(i)).digest())
+        trie = MerkleTrie(self.store, leaf_capacity=64)
+        for i in xrange(49):
+            trie.add(member(i))
+        old = trie.commit()
+        trie.add(member(49))
+        new = trie.commit()
+        self.assertEquals(list(diff(self.store, old, new)),
+                          [MerkleChange(MerkleChange.ADDED, (sorted(member(i).sha for i in xrange(50)).index(member(49).sha),),
+                                        None, member(49).sha)])
+
+        # Across a split, and within the branches after it
+        for i in xrange(50, 70):
+            trie.add(member(i))
+        split = trie.commit()
+        self.assertTrue(trie.root.flags & MerkleNodeHeader.BRANCH)
+        self.assertEquals(sorted(c.new for c in diff(self.store, new, split)), sorted(member(i).sha for i in xrange(50, 70)))
+        trie.remove(member(3).sha)
+        trie.add(member(70))
+        changes = list(diff(self.store, split, trie.commit()))
+        self.assertEquals(sorted((c.status, c.old, c.new) for c in changes),
+                          sorted([(MerkleChange.ADDED, None, member(70).sha), (MerkleChange.REMOVED, member(3).sha, None)]))
+        self.assertTrue(all(len(c.path) == 2 for c in changes))
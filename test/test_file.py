@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file test/test_file.py
+@description Merkle File and object store tests
+'''
+
+from test.test_case import MFSTestCase, attr
+
+from mfs.file import MerkleFile
+from mfs.node import MerkleNode, MerkleNodeHeader
+from mfs.symbol_table import SymbolTableHeader
+from mfs.exceptions import ObjectNotFound, MFSException
+from mfs.types import MFSDigests
+from binascii import hexlify
+from hashlib import sha1
+from tempfile import mkdtemp
+import shutil
+import os
+
+@attr('unit')
+class TestMerkleFile(MFSTestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_write_read(self):
+        mnode = MerkleNodeHeader()
+        for i in xrange(3):
+            mnode.add_child(MerkleNode(3, 0, 0, sha1(str(i)).digest()))
+
+        mfile = MerkleFile(self.path, mnode)
+        sha = mfile.write()
+        self.assertEquals(sha, sha1(mnode.serialize().raw_read()).digest())
+
+        hex_sha = hexlify(sha)
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'objects', hex_sha[:2], hex_sha[2:])))
+
+        mnode_header = mfile.read(sha)
+        self.assertIsInstance(mnode_header, MerkleNodeHeader)
+        self.assertEquals(mnode_header.children, 3)
+        self.assertEquals([o.sha for o in mnode_header.objects], [o.sha for o in mnode.objects])
+
+    def test_dedup(self):
+        st = SymbolTableHeader()
+        st.add('root')
+        st.add('time')
+
+        mfile = MerkleFile(self.path, st)
+        sha = mfile.write()
+        path = mfile.store.object_path(sha)
+        inode = os.stat(path).st_ino
+
+        self.assertEquals(MerkleFile(self.path, st).write(), sha)
+        self.assertEquals(os.stat(path).st_ino, inode)
+        self.assertEquals(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+
+        header = mfile.read(sha)
+        self.assertEquals([s.symbol for s in header.symbols], ['root', 'time'])
+
+    def test_missing(self):
+        mfile = MerkleFile(self.path)
+        self.assertRaises(ObjectNotFound, mfile.read, sha1('missing').digest())
+
+    def test_digest(self):
+        mnode = MerkleNodeHeader(MFSDigests.BLAKE2B)
+        mnode.add_child(MerkleNode(3, 0, 0, '\x01' * 64))
+
+        mfile = MerkleFile(self.path, mnode, MFSDigests.BLAKE2B)
+        sha = mfile.write()
+        self.assertEquals(len(sha), 64)
+        self.assertTrue(os.path.exists(mfile.store.object_path(sha)))
+
+        mfile = MerkleFile(self.path)
+        self.assertEquals(mfile.store.digest, MFSDigests.BLAKE2B)
+        mnode_header = mfile.read(sha)
+        self.assertEquals(mnode_header.objects[0].sha, '\x01' * 64)
+
+        self.assertRaises(MFSException, MerkleFile, self.path, None, MFSDigests.SHA1)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file test/test_filters.py
+@description Filter pipeline tests
+'''
+
+from test.test_case import MFSTestCase, attr
+
+from mfs.filters import FilterPipelineHeader, Filter, Filters, ShuffleFilter, DeltaFilter, ZlibFilter, BZ2Filter, LZMAFilter, codecs, map_chunks
+from mfs.shuffle import shuffle, unshuffle, delta_encode, delta_decode
+from mfs.objects import serialize_object, MFSObjectHeader
+from mfs.drivers.posix.cache import ChunkCache
+from mfs.drivers.posix.dataset import Dataset
+from mfs.drivers.posix.store import ObjectStore
+from mfs.hl.dataset import MFSDataset
+from mfs.datablock import DataBlockHeader
+from mfs.datatype import MFSUShortType, MFSDoubleType
+from struct import pack, unpack
+from tempfile import mkdtemp
+import shutil
+import os
+
+@attr('unit')
+class TestFilters(MFSTestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        self.store = ObjectStore(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_shuffle(self):
+        data = pack('<4I', 1, 2, 0x01020304, 0xffffffff)
+        shuffled = shuffle(data, 4)
+        self.assertEquals(shuffled[:4], '\x01\x02\x04\xff')
+        self.assertEquals(unshuffle(bytearray(shuffled), 4), data)
+        self.assertEquals(shuffle(data, 1), data)
+        self.assertEquals(shuffle('', 8), '')
+        self.assertRaises(ValueError, shuffle, data, 3)
+        self.assertRaises(ValueError, shuffle, data, 0)
+
+    def test_delta(self):
+        values = [10, 11, 13, 12, 0, 65535]
+        encoded = delta_encode(pack('<6H', *values), 2)
+        self.assertEquals(unpack('<6H', encoded), (10, 1, 2, 65535, 65524, 65535))
+        self.assertEquals(unpack('<6H', delta_decode(memoryview(encoded), 2)), tuple(values))
+        data = pack('<4d', 1.5, -2.0, 1e300, 0.0)
+        self.assertEquals(delta_decode(delta_encode(data, 8), 8), data)
+        self.assertRaises(ValueError, delta_encode, data, 3)
+        self.assertRaises(ValueError, delta_encode, data[:7], 8)
+
+    def test_pipeline(self):
+        pipeline = FilterPipelineHeader([ShuffleFilter(8), DeltaFilter(1), ZlibFilter(9), BZ2Filter()])
+        sb = serialize_object(pipeline)
+        sb.seek(0)
+        loaded = MFSObjectHeader.deserialize(sb)
+        loaded.deserialize_body(sb)
+        self.assertTrue(isinstance(loaded, FilterPipelineHeader))
+        self.assertEquals(loaded.key(), pipeline.key())
+        self.assertEquals(loaded.key(), ((Filters.SHUFFLE, 8), (Filters.DELTA, 1), (Filters.ZLIB, 9), (Filters.BZ2, 9)))
+
+        data = pack('<512d', *[i * 0.25 for i in xrange(512)])
+        encoded = loaded.encode(bytearray(data))
+        self.assertTrue(len(encoded) < len(data))
+        self.assertEquals(loaded.decode(memoryview(encoded)), data)
+
+    def test_unavailable(self):
+        self.assertRaises(TypeError, Filter(0x7f).encode, 'data')
+        if Filters.LZMA not in codecs:
+            self.assertRaises(TypeError, LZMAFilter().encode, 'data')
+            self.assertRaises(TypeError, Dataset, self.store, shape=(10,), datatype=MFSDoubleType(), filters=[LZMAFilter()])
+
+    def test_map_chunks(self):
+        self.assertEquals(map_chunks(lambda x: x * 2, xrange(100)), range(0, 200, 2))
+        self.assertEquals(map_chunks(len, []), [])
+
+    def test_dataset(self):
+        values = [i // 7 for i in xrange(4096)]
+        data = pack('<4096H', *values)
+        plain = Dataset(self.store, shape=(64, 64), datatype=MFSUShortType(), chunks=(16, 64))
+        dataset = Dataset(self.store, shape=(64, 64), datatype=MFSUShortType(), chunks=(16, 64),
+                          cache=ChunkCache(), filters=[ShuffleFilter(2), ZlibFilter()])
+        plain.write(data)
+        dataset.write(data)
+        self.assertEquals(str(dataset.read()), data) # Before the commit
+
+        sha = dataset.commit()
+        plain.commit()
+        self.assertNotEquals(sha, plain.commit())
+        for n in xrange(4):
+            block = self.store.load(dataset.index.entry(n).sha)
+            self.assertEquals(block.flags, DataBlockHeader.FILTERED)
+            self.assertTrue(block.total_size < self.store.load(plain.index.entry(n).sha).total_size // 4)
+
+        dataset = Dataset(self.store, sha, cache=ChunkCache())
+        self.assertEquals(dataset.pipeline.key(), ((Filters.SHUFFLE, 2), (Filters.ZLIB, 6)))
+        self.assertEquals(str(dataset.read()), data)
+        self.assertEquals(unpack('<3H', str(dataset.read((20, 10), (1, 3)))), tuple(values[20 * 64 + 10:20 * 64 + 13]))
+
+        # Partial writes decode, patch and encode the chunks again
+        dataset.write(pack('<2H', 9999, 9998), (63, 62), (1, 2))
+        dataset = Dataset(self.store, dataset.commit(), cache=ChunkCache())
+        self.assertEquals(unpack('<4H', str(dataset.read((63, 60), (1, 4)))), (values[4092], values[4093], 9999, 9998))
+
+    def test_incompressible(self):
+        # Chunks the pipeline doesn't shrink are stored as they are
+        data = os.urandom(800)
+        dataset = MFSDataset(self.store, 100, MFSDoubleType(), chunks=100, filters=[ZlibFilter()])
+        dataset.set(data)
+        sha = dataset.commit()
+        self.assertEquals(self.store.load(dataset.dataset.index.entry(0).sha).flags, 0)
+        self.assertEquals(str(MFSDataset(self.store, sha=sha).get()), data)
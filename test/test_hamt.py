@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file test/test_hamt.py
+@description Merkle trie tests
+'''
+
+from test.test_case import MFSTestCase, attr
+
+from mfs.hamt import MerkleTrie
+from mfs.node import MerkleNode, MerkleNodeHeader
+from mfs.drivers.posix.store import ObjectStore
+from mfs.datatype import MFSDoubleType
+from mfs.types import MFSTypes
+from hashlib import sha1
+from tempfile import mkdtemp
+import shutil
+import random
+
+@attr('unit')
+class TestMerkleTrie(MFSTestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        self.store = ObjectStore(self.path)
+        self.writes = []
+        write = self.store.write
+        def counting_write(sb):
+            self.writes.append(sb)
+            return write(sb)
+        self.store.write = counting_write
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def member(self, i):
+        return MerkleNode(3, 0, 0, sha1(str(i)).digest())
+
+    def test_small(self):
+        trie = MerkleTrie(self.store, leaf_capacity=4)
+        for i in xrange(4):
+            self.assertTrue(trie.add(self.member(i)))
+        self.assertFalse(trie.add(self.member(0)))
+        self.assertFalse(trie.root.flags & MerkleNodeHeader.BRANCH)
+        self.assertEquals([o.sha for o in trie], sorted(self.member(i).sha for i in xrange(4)))
+        self.assertTrue(self.member(2).sha in trie)
+        self.assertFalse(self.member(5).sha in trie)
+
+    def test_split_and_collapse(self):
+        trie = MerkleTrie(self.store, leaf_capacity=8)
+        members = range(500)
+        random.shuffle(members)
+        for i in members:
+            trie.add(self.member(i))
+        self.assertTrue(trie.root.flags & MerkleNodeHeader.BRANCH)
+        self.assertEquals(trie.count(trie.root), 500)
+        self.assertEquals([o.sha for o in trie], sorted(self.member(i).sha for i in xrange(500)))
+        sha = trie.commit()
+
+        # Same set, any insertion order, same tree
+        other = MerkleTrie(self.store, leaf_capacity=8)
+        for i in xrange(500):
+            other.add(self.member(i))
+        self.assertEquals(other.commit(), sha)
+
+        trie = MerkleTrie(self.store, sha, leaf_capacity=8)
+        for i in xrange(500):
+            self.assertEquals(trie.get(self.member(i).sha).sha, self.member(i).sha)
+        self.assertIsNone(trie.get(sha1('missing').digest()))
+
+        for i in members[:495]:
+            self.assertTrue(trie.remove(self.member(i).sha))
+        self.assertFalse(trie.remove(self.member(members[0]).sha))
+        self.assertFalse(trie.root.flags & MerkleNodeHeader.BRANCH)
+        self.assertEquals(sorted(o.sha for o in trie), sorted(self.member(i).sha for i in members[495:]))
+
+        small = MerkleTrie(self.store, leaf_capacity=8)
+        for i in members[495:]:
+            small.add(self.member(i))
+        self.assertEquals(trie.commit(), small.commit())
+
+    def test_children_with_objects(self):
+        # Children carrying their object give the same tree as digests alone
+        datatype = MFSDoubleType()
+        sha = self.store.write(datatype.serialize())
+        tries = []
+        for obj in (None, datatype):
+            trie = MerkleTrie(self.store, leaf_capacity=4)
+            for i in xrange(10):
+                trie.add(self.member(i))
+            trie.add(MerkleNode(MFSTypes.Datatype, 0, 0, sha, obj))
+            tries.append(trie)
+        self.assertEquals(tries[0].commit(), tries[1].commit())
+        for trie in tries:
+            self.assertTrue(trie.root.flags & MerkleNodeHeader.BRANCH)
+            leaf = trie.root.load_child(trie.find_bucket(trie.root, ord(sha[0])), self.store)
+            self.assertTrue(leaf.flags & MerkleNodeHeader.SORTED)
+
+        small = MerkleTrie(self.store)
+        small.add(MerkleNode(MFSTypes.Datatype, 0, 0, sha, datatype))
+        self.assertTrue(small.root.flags & MerkleNodeHeader.SORTED)
+
+    def test_commit_path(self):
+        trie = MerkleTrie(self.store, leaf_capacity=16)
+        for i in xrange(2000):
+            trie.add(self.member(i))
+        trie.commit()
+        depth = 0
+        node = trie.root
+        while node.flags & MerkleNodeHeader.BRANCH:
+            node = node.objects[0].obj
+            depth += 1
+
+        del self.writes[:]
+        trie.add(self.member(2000))
+        trie.commit()
+        self.assertTrue(len(self.writes) <= depth + 1)
+        self.assertTrue(self.member(2000).sha in MerkleTrie(self.store, trie.root.sha))
+
+    def test_full_node(self):
+        mnode = MerkleNodeHeader()
+        mnode.children = 0xffff
+        self.assertRaises(ValueError, mnode.add_child, self.member(0))
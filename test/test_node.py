@@ -5,13 +5,18 @@
 @description Merkle Node Test
 '''
 
-from test.test_case import MFSTestCase
+from test.test_case import MFSTestCase, attr
 from test.performance import PerformanceTestCase
 
 from mfs.objects import MFSObjectHeader
-from mfs.node import MerkleNode, MerkleNodeHeader
-from hashlib import sha1
-from tempfile import TemporaryFile
+from mfs.node import MerkleNode, MerkleNodeHeader, MerkleChildren
+from mfs.symbol_table import SymbolTableHeader
+from mfs.drivers.posix.store import ObjectStore
+from mfs.types import MFSDigests
+from mfs.exceptions import MFSException
+from hashlib import sha1, sha256
+from tempfile import TemporaryFile, mkdtemp
+import shutil
 from mfs.string_buffer import StringBuffer
 
 class TestNode(MFSTestCase):
@@ -38,12 +43,209 @@ class TestNode(MFSTestCase):
 
         self.assertEquals(mnode.objects[-1].sha, mnode_header.objects[-1].sha)
 
-            
-
-
-
-
-        
-
-
-
+    def test_serialize_into(self):
+        mnode = MerkleNodeHeader()
+        for i in xrange(3):
+            mnode.add_child(MerkleNode(3, 0, 0, sha1(str(i)).digest()))
+        self.assertEquals(mnode.serialized_size(), 16 + 8 + 3 * 24)
+
+        sb = StringBuffer(8 + mnode.serialized_size())
+        sb.seek(8)
+        mnode.serialize_into(sb)
+        self.assertEquals(sb.offset(), sb.buffer_size())
+
+        sb.seek(8)
+        self.assertEquals(sb.raw_read(), mnode.serialize().raw_read())
+
+        sb.seek(8)
+        mnode_header = MFSObjectHeader.deserialize(sb)
+        mnode_header.deserialize_children(sb)
+        self.assertEquals([o.sha for o in mnode_header.objects], [o.sha for o in mnode.objects])
+
+    def test_digest_width(self):
+        sha_bytes = sha256('sample text').digest()
+        mnode = MerkleNodeHeader(MFSDigests.SHA256)
+        for i in xrange(3):
+            mnode.add_child(MerkleNode(3, 0, 0, sha_bytes))
+        self.assertRaises(ValueError, mnode.add_child, MerkleNode(3, 0, 0, sha1('sample text').digest()))
+        self.assertEquals(mnode.serialized_size(), 16 + 8 + 3 * 40)
+
+        sb = mnode.serialize()
+        mnode_header = MFSObjectHeader.deserialize(sb)
+        mnode_header.deserialize_children(sb)
+        self.assertEquals(mnode_header.digest, MFSDigests.SHA256)
+        self.assertEquals(mnode_header.digest_size, 32)
+        self.assertEquals([o.sha for o in mnode_header.objects], [sha_bytes] * 3)
+
+    def test_version_0(self):
+        sha_bytes = sha1('sample text').digest()
+        sb = StringBuffer(16 + 24)
+        sb.pack('<BBH4sQ', 2, 0, 1, '.MFS', 24)
+        MerkleNode(3, 0, 0, sha_bytes).serialize_into(sb)
+        sb.seek(0)
+
+        mnode_header = MFSObjectHeader.deserialize(sb)
+        mnode_header.deserialize_children(sb)
+        self.assertEquals(mnode_header.version, 0)
+        self.assertEquals(mnode_header.objects[0].sha, sha_bytes)
+
+        sb.seek(0)
+        self.assertEquals(mnode_header.serialize().raw_read(), sb.raw_read())
+
+    def test_lazy_children(self):
+        mnode = MerkleNodeHeader()
+        shas = [sha1(str(i)).digest() for i in xrange(60000)]
+        for i, sha in enumerate(shas):
+            mnode.add_child(MerkleNode(3, 0, i % 7, sha))
+        sb = mnode.serialize()
+
+        header = MFSObjectHeader.deserialize(sb)
+        header.deserialize_body(sb)
+        self.assertIsInstance(header.objects, MerkleChildren)
+        self.assertEquals(sb.offset(), sb.buffer_size())
+        self.assertEquals(len(header.objects), 60000)
+        self.assertEquals(header.objects[12345].sha, shas[12345])
+        self.assertEquals(header.objects[12345].flags, 12345 % 7)
+        self.assertEquals(header.objects[-1].sha, shas[-1])
+        self.assertRaises(IndexError, header.objects.__getitem__, 60000)
+        self.assertEquals(list(header.objects.shas()), shas)
+        self.assertEquals(header.find_child(shas[59999]), 59999)
+        self.assertEquals(header.find_child(sha1('missing').digest()), -1)
+        sb.seek(0)
+        self.assertEquals(header.serialize().raw_read(), sb.raw_read())
+
+        # Modifying the node decodes its children
+        header.delete_child(shas[0])
+        self.assertIsInstance(header.objects, list)
+        self.assertEquals(header.objects[0].mfs_type, 0)
+
+    def test_sorted_children(self):
+        mnode = MerkleNodeHeader()
+        shas = [sha1(str(i)).digest() for i in xrange(100)]
+        for sha in shas:
+            mnode.add_child(MerkleNode(3, 0, 0, sha))
+        mnode.sort_children()
+        self.assertTrue(mnode.flags & MerkleNodeHeader.SORTED)
+        self.assertEquals(mnode.find_child(shas[10]), sorted(shas).index(shas[10]))
+
+        sb = mnode.serialize()
+        header = MFSObjectHeader.deserialize(sb)
+        header.deserialize_body(sb)
+        self.assertTrue(header.objects.sorted)
+        for sha in shas:
+            self.assertEquals(header.find_child(sha), sorted(shas).index(sha))
+        self.assertEquals(header.find_child(sha1('missing').digest()), -1)
+
+        header.add_child(MerkleNode(3, 0, 0, '\0' * 20))
+        self.assertFalse(header.flags & MerkleNodeHeader.SORTED)
+        self.assertEquals(header.find_child('\0' * 20), 100)
+
+@attr('unit')
+class TestNodeCommit(MFSTestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+        self.store = ObjectStore(self.path)
+        self.writes = []
+        write = self.store.write
+        def counting_write(sb):
+            self.writes.append(sb)
+            return write(sb)
+        self.store.write = counting_write
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def build_tree(self, leaf_name):
+        root = MerkleNodeHeader()
+        for i in xrange(3):
+            mid = MerkleNodeHeader()
+            for j in xrange(3):
+                st = SymbolTableHeader()
+                st.add(leaf_name if (i, j) == (1, 2) else 'leaf %d.%d' % (i, j))
+                mid.add_child(MerkleNode(st.mfs_type, 0, 0, None, st))
+            root.add_child(MerkleNode(mid.mfs_type, 0, 0, None, mid))
+        return root
+
+    def test_commit(self):
+        root = self.build_tree('leaf 1.2')
+        sha = root.commit(self.store)
+        self.assertEquals(len(self.writes), 13)
+        self.assertFalse(root.dirty)
+
+        del self.writes[:]
+        self.assertEquals(root.commit(self.store), sha)
+        self.assertEquals(self.writes, [])
+
+        st = SymbolTableHeader()
+        st.add('changed')
+        mid = root.objects[1].obj
+        mid.set_child(2, st)
+        self.assertTrue(root.dirty)
+        self.assertEquals(root.dirty_children, set([1]))
+
+        new_sha = root.commit(self.store)
+        self.assertEquals(len(self.writes), 3) # leaf, mid and root
+        self.assertEquals(new_sha, self.build_tree('changed').commit(self.store))
+
+    def test_lazy_load_child(self):
+        # Reading through a loaded tree decodes no child lists, changing a leaf
+        # decodes the ones on its path
+        sha = self.build_tree('leaf 1.2').commit(self.store)
+        root = self.store.load(sha)
+        mid = root.load_child(1, self.store)
+        st = mid.load_child(2, self.store)
+        self.assertIs(root.load_child(1, self.store), mid)
+        self.assertIsInstance(root.objects, MerkleChildren)
+        self.assertIsInstance(mid.objects, MerkleChildren)
+
+        st.add('more')
+        mid.touch_child(2)
+        self.assertIsInstance(root.objects, list)
+        self.assertIs(root.objects[1].obj, mid)
+        self.assertIs(mid.objects[2].obj, st)
+        self.assertIs(root.load_child(1, self.store), mid)
+
+        del self.writes[:]
+        root = self.store.load(root.commit(self.store))
+        self.assertEquals(len(self.writes), 3)
+        st = root.load_child(1, self.store).load_child(2, self.store)
+        self.assertEquals([s.symbol for s in st.symbols], ['leaf 1.2', 'more'])
+
+        root.load_child(0, self.store)
+        root.clear_children()
+        self.assertEquals((root.children, root.loaded), (0, {}))
+
+    def test_digest_mismatch(self):
+        path = mkdtemp()
+        try:
+            store = ObjectStore(path, MFSDigests.SHA256)
+            self.assertRaises(MFSException, self.build_tree('leaf 1.2').commit, store)
+
+            # A SHA-256 node in a SHA-1 store fails on its own digest
+            root = MerkleNodeHeader(MFSDigests.SHA256)
+            self.assertRaises(MFSException, root.commit, self.store)
+            root = MerkleNodeHeader(MFSDigests.SHA256)
+            st = SymbolTableHeader()
+            st.add('leaf')
+            root.add_child(MerkleNode(st.mfs_type, 0, 0, None, st))
+            self.assertEquals(len(root.commit(store)), 32)
+        finally:
+            shutil.rmtree(path)
+
+    def test_loaded_path(self):
+        sha = self.build_tree('leaf 1.2').commit(self.store)
+        del self.writes[:]
+
+        root = self.store.load(sha)
+        mid = root.load_child(1, self.store)
+        st = mid.load_child(2, self.store)
+        self.assertFalse(root.dirty)
+
+        st.add('more')
+        mid.touch_child(2)
+        root.commit(self.store)
+        self.assertEquals(len(self.writes), 3)
+
+        root = self.store.load(root.sha)
+        st = root.load_child(1, self.store).load_child(2, self.store)
+        self.assertEquals([s.symbol for s in st.symbols], ['leaf 1.2', 'more'])
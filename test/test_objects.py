@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file test/test_objects.py
+@description Object decoding tests
+'''
+
+from test.test_case import MFSTestCase, attr
+
+from mfs.objects import MFSObjectHeader, iter_objects, serialize_objects
+from mfs.node import MerkleNode, MerkleNodeHeader
+from mfs.symbol_table import SymbolTableHeader
+from mfs.datatype import DatatypeHeader, MFSDoubleType
+from mfs.dataspace import DataspaceHeader
+from mfs.attribute import AttributeHeader
+from mfs.string_buffer import StringBuffer
+from mfs.exceptions import SerializationError
+from hashlib import sha1
+from tempfile import TemporaryFile
+
+@attr('unit')
+class TestObjects(MFSTestCase):
+    def build_stream(self):
+        st = SymbolTableHeader()
+        st.add('root')
+        st.add('time')
+        mnode = MerkleNodeHeader()
+        mnode.add_child(MerkleNode(3, 0, 0, sha1('leaf').digest()))
+        attribute = AttributeHeader(4, 16, 24, 16)
+        attribute.payload = 'units\0\0\0degrees\0'
+        objects = [st, mnode, MFSDoubleType(), DataspaceHeader((10, 20)), attribute]
+
+        sb = StringBuffer(sum(o.serialized_size() for o in objects))
+        for o in objects:
+            o.serialize_into(sb)
+        sb.seek(0)
+        return objects, sb
+
+    def check(self, headers):
+        self.assertEquals([h.__class__ for h in headers],
+                [SymbolTableHeader, MerkleNodeHeader, DatatypeHeader, DataspaceHeader, AttributeHeader])
+        self.assertEquals([s.symbol for s in headers[0].symbols], ['root', 'time'])
+        self.assertEquals(headers[1].objects[0].sha, sha1('leaf').digest())
+        self.assertEquals(headers[2].datatype, 0x09)
+        self.assertEquals([d.dim_size for d in headers[3].dataspaces], [10, 20])
+        self.assertEquals(headers[4].payload, 'units\0\0\0degrees\0')
+
+    def test_iter_objects(self):
+        objects, sb = self.build_stream()
+        self.check(list(iter_objects(sb)))
+        sb.seek(0)
+        self.check(list(iter_objects(sb.raw_read())))
+
+        with TemporaryFile('w+b') as f:
+            sb.seek(0)
+            sb.fwrite(f.fileno())
+            f.seek(0)
+            self.check(list(iter_objects(f.fileno())))
+
+    def test_serialize_objects(self):
+        objects, sb = self.build_stream()
+        stream = serialize_objects(objects)
+        self.assertTrue(stream.is_growable())
+        self.assertEquals(stream.buffer_size(), sb.buffer_size())
+        stream.seek(0)
+        self.assertEquals(stream.raw_read(), sb.raw_read())
+        stream.seek(0)
+        self.check(list(iter_objects(stream)))
+
+    def test_attribute(self):
+        objects, sb = self.build_stream()
+        attribute = objects[-1]
+        header = MFSObjectHeader.deserialize(attribute.serialize())
+        self.assertIsInstance(header, AttributeHeader)
+        self.assertEquals((header.name_size, header.datatype_size, header.dataspace_size), (4, 16, 24))
+
+    def test_unrecognized(self):
+        sb = StringBuffer(16)
+        sb.pack('<BxxxxxxxQ', 0x7f, 0)
+        sb.seek(0)
+        self.assertRaises(TypeError, MFSObjectHeader.deserialize, sb)
+
+    def test_short_serialize(self):
+        attribute = self.build_stream()[0][-1]
+        attribute.serialized_size = lambda: 16 + attribute.total_size + 8
+        self.assertRaises(SerializationError, attribute.serialize)
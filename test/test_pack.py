@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file test/test_pack.py
+@description Pack file tests
+'''
+
+from test.test_case import MFSTestCase, attr
+
+from mfs.drivers.posix.store import ObjectStore
+from mfs.drivers.posix.pack import Pack, write_pack
+from mfs.string_buffer import StringBuffer
+from mfs.symbol_table import SymbolTableHeader
+from mfs.exceptions import ObjectNotFound
+from mfs.types import MFSDigests
+from hashlib import sha1
+from tempfile import mkdtemp
+from StringIO import StringIO
+import shutil
+import sys
+import gc
+import os
+
+@attr('unit')
+class TestPack(MFSTestCase):
+    def setUp(self):
+        self.path = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_write_pack(self):
+        objects = {}
+        for i in xrange(300):
+            sb = StringBuffer(8 * (i % 5 + 1))
+            sb.write(str(i))
+            sb.seek(0)
+            objects[sha1(str(i)).digest()] = sb
+        objects[sha1('large').digest()] = StringBuffer(128 * 1024)
+
+        path = write_pack(self.path, objects.items(), MFSDigests.SHA1)
+        self.assertTrue(os.path.exists(path + '.pack'))
+        self.assertTrue(os.path.exists(path + '.idx'))
+
+        pack = Pack(path)
+        self.assertEquals(len(pack), 301)
+        self.assertEquals(list(pack), sorted(objects))
+        for sha, sb in objects.iteritems():
+            self.assertTrue(sha in pack)
+            self.assertEquals(pack.read(sha).raw_read(), sb.raw_read())
+        self.assertTrue(pack.read(sha1('large').digest()).is_mapped())
+        self.assertFalse(sha1('missing').digest() in pack)
+        self.assertIsNone(pack.read(sha1('missing').digest()))
+        pack.close()
+
+        self.assertIsNone(write_pack(self.path, [], MFSDigests.SHA1))
+
+    def test_open_errors(self):
+        # A pack that fails to open must not raise again when it's collected
+        path = os.path.join(self.path, 'pack-broken')
+        with open(path + '.idx', 'w') as f:
+            f.write('\0' * 2048)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            self.assertRaises(TypeError, Pack, path)
+            self.assertRaises(OSError, Pack, os.path.join(self.path, 'pack-missing'))
+            gc.collect()
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        self.assertEquals(errors, '')
+
+    def test_repack(self):
+        store = ObjectStore(self.path)
+        shas = []
+        for i in xrange(20):
+            st = SymbolTableHeader()
+            st.add('symbol_%d' % i)
+            shas.append(store.write(st.serialize()))
+
+        pack = store.repack()
+        self.assertEquals(sorted(pack), sorted(shas))
+        self.assertEquals(list(store.loose_objects()), [])
+        self.assertEquals(sorted(os.listdir(store.path)), ['bloom', 'digest', 'pack'])
+        self.assertIsNone(store.repack())
+
+        store = ObjectStore(self.path)
+        for i, sha in enumerate(shas):
+            self.assertTrue(store.exists(sha))
+            self.assertEquals([s.symbol for s in store.load(sha).symbols], ['symbol_%d' % i])
+        self.assertRaises(ObjectNotFound, store.read, sha1('missing').digest())
+
+        # Objects that are already packed aren't written again
+        st = SymbolTableHeader()
+        st.add('symbol_0')
+        self.assertEquals(store.write(st.serialize()), shas[0])
+        self.assertEquals(list(store.loose_objects()), [])
+
+        st.add('symbol_1')
+        sha = store.write(st.serialize())
+        self.assertEquals(list(store.loose_objects()), [sha])
+        store.repack()
+        self.assertEquals(len(store.packs), 2)
+        self.assertTrue(store.exists(sha))
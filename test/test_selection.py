@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+'''
+@author Luke Campbell
+@file test/test_selection.py
+@description Hyperslab selection tests
+'''
+
+from test.test_case import MFSTestCase, attr
+
+from mfs.selection import Hyperslab
+
+@attr('unit')
+class TestHyperslab(MFSTestCase):
+    def test_runs(self):
+        selection = Hyperslab((1, 0), (3, 4), (4, 1), (2, 1))
+        self.assertEquals(selection.shape(), (6, 4))
+        self.assertEquals(selection.runs(0), [(1, 2, 0), (5, 2, 2), (9, 2, 4)])
+        self.assertEquals(selection.runs(1), [(0, 4, 0)]) # Contiguous, merged
+        selection.check((11, 4))
+        self.assertRaises(ValueError, selection.check, (10, 4))
+        self.assertRaises(ValueError, selection.check, (11,))
+
+    def test_plan(self):
+        selection = Hyperslab((1, 3), (3, 1), (4, 1), (2, 1))
+        plan = selection.plan((4, 8))
+        # 1-2 in chunk 0, 5-6 in chunk 1, 9-10 in chunk 2
+        self.assertEquals(plan[0], {0 : [(1, 2, 0)], 1 : [(1, 2, 2)], 2 : [(1, 2, 4)]})
+        self.assertEquals(plan[1], {0 : [(3, 1, 0)]})
+
+        # A run crossing chunk boundaries is split
+        plan = Hyperslab((3,), (6,)).plan((4,))
+        self.assertEquals(plan[0], {0 : [(3, 1, 0)], 1 : [(0, 4, 1)], 2 : [(0, 1, 5)]})
+        self.assertEquals(Hyperslab((3,), (0,)).plan((4,)), [{}])
+
+    def test_from_slices(self):
+        selection = Hyperslab.from_slices((10, 20, 30), (5, slice(10, 20), slice(None, None, 7)))
+        self.assertEquals((selection.start, selection.count, selection.stride), ((5, 10, 0), (1, 10, 5), (1, 1, 7)))
+        selection = Hyperslab.from_slices((10, 20), -1)
+        self.assertEquals((selection.start, selection.count), ((9, 0), (1, 20)))
+        self.assertRaises(IndexError, Hyperslab.from_slices, (10,), 10)
+        self.assertRaises(IndexError, Hyperslab.from_slices, (10,), (1, 2))
+        self.assertRaises(ValueError, Hyperslab.from_slices, (10,), slice(None, None, -1))
+        self.assertRaises(TypeError, Hyperslab.from_slices, (10,), 'a')
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, Hyperslab, (0,), (2,), (1,), (2,)) # Overlapping blocks
+        self.assertRaises(ValueError, Hyperslab, (0,), (2,), (2,), (0,))
+        self.assertRaises(ValueError, Hyperslab, (0, 0), (2,))
@@ -1,7 +1,13 @@
 from test.test_case import MFSTestCase, attr
 
-from mfs.string_buffer import StringBuffer, BufferOverflow
+from mfs.string_buffer import StringBuffer, BufferOverflow, hash_many, buffer_pool_stats, clear_buffer_pool
+from mfs.string_buffer import writev, readv, pwritev, preadv
 from tempfile import TemporaryFile
+from hashlib import sha1
+from struct import pack
+from binascii import unhexlify
+import os
+from mfs.types import MFSDigests
 
 @attr('unit')
 class TestStringBuffer(MFSTestCase):
@@ -118,3 +124,334 @@ class TestStringBuffer(MFSTestCase):
         outside = StringBuffer(sha1(buf.raw_read()).digest())
         self.assertEquals(outside.raw_read(), buf_sha.raw_read())
 
+
+    def test_mmap(self):
+        with TemporaryFile('w+b') as f:
+            f.write('\x10\x00' + 'hello world')
+            f.flush()
+
+            sb = StringBuffer.from_mmap(f.fileno(), 13)
+            self.assertTrue(sb.is_mapped())
+            self.assertTrue(sb.is_readonly())
+            self.assertEquals(sb.buffer_size(), 13)
+            self.assertEquals(sb.read_uint(2), 16)
+            self.assertEquals(sb.raw_read(5), 'hello')
+            self.assertRaises(TypeError, sb.write, 'jello')
+            self.assertRaises(BufferOverflow, sb.raw_read, 7)
+
+            f.seek(0)
+            self.assertEquals(sb.hash().raw_read(), StringBuffer(sha1(f.read()).digest()).raw_read())
+
+    def test_mmap_unterminated(self):
+        # A full page mapping has no null byte after it
+        with TemporaryFile('w+b') as f:
+            f.write('x' * 4096)
+            f.flush()
+
+            sb = StringBuffer.from_mmap(f.fileno(), 4096)
+            self.assertEquals(sb.raw_read(4, strip_null=True), 'xxxx')
+            self.assertEquals(sb.read(), 'x' * 4092)
+            sb.seek(4096)
+            self.assertEquals(sb.read(), '')
+
+        sb = StringBuffer.wrap(bytearray('ab\0cd'))
+        self.assertEquals(sb.read(), 'ab')
+        self.assertEquals(sb.raw_read(5, strip_null=True), 'ab')
+        self.assertEquals(StringBuffer.wrap(bytearray('abcd')).read(), 'abcd')
+
+    def test_mmap_offset(self):
+        with TemporaryFile('w+b') as f:
+            f.write('x' * 5000 + 'hello world')
+            f.flush()
+
+            sb = StringBuffer.from_mmap(f.fileno(), 11, 5000)
+            self.assertEquals(sb.raw_read(), 'hello world')
+
+    def test_mmap_copy_on_write(self):
+        with TemporaryFile('w+b') as f:
+            f.write('hello world')
+            f.flush()
+
+            sb = StringBuffer.from_mmap(f.fileno(), 11, copy_on_write=True)
+            self.assertFalse(sb.is_readonly())
+            sb.write('jello')
+            sb.seek(0)
+            self.assertEquals(sb.raw_read(), 'jello world')
+
+            f.seek(0)
+            self.assertEquals(f.read(), 'hello world')
+
+    def test_buffer_protocol(self):
+        sb = StringBuffer('hello world')
+        view = memoryview(sb)
+        self.assertEquals(len(view), 16)
+        self.assertFalse(view.readonly)
+        self.assertEquals(view[:5].tobytes(), 'hello')
+
+        view[0] = 'j'
+        self.assertEquals(sb.read(), 'jello world')
+
+        sb.seek(6)
+        world = sb.view(5)
+        self.assertEquals(world.tobytes(), 'world')
+        self.assertEquals(sb.offset(), 11)
+
+        self.assertEquals(bytearray(sb)[:11], bytearray('jello world'))
+
+    def test_write_buffer(self):
+        sb = StringBuffer(16)
+        sb.write(bytearray('hello '))
+        sb.write(memoryview('world'))
+        sb.seek(0)
+        self.assertEquals(sb.read(), 'hello world')
+
+        sb = StringBuffer(bytearray('\x01\x00\x02\x00'))
+        self.assertEquals(sb.buffer_size(), 8)
+        self.assertEquals(sb.read_uint(2), 1)
+        self.assertEquals(sb.read_uint(2), 2)
+
+    def test_wrap(self):
+        target = bytearray(11)
+        sb = StringBuffer.wrap(target)
+        self.assertFalse(sb.is_readonly())
+        self.assertEquals(sb.buffer_size(), 11)
+        with TemporaryFile('w+b') as f:
+            f.write('hello world')
+            f.seek(0)
+            sb.fread(f.fileno())
+        self.assertEquals(target, bytearray('hello world'))
+
+        sb = StringBuffer.wrap('hello')
+        self.assertTrue(sb.is_readonly())
+        self.assertRaises(TypeError, sb.write, 'j')
+
+    def test_typed(self):
+        sb = StringBuffer(64)
+        sb.write_u8(0xff)
+        sb.write_i8(-2)
+        sb.write_u16(0xbeef)
+        sb.write_i16(-300)
+        sb.write_u32(0xdeadbeef)
+        sb.write_i32(-70000)
+        sb.write_u64(0xffffffffffffffff)
+        sb.write_i64(-(1 << 40))
+        sb.write_f32(1.5)
+        sb.write_f64(-0.25)
+        self.assertEquals(sb.offset(), 42)
+        self.assertRaises(OverflowError, sb.write_u16, 0x10000)
+        self.assertRaises(OverflowError, sb.write_i8, 128)
+
+        sb.seek(0)
+        self.assertEquals(sb.raw_read(42), pack('<BbHhIiQqfd', 0xff, -2, 0xbeef, -300, 0xdeadbeef, -70000, 0xffffffffffffffff, -(1 << 40), 1.5, -0.25))
+
+        sb.seek(0)
+        self.assertEquals(sb.read_u8(), 0xff)
+        self.assertEquals(sb.read_i8(), -2)
+        self.assertEquals(sb.read_u16(), 0xbeef)
+        self.assertEquals(sb.read_i16(), -300)
+        self.assertEquals(sb.read_u32(), 0xdeadbeef)
+        self.assertEquals(sb.read_i32(), -70000)
+        self.assertEquals(sb.read_u64(), 0xffffffffffffffff)
+        self.assertEquals(sb.read_i64(), -(1 << 40))
+        self.assertEquals(sb.read_f32(), 1.5)
+        self.assertEquals(sb.read_f64(), -0.25)
+
+        sb.seek(60)
+        self.assertRaises(BufferOverflow, sb.read_u64)
+        self.assertEquals(sb.offset(), 60)
+
+    def test_unpack_header(self):
+        sb = StringBuffer(16)
+        sb.pack('<BBH4sQ', 2, 0, 5, '.MFS', 1024)
+        sb.seek(0)
+        self.assertEquals(sb.raw_read(), pack('<BBH4sQ', 2, 0, 5, '.MFS', 1024))
+
+        sb.seek(0)
+        self.assertEquals(sb.unpack_header('<BBH4sQ'), (2, 0, 5, '.MFS', 1024))
+        self.assertEquals(sb.offset(), 16)
+
+        sb.seek(0)
+        self.assertEquals(sb.unpack_header('<BxxxIQ'), (2, 0x53464d2e, 1024))
+
+        sb.seek(0)
+        self.assertRaises(ValueError, sb.unpack_header, '>BBH4sQ')
+        self.assertRaises(BufferOverflow, sb.unpack_header, '<QQQ')
+        self.assertRaises(TypeError, sb.pack, '<BB', 1)
+        self.assertEquals(sb.offset(), 0)
+
+    def test_hash_block_size(self):
+        with open('/dev/urandom', 'r+b') as f:
+            buf = StringBuffer.from_file(f.fileno(), 4096 * 3 + 8)
+        digest = sha1(buf.raw_read()).digest()
+        self.assertEquals(buf.hash().raw_read(20), digest)
+        self.assertEquals(buf.hash(1000).raw_read(20), digest)
+        self.assertRaises(ValueError, buf.hash, 0)
+
+    def test_hash_many(self):
+        buffers = [StringBuffer('buffer %d' % i) for i in xrange(32)]
+        buffers.append(bytearray('hello world'))
+        expected = [sha1(bytearray(b)).digest() for b in buffers]
+
+        digests = hash_many(buffers, threads=4)
+        self.assertEquals([d.raw_read(20) for d in digests], expected)
+
+        digests = hash_many(buffers, threads=1, block_size=3)
+        self.assertEquals([d.raw_read(20) for d in digests], expected)
+
+        self.assertEquals(hash_many([]), [])
+        self.assertRaises(TypeError, hash_many, [StringBuffer(8), 1], threads=2)
+
+    def test_digests(self):
+        import hashlib
+        buf = StringBuffer("Hello World")
+        data = buf.raw_read()
+        self.assertEquals(buf.hash(digest=MFSDigests.SHA256).raw_read(), hashlib.sha256(data).digest())
+        self.assertEquals(buf.hash(digest=MFSDigests.BLAKE2B).raw_read(), unhexlify( # 'Hello World' + 5 null bytes
+            'ecaa80a448a96c12f506d1bf2d69406787b7968677140bf8ada075dfa3134c4d'
+            '069af105658f41b0dc0f657456c7fe5cee86248401ceb283528aacb51bae64ba'))
+
+        digests = hash_many([buf, buf], threads=2, digest=MFSDigests.SHA256)
+        self.assertEquals([d.raw_read() for d in digests], [hashlib.sha256(data).digest()] * 2)
+
+    def test_growable(self):
+        sb = StringBuffer.growable(8)
+        self.assertTrue(sb.is_growable())
+        self.assertEquals(sb.buffer_size(), 0)
+        sb.pack('<BBHIQ', 1, 2, 3, 4, 5)
+        self.assertEquals(sb.buffer_size(), 16)
+        capacity = sb.buffer_capacity()
+        self.assertTrue(capacity >= 16)
+        for i in xrange(1000):
+            sb.write_u32(i)
+        self.assertEquals(sb.buffer_size(), 16 + 4000)
+        self.assertTrue(sb.buffer_capacity() < 2 * (16 + 4000) + 8)
+        sb.write('tail')
+        sb.seek(16)
+        self.assertEquals([sb.read_u32() for i in xrange(1000)], range(1000))
+        self.assertEquals(sb.raw_read(), 'tail')
+        self.assertRaises(BufferOverflow, sb.seek, sb.buffer_size() + 1)
+
+        sb.reserve(1 << 16)
+        self.assertEquals(sb.buffer_capacity(), 1 << 16)
+        self.assertEquals(sb.buffer_size(), 4020)
+        sb.shrink_to_fit()
+        self.assertEquals(sb.buffer_capacity(), 4020)
+
+        # The storage can't move under an exported view
+        view = memoryview(sb)
+        self.assertRaises(BufferError, sb.write, 'x' * 100)
+        del view
+        sb.write('x' * 100)
+        self.assertEquals(sb.buffer_size(), 4120)
+
+        self.assertRaises(TypeError, StringBuffer(8).reserve, 16)
+        self.assertRaises(BufferOverflow, StringBuffer(8).write, 'x' * 9)
+
+    def test_growable_fread(self):
+        with TemporaryFile('w+b') as f:
+            f.write('hello world')
+            f.flush()
+            f.seek(0)
+            sb = StringBuffer.growable()
+            sb.write('> ')
+            sb.fread(f.fileno(), 100)
+            self.assertEquals(sb.buffer_size(), 13)
+            sb.seek(0)
+            self.assertEquals(sb.raw_read(), '> hello world')
+
+    def test_buffer_pool(self):
+        clear_buffer_pool()
+        self.assertEquals(sum(buffer_pool_stats().values()), 0)
+        sb = StringBuffer(100)
+        del sb
+        self.assertEquals(buffer_pool_stats()[128], 1)
+
+        # The recycled block is handed out again and zeroed unless asked not to
+        sb = StringBuffer(120)
+        self.assertEquals(buffer_pool_stats()[128], 0)
+        self.assertEquals(sb.raw_read(), '\0' * 120)
+        sb.seek(0)
+        sb.write('x' * 120)
+        del sb
+        sb = StringBuffer(13, zero=False)
+        self.assertEquals(sb.buffer_size(), 16)
+        sb.seek(13)
+        self.assertEquals(sb.raw_read(), '\0' * 3) # The padding is always zeroed
+
+        # Large buffers bypass the pool
+        del sb
+        big = StringBuffer(1 << 16)
+        del big
+        self.assertFalse((1 << 16) in buffer_pool_stats())
+        clear_buffer_pool()
+        self.assertEquals(sum(buffer_pool_stats().values()), 0)
+
+    def test_positional(self):
+        sb = StringBuffer(32)
+        sb.pack('<HhI', 0xbeef, -2, 7)
+        sb.write('symbol\0pad')
+        sb.seek(3)
+        self.assertEquals(sb.read_uint_at(0, 2), 0xbeef)
+        self.assertEquals(sb.read_int_at(2, 2), -2)
+        self.assertEquals(sb.unpack_header_at('<HhI', 0), (0xbeef, -2, 7))
+        self.assertEquals(sb.raw_read_at(8, 10), 'symbol\0pad')
+        self.assertEquals(sb.raw_read_at(8, 10, strip_null=True), 'symbol')
+        self.assertEquals(sb.view_at(8, 6).tobytes(), 'symbol')
+        self.assertEquals(sb.offset(), 3) # The cursor never moves
+        self.assertRaises(BufferOverflow, sb.raw_read_at, 30, 3)
+        self.assertRaises(BufferOverflow, sb.read_uint_at, 32, 1)
+        self.assertRaises(IOError, sb.read_uint_at, 0, 3)
+
+        # Threads sharing one buffer
+        from threading import Thread
+        results = []
+        def reader():
+            results.append(all(sb.read_uint_at(0, 2) == 0xbeef and sb.raw_read_at(8, 6) == 'symbol' for i in xrange(1000)))
+        threads = [Thread(target=reader) for i in xrange(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEquals(results, [True] * 4)
+
+    def test_pread_pwrite(self):
+        with TemporaryFile('w+b') as f:
+            fd = f.fileno()
+            sb = StringBuffer('hello world')
+            self.assertEquals(sb.pwrite(fd, 100, 5), 5)
+            self.assertEquals(sb.pwrite(fd, 0, offset=6), 10) # 'world' and the padding
+            self.assertEquals(os.lseek(fd, 0, os.SEEK_CUR), 0)
+
+            sb = StringBuffer(16)
+            sb.seek(4)
+            self.assertEquals(sb.pread(fd, 100, offset=2), 5) # Short at the end of the file
+            self.assertEquals(sb.raw_read_at(0, 8), '\0\0hello\0')
+            self.assertEquals(sb.pread(fd, 0, 5), 5)
+            self.assertEquals(sb.raw_read_at(0, 5), 'world')
+            self.assertEquals(sb.offset(), 4)
+            self.assertRaises(BufferOverflow, sb.pread, fd, 0, 17)
+            self.assertRaises(IOError, sb.pread, -1, 0)
+
+    def test_vector_io(self):
+        with TemporaryFile('w+b') as f:
+            fd = f.fileno()
+            parts = [StringBuffer('header'), '', bytearray('body'), memoryview('tail')]
+            self.assertEquals(writev(fd, parts), 8 + 4 + 4)
+            self.assertEquals(writev(fd, []), 0)
+            # More buffers than fit in one call
+            self.assertEquals(writev(fd, ['x'] * 5000), 5000)
+            self.assertEquals(pwritev(fd, ['H', 'E'], 0), 2)
+            self.assertEquals(os.lseek(fd, 0, os.SEEK_CUR), 16 + 5000)
+
+            head, body = StringBuffer(8), bytearray(8)
+            self.assertEquals(preadv(fd, [head, body], 0), 16)
+            self.assertEquals(head.raw_read(), 'HEader\0\0')
+            self.assertEquals(str(body), 'bodytail')
+
+            os.lseek(fd, 16 + 4998, os.SEEK_SET)
+            rest = [bytearray(1) for i in xrange(4)]
+            self.assertEquals(readv(fd, rest), 2) # Short at the end of the file
+            self.assertEquals([str(b) for b in rest], ['x', 'x', '\0', '\0'])
+
+            self.assertRaises(BufferError, readv, fd, ['read-only'])
+            self.assertRaises(IOError, writev, -1, ['x'])
@@ -3,7 +3,7 @@ from test.test_case import MFSTestCase
 from test.performance import PerformanceTestCase
 
 from mfs.objects import MFSObjectHeader
-from mfs.symbol_table import SymbolTableHeader
+from mfs.symbol_table import SymbolTableHeader, SymbolTableEntry
 from mfs.exceptions import SerializationError
 from mfs.string_buffer import StringBuffer
 from tempfile import TemporaryFile
@@ -43,6 +43,64 @@ class TestSymbolTable(MFSTestCase):
         for i in xrange(len(st.symbols)):
             self.assertEquals(st.symbols[i].symbol, header.symbols[i].symbol)
 
+    def test_lookup(self):
+        st = SymbolTableHeader()
+        for i in xrange(1000):
+            st.add('symbol_%d' % i)
+        self.assertEquals(st.find('symbol_500').idx, 500)
+        self.assertEquals(st.lookup(999).symbol, 'symbol_999')
+        self.assertIsNone(st.find('missing'))
+        self.assertIsNone(st.lookup(1000))
+
+        st.add(SymbolTableEntry(2000, 7, 'sparse'))
+        st.add('next')
+        self.assertEquals(st.find('next').idx, 2001)
+
+    def test_find_serialized(self):
+        st = SymbolTableHeader()
+        names = ['symbol_%d' % i for i in xrange(500)]
+        random.shuffle(names)
+        for name in names:
+            st.add(name)
+        st.add('symbol_7') # Duplicates resolve to the first entry
+
+        sb = st.serialize()
+        self.assertEquals(sb.buffer_size(), len(st))
+        for name in names[:50]:
+            entry = SymbolTableHeader.find_serialized(sb, name)
+            self.assertEquals(entry.symbol, name)
+            self.assertEquals(entry.idx, st.find(name).idx)
+            self.assertEquals(SymbolTableHeader.lookup_serialized(sb, entry.idx).symbol, name)
+        self.assertEquals(SymbolTableHeader.find_serialized(sb, 'symbol_7').idx, names.index('symbol_7'))
+        self.assertIsNone(SymbolTableHeader.find_serialized(sb, 'missing'))
+        self.assertIsNone(SymbolTableHeader.find_serialized(sb, 'zzz'))
+        self.assertIsNone(SymbolTableHeader.lookup_serialized(sb, 501))
+        self.assertEquals(sb.offset(), 0)
+
+        header = MFSObjectHeader.deserialize(sb)
+        header.deserialize_body(sb)
+        self.assertEquals(sb.offset(), sb.buffer_size())
+        self.assertEquals([s.symbol for s in header.symbols], names + ['symbol_7'])
+
+    def test_version_0(self):
+        sb = StringBuffer(16 + 16 + 16)
+        sb.pack('<BBHIQ', 0x03, 0, 0, 2, 32)
+        sb.pack('<HxxI', 0, 5)
+        sb.write('root\0\0\0\0')
+        sb.pack('<HxxI', 1, 5)
+        sb.write('time\0\0\0\0')
+
+        sb.seek(0)
+        self.assertEquals(SymbolTableHeader.find_serialized(sb, 'time').idx, 1)
+        header = MFSObjectHeader.deserialize(sb)
+        header.deserialize_body(sb)
+        self.assertEquals(header.find('root').idx, 0)
+
+        # Written back with indexes
+        sb = header.serialize()
+        self.assertEquals(sb.buffer_size(), 16 + 32 + 16)
+        self.assertEquals(SymbolTableHeader.find_serialized(sb, 'root').idx, 0)
+
 @attr('perf')
 class PerformanceSymbolTable(PerformanceTestCase):
     def create_symbol_tables(self):